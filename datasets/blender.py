@@ -12,6 +12,7 @@ import pytorch_lightning as pl
 
 import datasets
 from models.ray_utils import get_ray_directions
+from datasets.utils import parallel_load, get_load_num_workers
 from utils.misc import get_rank
 
 
@@ -62,24 +63,28 @@ class BlenderDatasetBase():
             get_ray_directions(self.w, self.h, self.fx, self.fy, self.cx, self.cy).to(self.rank) # (h, w, 3)
 
 
-        self.all_c2w, self.all_images, self.all_fg_masks = [], [], []
+        self.all_c2w = []
 
         for i, frame in enumerate(meta['frames']):
             c2w = torch.from_numpy(np.array(frame['transform_matrix'])[:3, :4])
             self.all_c2w.append(c2w)
 
-            img_path = os.path.join(self.config.root_dir, f"{frame['file_path']}.png")
+        def load_image(i):
+            img_path = os.path.join(self.config.root_dir, f"{meta['frames'][i]['file_path']}.png")
             img = Image.open(img_path)
             img = img.resize(self.img_wh, Image.BICUBIC)
             img = TF.to_tensor(img).permute(1, 2, 0) # (4, h, w) => (h, w, 4)
+            return img[...,:3], img[..., -1]
 
-            self.all_fg_masks.append(img[..., -1]) # (h, w)
-            self.all_images.append(img[...,:3])
+        n_images = len(meta['frames'])
+        self.all_images = torch.empty((n_images, self.h, self.w, 3), dtype=torch.float32)
+        self.all_fg_masks = torch.empty((n_images, self.h, self.w), dtype=torch.float32)
+        parallel_load(load_image, n_images, [self.all_images, self.all_fg_masks], get_load_num_workers(self.config))
 
         self.all_c2w, self.all_images, self.all_fg_masks = \
             torch.stack(self.all_c2w, dim=0).float().to(self.rank), \
-            torch.stack(self.all_images, dim=0).float().to(self.rank), \
-            torch.stack(self.all_fg_masks, dim=0).float().to(self.rank)
+            self.all_images.to(self.rank), \
+            self.all_fg_masks.to(self.rank)
         
 
 class BlenderDataset(Dataset, BlenderDatasetBase):
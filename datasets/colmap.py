@@ -12,8 +12,9 @@ import pytorch_lightning as pl
 
 import datasets
 from datasets.colmap_utils import \
-    read_cameras_binary, read_images_binary, read_points3d_binary
+    read_cameras_binary, read_images_binary_columnar, read_points3d_binary_columnar
 from models.ray_utils import get_ray_directions
+from datasets.utils import ImageCache, parallel_load, get_load_num_workers
 from utils.misc import get_rank
 
 
@@ -134,6 +135,24 @@ class ColmapDatasetBase():
     initialized = False
     properties = {}
 
+    def get_mask_path(self, name, mask_dir):
+        mask_paths = [os.path.join(mask_dir, name), os.path.join(mask_dir, name[3:])]
+        mask_paths = list(filter(os.path.exists, mask_paths))
+        assert len(mask_paths) == 1
+        return mask_paths[0]
+
+    def read_image_uint8(self, name, img_wh, mask_dir, has_mask):
+        img = Image.open(os.path.join(self.config.root_dir, 'images', name))
+        img = img.resize(img_wh, Image.BICUBIC)
+        img = np.array(img.convert('RGB'))
+        if has_mask:
+            mask = Image.open(self.get_mask_path(name, mask_dir)).convert('L')
+            mask = mask.resize(img_wh, Image.BICUBIC)
+            mask = np.array(mask)
+        else:
+            mask = np.full(img.shape[:2], 255, dtype=np.uint8)
+        return img, mask
+
     def setup(self, config, split):
         self.config = config
         self.split = split
@@ -170,7 +189,7 @@ class ColmapDatasetBase():
             
             directions = get_ray_directions(w, h, fx, fy, cx, cy).to(self.rank)
 
-            imdata = read_images_binary(os.path.join(self.config.root_dir, 'sparse/0/images.bin'))
+            imdata = read_images_binary_columnar(os.path.join(self.config.root_dir, 'sparse/0/images.bin'))
 
             mask_dir = os.path.join(self.config.root_dir, 'masks')
             has_mask = os.path.exists(mask_dir) # TODO: support partial masks
@@ -184,28 +203,31 @@ class ColmapDatasetBase():
                 c2w = torch.from_numpy(np.concatenate([R.T, -R.T@t], axis=1)).float()
                 c2w[:,1:3] *= -1. # COLMAP => OpenGL
                 all_c2w.append(c2w)
-                if self.split in ['train', 'val']:
-                    img_path = os.path.join(self.config.root_dir, 'images', d.name)
-                    img = Image.open(img_path)
-                    img = img.resize(img_wh, Image.BICUBIC)
-                    img = TF.to_tensor(img).permute(1, 2, 0)[...,:3]
-                    img = img.to(self.rank) if self.config.load_data_on_gpu else img.cpu()
-                    if has_mask:
-                        mask_paths = [os.path.join(mask_dir, d.name), os.path.join(mask_dir, d.name[3:])]
-                        mask_paths = list(filter(os.path.exists, mask_paths))
-                        assert len(mask_paths) == 1
-                        mask = Image.open(mask_paths[0]).convert('L') # (H, W, 1)
-                        mask = mask.resize(img_wh, Image.BICUBIC)
-                        mask = TF.to_tensor(mask)[0]
-                    else:
-                        mask = torch.ones_like(img[...,0], device=img.device)
-                    all_fg_masks.append(mask) # (h, w)
-                    all_images.append(img)
             
             all_c2w = torch.stack(all_c2w, dim=0)   
 
-            pts3d = read_points3d_binary(os.path.join(self.config.root_dir, 'sparse/0/points3D.bin'))
-            pts3d = torch.from_numpy(np.array([pts3d[k].xyz for k in pts3d])).float()
+            if self.split in ['train', 'val']:
+                names = [d.name for d in imdata.values()]
+                load_image = lambda i: self.read_image_uint8(names[i], img_wh, mask_dir, has_mask)
+                num_workers = get_load_num_workers(self.config)
+                if self.config.get('image_cache', False):
+                    image_paths = [os.path.join(self.config.root_dir, 'images', name) for name in names]
+                    mask_paths = [self.get_mask_path(name, mask_dir) for name in names] if has_mask else None
+                    image_cache = ImageCache(self.config.get('image_cache_dir', os.path.join(self.config.root_dir, 'cache')), image_paths, img_wh, mask_paths)
+                    if not image_cache.exists():
+                        image_cache.write(load_image, num_workers)
+                    # uint8 (N, H, W, 3) and (N, H, W) tensors backed by the memory-mapped cache file
+                    all_images, all_fg_masks = image_cache.load()
+                else:
+                    all_images = torch.empty((len(names), h, w, 3), dtype=torch.float32)
+                    all_fg_masks = torch.empty((len(names), h, w), dtype=torch.float32)
+                    parallel_load(
+                        lambda i: [torch.from_numpy(x).float() / 255. for x in load_image(i)],
+                        len(names), [all_images, all_fg_masks], num_workers
+                    )
+
+            pts3d = read_points3d_binary_columnar(os.path.join(self.config.root_dir, 'sparse/0/points3D.bin'))
+            pts3d = torch.from_numpy(pts3d.xyz).float()
             all_c2w, pts3d = normalize_poses(all_c2w, pts3d, up_est_method=self.config.up_est_method, center_est_method=self.config.center_est_method)
 
             ColmapDatasetBase.properties = {
@@ -231,8 +253,6 @@ class ColmapDatasetBase():
             self.all_c2w = create_spheric_poses(self.all_c2w[:,:,3], n_steps=self.config.n_test_traj_steps)
             self.all_images = torch.zeros((self.config.n_test_traj_steps, self.h, self.w, 3), dtype=torch.float32)
             self.all_fg_masks = torch.zeros((self.config.n_test_traj_steps, self.h, self.w), dtype=torch.float32)
-        else:
-            self.all_images, self.all_fg_masks = torch.stack(self.all_images, dim=0).float(), torch.stack(self.all_fg_masks, dim=0).float()
 
         """
         # for debug use
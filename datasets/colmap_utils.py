@@ -30,7 +30,9 @@
 # Author: Johannes L. Schoenberger (jsch at inf.ethz.ch)
 
 import os
+import mmap
 import collections
+import collections.abc
 import numpy as np
 import struct
 
@@ -256,6 +258,147 @@ def read_points3d_binary(path_to_model_file):
     return points3D
 
 
+# fixed-width parts of the binary records, numpy structured dtypes are packed like the files
+IMAGE_HEADER_DTYPE = np.dtype([
+    ("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")])
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+POINT3D_HEADER_DTYPE = np.dtype([
+    ("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8"), ("track_length", "<u8")])
+TRACK_ELEM_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+def map_file(path):
+    """Read-only memory map of the file, use it as a context manager to close the mapping.
+    Arrays returned by gather_byte_ranges are copies and stay valid after closing.
+    """
+    with open(path, "rb") as fid:
+        return mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def gather_byte_ranges(buffer, starts, lengths):
+    """Concatenate buffer[start:start+length] for sorted, non-overlapping ranges.
+    The ranges are selected with a byte mask made of alternating runs of gaps and ranges, not a Python loop.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    starts, lengths = np.asarray(starts, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+    ends = starts + lengths
+    gaps = starts - np.concatenate([[0], ends[:-1]])
+    run_lengths = np.stack([gaps, lengths], axis=-1).reshape(-1)
+    run_values = np.tile(np.array([False, True]), len(starts))
+    mask = np.repeat(run_values, run_lengths)
+    return data[:len(mask)][mask]
+
+
+class ColumnarImages(collections.abc.Mapping):
+    """Images of images.bin as columnar arrays: ids, qvecs, tvecs, camera_ids, names,
+    and all 2D points concatenated in xys / point3D_ids, with point_offsets[i]:point_offsets[i+1]
+    the points of the i-th image. Behaves like the dict returned by read_images_binary,
+    Image tuples are only built when an image is accessed.
+    """
+    def __init__(self, ids, qvecs, tvecs, camera_ids, names, point_offsets, xys, point3D_ids):
+        self.ids, self.qvecs, self.tvecs, self.camera_ids, self.names = ids, qvecs, tvecs, camera_ids, names
+        self.point_offsets, self.xys, self.point3D_ids = point_offsets, xys, point3D_ids
+        self.index = {image_id: i for i, image_id in enumerate(ids.tolist())}
+
+    def image(self, i):
+        start, end = self.point_offsets[i], self.point_offsets[i + 1]
+        return Image(
+            id=int(self.ids[i]), qvec=self.qvecs[i], tvec=self.tvecs[i],
+            camera_id=int(self.camera_ids[i]), name=self.names[i],
+            xys=self.xys[start:end], point3D_ids=self.point3D_ids[start:end])
+
+    def __getitem__(self, image_id):
+        return self.image(self.index[image_id])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ColumnarPoints3D(collections.abc.Mapping):
+    """Points of points3D.bin as columnar arrays: ids, xyz, rgb, errors, and all track elements
+    concatenated in image_ids / point2D_idxs, with track_offsets[i]:track_offsets[i+1] the track
+    of the i-th point. Behaves like the dict returned by read_points3d_binary.
+    """
+    def __init__(self, ids, xyz, rgb, errors, track_offsets, image_ids, point2D_idxs):
+        self.ids, self.xyz, self.rgb, self.errors = ids, xyz, rgb, errors
+        self.track_offsets, self.image_ids, self.point2D_idxs = track_offsets, image_ids, point2D_idxs
+        self.index = {point3D_id: i for i, point3D_id in enumerate(ids.tolist())}
+
+    def point(self, i):
+        start, end = self.track_offsets[i], self.track_offsets[i + 1]
+        return Point3D(
+            id=int(self.ids[i]), xyz=self.xyz[i], rgb=self.rgb[i], error=self.errors[i],
+            image_ids=self.image_ids[start:end], point2D_idxs=self.point2D_idxs[start:end])
+
+    def __getitem__(self, point3D_id):
+        return self.point(self.index[point3D_id])
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def read_images_binary_columnar(path_to_model_file):
+    """
+    Same file format as read_images_binary. Only the record boundaries are found
+    with a loop over images, the records themselves are parsed with np.frombuffer.
+    """
+    with map_file(path_to_model_file) as buffer:
+        num_reg_images = struct.unpack_from("<Q", buffer, 0)[0]
+        header_starts, names, point_starts, num_points = [], [], [], []
+        num_points_struct = struct.Struct("<Q")
+        pos = 8
+        for _ in range(num_reg_images):
+            header_starts.append(pos)
+            name_end = buffer.find(b"\x00", pos + IMAGE_HEADER_DTYPE.itemsize)
+            names.append(buffer[pos + IMAGE_HEADER_DTYPE.itemsize:name_end].decode("utf-8"))
+            n = num_points_struct.unpack_from(buffer, name_end + 1)[0]
+            point_starts.append(name_end + 9)
+            num_points.append(n)
+            pos = name_end + 9 + POINT2D_DTYPE.itemsize * n
+        num_points = np.asarray(num_points, dtype=np.int64)
+        # fields of packed records are unaligned strided views, columns are copied to contiguous arrays
+        headers = gather_byte_ranges(buffer, header_starts, [IMAGE_HEADER_DTYPE.itemsize] * num_reg_images).view(IMAGE_HEADER_DTYPE)
+        points = gather_byte_ranges(buffer, point_starts, POINT2D_DTYPE.itemsize * num_points).view(POINT2D_DTYPE)
+    column = lambda records, field: np.ascontiguousarray(records[field])
+    return ColumnarImages(
+        ids=column(headers, "id"), qvecs=column(headers, "qvec"), tvecs=column(headers, "tvec"),
+        camera_ids=column(headers, "camera_id"), names=names,
+        point_offsets=np.concatenate([[0], np.cumsum(num_points)]),
+        xys=column(points, "xy"), point3D_ids=column(points, "point3D_id"))
+
+
+def read_points3d_binary_columnar(path_to_model_file):
+    """
+    Same file format as read_points3d_binary. Only the record boundaries are found
+    with a loop over points, the records themselves are parsed with np.frombuffer.
+    """
+    with map_file(path_to_model_file) as buffer:
+        num_points = struct.unpack_from("<Q", buffer, 0)[0]
+        starts = []
+        header_size = POINT3D_HEADER_DTYPE.itemsize
+        track_length_struct = struct.Struct("<Q")
+        track_length_pos = header_size - 8
+        pos = 8
+        for _ in range(num_points):
+            starts.append(pos)
+            pos += header_size + TRACK_ELEM_DTYPE.itemsize * track_length_struct.unpack_from(buffer, pos + track_length_pos)[0]
+        starts = np.asarray(starts, dtype=np.int64)
+        headers = gather_byte_ranges(buffer, starts, np.full_like(starts, header_size)).view(POINT3D_HEADER_DTYPE)
+        track_lengths = headers["track_length"].astype(np.int64)
+        tracks = gather_byte_ranges(buffer, starts + header_size, TRACK_ELEM_DTYPE.itemsize * track_lengths).view(TRACK_ELEM_DTYPE)
+    column = lambda records, field: np.ascontiguousarray(records[field])
+    return ColumnarPoints3D(
+        ids=column(headers, "id"), xyz=column(headers, "xyz"), rgb=column(headers, "rgb"), errors=column(headers, "error"),
+        track_offsets=np.concatenate([[0], np.cumsum(track_lengths)]),
+        image_ids=column(tracks, "image_id"), point2D_idxs=column(tracks, "point2D_idx"))
+
+
 def read_model(path, ext):
     if ext == ".txt":
         cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
@@ -14,6 +14,7 @@ import pytorch_lightning as pl
 
 import datasets
 from models.ray_utils import get_ray_directions
+from datasets.utils import parallel_load, get_load_num_workers
 from utils.misc import get_rank
 
 
@@ -105,7 +106,10 @@ class DTUDatasetBase():
             c2w_[:3,1:3] *= -1. # flip input sign
             self.all_c2w.append(c2w_[:3,:4])         
 
-            if self.split in ['train', 'val']:
+        self.all_c2w = torch.stack(self.all_c2w, dim=0)
+
+        if self.split in ['train', 'val']:
+            def load_image(i):
                 img_path = os.path.join(self.config.root_dir, 'image', f'{i:06d}.png')
                 img = Image.open(img_path)
                 img = img.resize(self.img_wh, Image.BICUBIC)
@@ -115,11 +119,11 @@ class DTUDatasetBase():
                 mask = Image.open(mask_path).convert('L') # (H, W, 1)
                 mask = mask.resize(self.img_wh, Image.BICUBIC)
                 mask = TF.to_tensor(mask)[0]
+                return img, mask
 
-                self.all_fg_masks.append(mask) # (h, w)
-                self.all_images.append(img)
-
-        self.all_c2w = torch.stack(self.all_c2w, dim=0)
+            self.all_images = torch.empty((n_images, self.h, self.w, 3), dtype=torch.float32)
+            self.all_fg_masks = torch.empty((n_images, self.h, self.w), dtype=torch.float32)
+            parallel_load(load_image, n_images, [self.all_images, self.all_fg_masks], get_load_num_workers(self.config))
 
         if self.split == 'test':
             self.all_c2w = create_spheric_poses(self.all_c2w[:,:,3], n_steps=self.config.n_test_traj_steps)
@@ -127,7 +131,6 @@ class DTUDatasetBase():
             self.all_fg_masks = torch.zeros((self.config.n_test_traj_steps, self.h, self.w), dtype=torch.float32)
             self.directions = self.directions[0]
         else:
-            self.all_images, self.all_fg_masks = torch.stack(self.all_images, dim=0), torch.stack(self.all_fg_masks, dim=0)  
             self.directions = torch.stack(self.directions, dim=0)
 
         self.directions = self.directions.float().to(self.rank)
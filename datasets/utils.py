@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+from models.ray_utils import get_rays, oct_encode, oct_decode
+
+
+class RayCache():
+    """
+    Training rays of a dataset precomputed once, so that a training step only gathers by flat pixel index
+    (image_index * H * W + y * W + x) instead of rebuilding rays with get_rays.
+    Origins are stored once per camera, normalized world-space directions once per pixel, either
+    as fp16 vectors ('fp16', 6 bytes per pixel) or as int16 octahedral coordinates ('oct', 4 bytes per pixel).
+    """
+    def __init__(self, directions, all_c2w, encoding='fp16'):
+        assert encoding in ['fp16', 'oct'], f"Unknown ray cache encoding: {encoding}"
+        self.encoding = encoding
+        n_images, h, w = all_c2w.shape[0], directions.shape[-3], directions.shape[-2]
+        self.n_pixels = h * w
+        self.origins = all_c2w[:,:,3].float().clone() # (N_images, 3)
+        if self.encoding == 'fp16':
+            self.dirs = torch.empty((n_images * self.n_pixels, 3), dtype=torch.float16, device=directions.device)
+        else:
+            self.dirs = torch.empty((n_images * self.n_pixels, 2), dtype=torch.int16, device=directions.device)
+        for i in range(n_images):
+            directions_i = directions if directions.ndim == 3 else directions[i]
+            _, rays_d = get_rays(directions_i, all_c2w[i].to(directions_i))
+            self.dirs[i*self.n_pixels:(i+1)*self.n_pixels] = self.encode(F.normalize(rays_d, p=2, dim=-1))
+
+    def encode(self, dirs):
+        if self.encoding == 'fp16':
+            return dirs.half()
+        return (oct_encode(dirs) * 32767.).round().short()
+
+    def decode(self, dirs):
+        if self.encoding == 'fp16':
+            return dirs.float()
+        return oct_decode(dirs.float() / 32767.)
+
+    def __call__(self, pixel_index):
+        rays_o = self.origins[pixel_index // self.n_pixels]
+        rays_d = self.decode(self.dirs[pixel_index])
+        return rays_o, rays_d
+
+
+def get_ray_cache(dataset):
+    # built lazily on first use so that only the dataset used for training pays for it
+    if getattr(dataset, 'ray_cache', None) is None:
+        dataset.ray_cache = RayCache(dataset.directions, dataset.all_c2w, dataset.config.ray_cache)
+        # the cache replaces the full-precision per-pixel directions, training only gathers from it
+        dataset.directions = None
+    return dataset.ray_cache
+
+
+def parallel_load(load_fn, n, outputs, num_workers):
+    """
+    Calls load_fn(i) for i in range(n) on a thread pool and writes the returned arrays into the preallocated outputs[k][i].
+    PIL decoding and resizing release the GIL, so threads decode in parallel without copying results between processes.
+    Every result has its own slot in the outputs, so they do not depend on the scheduling of the workers.
+    """
+    def load(i):
+        for output, value in zip(outputs, load_fn(i)):
+            output[i] = value
+
+    if num_workers <= 1:
+        for i in range(n):
+            load(i)
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            # consume the results to re-raise exceptions from the workers
+            list(executor.map(load, range(n)))
+
+
+def get_load_num_workers(config):
+    return config.get('load_num_workers', min(8, os.cpu_count()))
+
+
+def to_float(images):
+    # images and masks may be kept as uint8 (see ImageCache), gathered pixels are converted on the fly
+    if images.dtype == torch.uint8:
+        return images.float() / 255.
+    return images
+
+
+class ImageCache():
+    """
+    Decoded and resized uint8 images and masks of a dataset stored in one contiguous file, all images followed by all masks,
+    with a json index of the shape. The file is written once and memory-mapped by later runs, so images are not decoded
+    again and do not have to fit in host memory. The cache key covers the names, sizes and modification times of the images
+    and masks and the image resolution, any change of those writes a new cache file.
+    """
+    def __init__(self, cache_dir, image_paths, img_wh, mask_paths=None):
+        w, h = img_wh
+        self.shape = (len(image_paths), h, w)
+        file_key = lambda p: (os.path.basename(p), os.path.getsize(p), os.stat(p).st_mtime_ns)
+        key = json.dumps({
+            'images': [file_key(p) for p in image_paths],
+            'masks': None if mask_paths is None else [file_key(p) for p in mask_paths],
+            'img_wh': [w, h]
+        })
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        os.makedirs(cache_dir, exist_ok=True)
+        self.data_path = os.path.join(cache_dir, f'images-{key}.bin')
+        self.index_path = os.path.join(cache_dir, f'images-{key}.json')
+
+    def exists(self):
+        # the index is written last, an interrupted conversion leaves no index behind
+        return os.path.exists(self.index_path) and os.path.exists(self.data_path)
+
+    def write(self, load_fn, num_workers=1):
+        """
+        load_fn(i) returns the i-th image as a uint8 (h, w, 3) array and its mask as a uint8 (h, w) array.
+        """
+        n, h, w = self.shape
+        tmp_path = self.data_path + '.tmp'
+        data = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=(n * h * w * 4,))
+        images, masks = data[:n * h * w * 3].reshape(n, h, w, 3), data[n * h * w * 3:].reshape(n, h, w)
+        parallel_load(load_fn, n, [images, masks], num_workers)
+        del images, masks
+        data.flush()
+        del data
+        os.replace(tmp_path, self.data_path)
+        with open(self.index_path, 'w') as f:
+            json.dump({'shape': [n, h, w]}, f)
+
+    def load(self):
+        with open(self.index_path) as f:
+            n, h, w = json.load(f)['shape']
+        # copy-on-write mapping: writable for torch.from_numpy, the file itself is never modified
+        data = np.memmap(self.data_path, dtype=np.uint8, mode='c')
+        # images and masks are laid out contiguously, so each is a single strided view of the file
+        images = data[:n * h * w * 3].reshape(n, h, w, 3)
+        masks = data[n * h * w * 3:].reshape(n, h, w)
+        return torch.from_numpy(images), torch.from_numpy(masks)
@@ -0,0 +1,205 @@
+"""
+Baking of a trained NeuS model into a sparse voxel grid for fast (CPU) previews.
+
+bake_neus samples the SDF and the radiance of the model at the corners of the voxels of bricks (brick_size^3 voxels)
+close to the surface. The radiance is stored as spherical harmonics fitted to the texture network evaluated in n_dirs
+directions, with the normal of the SDF. BakedNeuS renders the baked grid: it only marches the samples inside occupied
+bricks, interpolates the SDF, its gradient and the SH coefficients trilinearly and composites with the NeuS alpha
+(cos_anneal_ratio = 1 as in evaluation).
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from models.utils import chunk_batch
+from models.rendering import ray_aabb_intersect_torch, render_weight_from_alpha_torch, accumulate_along_rays_torch
+
+
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792, -1.0925484305920792, 0.31539156525252005, -1.0925484305920792, 0.5462742152960396]
+
+
+def sh_basis(dirs, degree):
+    # real spherical harmonics up to degree 2 of unit directions (N, 3) => (N, (degree + 1)^2)
+    x, y, z = dirs.unbind(-1)
+    basis = [torch.full_like(x, SH_C0)]
+    if degree >= 1:
+        basis += [-SH_C1 * y, SH_C1 * z, -SH_C1 * x]
+    if degree >= 2:
+        basis += [SH_C2[0] * x * y, SH_C2[1] * y * z, SH_C2[2] * (2 * z * z - x * x - y * y), SH_C2[3] * x * z, SH_C2[4] * (x * x - y * y)]
+    if degree > 2:
+        raise NotImplementedError
+    return torch.stack(basis, dim=-1)
+
+
+def fibonacci_directions(n):
+    # n nearly uniform unit directions
+    i = torch.arange(n, dtype=torch.float32) + 0.5
+    z = 1 - 2 * i / n
+    phi = math.pi * (3 - math.sqrt(5)) * i
+    r = (1 - z * z).sqrt()
+    return torch.stack([r * phi.cos(), r * phi.sin(), z], dim=-1)
+
+
+def brick_corners(brick_size):
+    return torch.stack(torch.meshgrid(*([torch.arange(brick_size + 1)] * 3), indexing='ij'), dim=-1).view(-1, 3)
+
+
+@torch.no_grad()
+def bake_neus(model, resolution=256, brick_size=8, band=2.0, sh_degree=1, n_dirs=32, chunk=65536):
+    """
+    resolution: number of voxels along each axis of the scene box, a multiple of brick_size.
+    band: half width (in voxels) of the region around the zero level set that is baked, beyond the conservative brick test.
+    Returns a dict of tensors (on CPU) to be saved with torch.save and loaded by BakedNeuS.
+    """
+    assert resolution % brick_size == 0, "resolution has to be a multiple of brick_size"
+    assert sh_degree in [0, 1, 2], f"sh_degree has to be 0, 1 or 2, got {sh_degree}"
+    assert n_dirs >= (sh_degree + 1)**2, f"n_dirs has to be at least (sh_degree + 1)^2 = {(sh_degree + 1)**2} to fit the SH coefficients"
+    radius, device = model.config.radius, model.scene_aabb.device
+    voxel_size = 2 * radius / resolution
+    n_bricks = resolution // brick_size
+
+    def to_world(index, n):
+        return (index.float() / n * 2 - 1) * radius
+
+    def eval_sdf(x):
+        return model.geometry(x.to(device), with_grad=False, with_feature=False)
+
+    # bricks whose corners are all farther from the surface than the brick diagonal (plus the band) are empty
+    lattice = brick_corners(n_bricks)
+    lattice_sdf = chunk_batch(eval_sdf, chunk, True, to_world(lattice, n_bricks)).view(n_bricks + 1, n_bricks + 1, n_bricks + 1)
+    corner_sdf = torch.stack([lattice_sdf[i:i+n_bricks, j:j+n_bricks, k:k+n_bricks] for i, j, k in brick_corners(1).tolist()], dim=-1)
+    brick_diagonal = math.sqrt(3) * brick_size * voxel_size
+    active = (corner_sdf.amin(dim=-1) <= 0) & (corner_sdf.amax(dim=-1) >= 0)
+    active |= corner_sdf.abs().amin(dim=-1) <= brick_diagonal + band * voxel_size
+    bricks = torch.nonzero(active)
+    brick_index = torch.full((n_bricks,) * 3, -1, dtype=torch.int32)
+    brick_index[active] = torch.arange(len(bricks), dtype=torch.int32)
+
+    # SDF and SH coefficients at the voxel corners of the active bricks, the radiance is fitted in n_dirs directions
+    dirs = fibonacci_directions(n_dirs).to(device)
+    fit = torch.linalg.pinv(sh_basis(dirs, sh_degree)) # ((degree + 1)^2, n_dirs)
+    def eval_baked(x):
+        sdf, sdf_grad, feature = model.geometry(x.to(device), with_grad=True, with_feature=True)
+        normal = F.normalize(sdf_grad, p=2, dim=-1)
+        n = len(x)
+        rgb = model.texture(
+            feature[:,None].expand(n, n_dirs, feature.shape[-1]).reshape(n * n_dirs, -1),
+            dirs.repeat(n, 1),
+            normal[:,None].expand(n, n_dirs, 3).reshape(n * n_dirs, 3)
+        ).view(n, n_dirs, 3)
+        sh = torch.einsum('ck,nkj->ncj', fit, rgb.float())
+        return sdf.detach(), sh.reshape(n, -1).detach()
+
+    points = to_world((bricks[:,None,:] * brick_size + brick_corners(brick_size)[None,:,:]).reshape(-1, 3), resolution)
+    sdf, sh = chunk_batch(eval_baked, max(chunk // n_dirs, 1), True, points)
+    corners_per_brick = (brick_size + 1)**3
+    return {
+        'radius': radius,
+        'resolution': resolution,
+        'brick_size': brick_size,
+        'sh_degree': sh_degree,
+        'inv_s': float(model.variance.inv_s),
+        'brick_index': brick_index,
+        'sdf': sdf.view(len(bricks), corners_per_brick).half(),
+        'sh': sh.view(len(bricks), corners_per_brick, -1).half(),
+    }
+
+
+class BakedNeuS:
+    """
+    Renderer of a grid baked by bake_neus, in float32 on any device.
+    step_size defaults to half a voxel, samples are processed sample_chunk at a time.
+    """
+    def __init__(self, baked, device='cpu', step_size=None, sample_chunk=2**22):
+        self.radius, self.resolution, self.brick_size = baked['radius'], baked['resolution'], baked['brick_size']
+        self.sh_degree, self.inv_s = baked['sh_degree'], baked['inv_s']
+        self.brick_index = baked['brick_index'].to(device).long()
+        self.sdf = baked['sdf'].to(device).float().view(-1)
+        self.sh = baked['sh'].to(device).float()
+        self.sh = self.sh.view(-1, self.sh.shape[-1])
+        self.voxel_size = 2 * self.radius / self.resolution
+        self.step_size = step_size or self.voxel_size / 2
+        self.sample_chunk = sample_chunk
+        self.scene_aabb = torch.as_tensor([-self.radius] * 3 + [self.radius] * 3, dtype=torch.float32, device=device)
+        self.device = device
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        return cls(torch.load(path, map_location='cpu'), **kwargs)
+
+    def locate(self, x):
+        # brick id (-1 if empty) and continuous voxel coordinates within the brick of the world space points x (N, 3)
+        u = (x / self.radius * 0.5 + 0.5) * self.resolution
+        n_bricks = self.resolution // self.brick_size
+        brick = (u / self.brick_size).floor().long()
+        inside = ((brick >= 0) & (brick < n_bricks)).all(dim=-1)
+        brick = brick.clamp(0, n_bricks - 1)
+        index = torch.where(inside, self.brick_index[brick[:,0], brick[:,1], brick[:,2]], -1)
+        return index, u - brick * self.brick_size
+
+    def interpolate(self, index, local):
+        # trilinear SDF, its gradient (world space) and SH coefficients at voxel coordinates local within bricks index
+        b1 = self.brick_size + 1
+        cell = local.floor().clamp(0, self.brick_size - 1)
+        w = local - cell
+        cell = cell.long()
+        sdf, sdf_grad, sh = 0., 0., 0.
+        for i, j, k in brick_corners(1).tolist():
+            corner = index * b1**3 + ((cell[:,0] + i) * b1 + cell[:,1] + j) * b1 + cell[:,2] + k
+            wx, wy, wz = [w[:,d] if o else 1 - w[:,d] for d, o in enumerate((i, j, k))]
+            sign = [1. if o else -1. for o in (i, j, k)]
+            value = self.sdf[corner]
+            sdf = sdf + wx * wy * wz * value
+            sdf_grad = sdf_grad + torch.stack([sign[0] * wy * wz, sign[1] * wx * wz, sign[2] * wx * wy], dim=-1) * value[:,None]
+            sh = sh + (wx * wy * wz)[:,None] * self.sh[corner]
+        return sdf, sdf_grad * (self.resolution / (2 * self.radius)), sh
+
+    def render_(self, rays, background_color):
+        n_rays = rays.shape[0]
+        rays_o, rays_d = rays[:, 0:3], rays[:, 3:6]
+        t_min, t_max = ray_aabb_intersect_torch(rays_o, rays_d, self.scene_aabb)
+        n_steps = int(math.ceil(2 * math.sqrt(3) * self.radius / self.step_size))
+        t_starts = t_min[:,None] + torch.arange(n_steps, device=rays.device) * self.step_size
+        ray_indices, step = torch.nonzero(t_starts + self.step_size <= t_max[:,None], as_tuple=True)
+        t_starts = t_starts[ray_indices, step]
+        midpoints = t_starts + self.step_size / 2
+
+        # only the samples inside occupied bricks are interpolated
+        index, local = self.locate(rays_o[ray_indices] + rays_d[ray_indices] * midpoints[:,None])
+        occupied = index >= 0
+        ray_indices, midpoints, index, local = ray_indices[occupied], midpoints[occupied], index[occupied], local[occupied]
+        dirs = rays_d[ray_indices]
+        sdf, sdf_grad, sh = self.interpolate(index, local)
+        normal = F.normalize(sdf_grad, p=2, dim=-1)
+
+        iter_cos = -F.relu(-(dirs * normal).sum(-1))
+        prev_cdf = torch.sigmoid((sdf - iter_cos * self.step_size * 0.5) * self.inv_s)
+        next_cdf = torch.sigmoid((sdf + iter_cos * self.step_size * 0.5) * self.inv_s)
+        alpha = ((prev_cdf - next_cdf + 1e-5) / (prev_cdf + 1e-5)).clip(0.0, 1.0)[:,None]
+        weights = render_weight_from_alpha_torch(alpha, ray_indices, n_rays)
+
+        rgb = (sh.view(len(sh), -1, 3) * sh_basis(dirs, self.sh_degree)[...,None]).sum(1).clamp(0., 1.)
+        opacity = accumulate_along_rays_torch(weights, ray_indices, values=None, n_rays=n_rays)
+        depth = accumulate_along_rays_torch(weights, ray_indices, values=midpoints[:,None], n_rays=n_rays)
+        comp_rgb = accumulate_along_rays_torch(weights, ray_indices, values=rgb, n_rays=n_rays)
+        return {
+            'comp_rgb': comp_rgb,
+            'comp_rgb_full': comp_rgb + background_color * (1.0 - opacity),
+            'opacity': opacity,
+            'depth': depth,
+            'num_samples': torch.as_tensor([len(midpoints)], dtype=torch.int32, device=rays.device)
+        }
+
+    @torch.no_grad()
+    def render(self, rays, background_color=None):
+        # rays (N, 6) of normalized directions, as for NeuSModel.forward
+        rays = rays.to(self.device)
+        if background_color is None:
+            background_color = torch.ones((3,), dtype=torch.float32, device=self.device)
+        n_steps = int(math.ceil(2 * math.sqrt(3) * self.radius / self.step_size))
+        out = chunk_batch(self.render_, max(self.sample_chunk // n_steps, 1), False, rays, background_color=background_color)
+        return {**out, 'num_samples': out['num_samples'].sum()}
@@ -1,3 +1,8 @@
+import os
+import tempfile
+import contextlib
+import multiprocessing
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -7,33 +12,54 @@ from pytorch_lightning.utilities.rank_zero import rank_zero_info
 
 import models
 from models.base import BaseModel
-from models.utils import scale_anything, get_activation, cleanup, chunk_batch
-from models.network_utils import get_encoding, get_mlp, get_encoding_with_network
+from models.utils import scale_anything, get_activation, cleanup, chunk_batch, chunk_batch_stream
+from models.network_utils import get_encoding, get_mlp, get_encoding_with_network, supports_closed_form_grad
 from utils.misc import get_rank
 from systems.utils import update_module_step
 from nerfacc import ContractionType
 
 
+def contract_aabb(x, radius: float):
+    # [-radius, radius] to [0, 1]
+    return x / (2. * radius) + 0.5
+
+
+def contract_unbounded_sphere(x, radius: float):
+    # [-radius, radius] to [0.25, 0.75] and [-inf, inf] to [0, 1], points outside the unit sphere are contracted with
+    # (2 - 1 / mag) * x / mag, written without boolean indexing so that there is no data-dependent gather or sync
+    x = x / radius
+    mag = torch.linalg.vector_norm(x, dim=-1, keepdim=True).clamp(min=1.) # the contraction is the identity for mag <= 1
+    return x * ((2. - 1. / mag) / (4. * mag)) + 0.5
+
+
 def contract_to_unisphere(x, radius, contraction_type):
     if contraction_type == ContractionType.AABB:
-        x = scale_anything(x, (-radius, radius), (0, 1))
+        x = contract_aabb(x, radius)
     elif contraction_type == ContractionType.UN_BOUNDED_SPHERE:
-        x = scale_anything(x, (-radius, radius), (0, 1))
-        x = x * 2 - 1  # aabb is at [-1, 1]
-        mag = x.norm(dim=-1, keepdim=True)
-        mask = mag.squeeze(-1) > 1
-        x[mask] = (2 - 1 / mag[mask]) * (x[mask] / mag[mask])
-        x = x / 4 + 0.5  # [-inf, inf] is at [0, 1]
+        x = contract_unbounded_sphere(x, radius)
     else:
         raise NotImplementedError
     return x
 
 
+# level volume shared with the forked marching cubes workers, see MarchingCubeHelper.forward_parallel
+_mc_volume = None
+
+
+def _marching_cubes_block(args):
+    import mcubes
+    origin, block_size, threshold = args
+    x, y, z = origin
+    verts, faces = mcubes.marching_cubes(_mc_volume[x:x+block_size+1, y:y+block_size+1, z:z+block_size+1], threshold)
+    return verts.astype(np.float32), faces.astype(np.int64), origin
+
+
 class MarchingCubeHelper(nn.Module):
-    def __init__(self, resolution, use_torch=True):
+    def __init__(self, resolution, use_torch=True, num_workers=1, block_size=128):
         super().__init__()
         self.resolution = resolution
         self.use_torch = use_torch
+        self.num_workers, self.block_size = num_workers, block_size
         self.points_range = (0, 1)
         if self.use_torch:
             import torchmcubes
@@ -41,23 +67,39 @@ class MarchingCubeHelper(nn.Module):
         else:
             import mcubes
             self.mc_func = mcubes.marching_cubes
-        self.verts = None
 
-    def grid_vertices(self):
-        if self.verts is None:
-            x, y, z = torch.linspace(*self.points_range, self.resolution), torch.linspace(*self.points_range, self.resolution), torch.linspace(*self.points_range, self.resolution)
-            x, y, z = torch.meshgrid(x, y, z, indexing='ij')
-            verts = torch.cat([x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)], dim=-1).reshape(-1, 3)
-            self.verts = verts
-        return self.verts
+    def grid_vertices(self, start=0, end=None):
+        # coordinates of the grid vertices with linear (x, y, z) indices in [start, end), generated on the fly
+        n = self.resolution
+        end = n**3 if end is None else end
+        coords = torch.linspace(*self.points_range, n)
+        # whole z-rows covering the range, only the row indices need integer division
+        rows = torch.arange(start // n, (end - 1) // n + 1)
+        verts = torch.stack([
+            coords[rows // n][:,None].expand(-1, n),
+            coords[rows % n][:,None].expand(-1, n),
+            coords[None,:].expand(len(rows), -1)
+        ], dim=-1).view(-1, 3)
+        return verts[start - rows[0] * n:end - rows[0] * n]
 
-    def forward(self, level, threshold=0.):
+    def empty_level(self, path=None):
+        # preallocated level volume, memory-mapped to path if given
+        shape = (self.resolution, self.resolution, self.resolution)
+        if path is None:
+            return torch.empty(shape, dtype=torch.float32)
+        return torch.from_numpy(np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape))
+
+    def forward(self, level, threshold=0., inplace=False):
         level = level.float().view(self.resolution, self.resolution, self.resolution)
         if self.use_torch:
             verts, faces = self.mc_func(level.to(get_rank()), threshold)
             verts, faces = verts.cpu(), faces.cpu().long()
         else:
-            verts, faces = self.mc_func(-level.numpy(), threshold) # transform to numpy
+            level = level.numpy()
+            level = np.negative(level, out=level) if inplace else -level # negating in place avoids a copy of the volume
+            if self.num_workers > 1:
+                return self.forward_parallel(level, threshold)
+            verts, faces = self.mc_func(level, threshold) # transform to numpy
             verts, faces = torch.from_numpy(verts.astype(np.float32)), torch.from_numpy(faces.astype(np.int64)) # transform back to pytorch
         verts = verts / (self.resolution - 1.)
         return {
@@ -65,34 +107,109 @@ class MarchingCubeHelper(nn.Module):
             't_pos_idx': faces
         }
 
+    def forward_parallel(self, level, threshold=0.):
+        """
+        Marching cubes over blocks of block_size cells on a pool of num_workers forked processes.
+        Neighbouring blocks share a layer of grid vertices, so their meshes agree along the seams and are welded into the single-volume result.
+        level: the (negated) numpy level volume, read by the workers without copying.
+        """
+        global _mc_volume
+        n_cells = self.resolution - 1
+        origins = [(x, y, z) for x in range(0, n_cells, self.block_size) for y in range(0, n_cells, self.block_size) for z in range(0, n_cells, self.block_size)]
+        _mc_volume = level
+        try:
+            with multiprocessing.get_context('fork').Pool(self.num_workers) as pool:
+                blocks = pool.imap_unordered(_marching_cubes_block, [(origin, self.block_size, threshold) for origin in origins])
+                return self.merge_blocks((torch.from_numpy(verts), torch.from_numpy(faces), torch.as_tensor(origin)) for verts, faces, origin in blocks)
+        finally:
+            _mc_volume = None
+
+    def forward_blocks(self, blocks, threshold=0.):
+        """
+        Marching cubes over a sparse set of blocks of the (resolution)^3 grid.
+        blocks: iterable of (level, origin) with the level volume of a block and the grid index of its first vertex.
+        Blocks share their boundary vertices, the duplicated mesh vertices are welded afterwards.
+        """
+        def mesh_blocks():
+            for level, origin in blocks:
+                if self.use_torch:
+                    verts, faces = self.mc_func(level.float().to(get_rank()), threshold)
+                    verts, faces = verts.cpu(), faces.cpu().long()
+                else:
+                    verts, faces = self.mc_func(-level.float().numpy(), threshold)
+                    verts, faces = torch.from_numpy(verts.astype(np.float32)), torch.from_numpy(faces.astype(np.int64))
+                yield verts, faces, origin
+        return self.merge_blocks(mesh_blocks())
+
+    def merge_blocks(self, meshes):
+        # meshes: iterable of (verts, faces, origin) in block-local grid units, vertices on shared block faces are welded
+        v_pos, t_pos_idx, n_verts = [], [], 0
+        for verts, faces, origin in meshes:
+            if len(faces) == 0:
+                continue
+            v_pos.append(verts + origin.float())
+            t_pos_idx.append(faces + n_verts)
+            n_verts += len(verts)
+        if len(v_pos) == 0:
+            return {
+                'v_pos': torch.zeros((0, 3), dtype=torch.float32),
+                't_pos_idx': torch.zeros((0, 3), dtype=torch.int64)
+            }
+        verts, faces = weld_vertices(torch.cat(v_pos, dim=0), torch.cat(t_pos_idx, dim=0))
+        verts = verts / (self.resolution - 1.)
+        return {
+            'v_pos': verts,
+            't_pos_idx': faces
+        }
+
+
+def weld_vertices(verts, faces, eps=1e-3):
+    # merge vertices whose positions (in grid units) agree up to eps
+    _, inverse = torch.unique(torch.round(verts / eps).long(), dim=0, return_inverse=True)
+    verts_welded = torch.zeros((int(inverse.max()) + 1, 3), dtype=verts.dtype).index_copy_(0, inverse, verts)
+    return verts_welded, inverse[faces]
+
 
 class BaseImplicitGeometry(BaseModel):
+    # bound on the gradient norm of the level in world units, the narrow band of the sparse isosurface extraction relies on it
+    # (isosurface.level_lipschitz overrides it), None if the level has no such bound
+    level_lipschitz = None
+
     def __init__(self, config):
         super().__init__(config)
         if self.config.isosurface is not None:
             assert self.config.isosurface.method in ['mc', 'mc-torch']
+            if self.config.isosurface.get('sparse', False):
+                assert self.config.isosurface.get('level_lipschitz', self.level_lipschitz) is not None, \
+                    f"isosurface.sparse needs a Lipschitz bound of the level, {self.__class__.__name__} has none, set isosurface.level_lipschitz or use the dense extraction"
             if self.config.isosurface.method == 'mc-torch':
                 raise NotImplementedError("Please do not use mc-torch. It currently has some scaling issues I haven't fixed yet.")
-            self.helper = MarchingCubeHelper(self.config.isosurface.resolution, use_torch=self.config.isosurface.method=='mc-torch')
+            self.helper = MarchingCubeHelper(
+                self.config.isosurface.resolution, use_torch=self.config.isosurface.method=='mc-torch',
+                num_workers=self.config.isosurface.get('num_workers', 1), block_size=self.config.isosurface.get('mc_block_size', 128)
+            )
         self.radius = self.config.radius
         self.contraction_type = None # assigned in system
 
     def forward_level(self, points):
         raise NotImplementedError
 
-    def isosurface_(self, vmin, vmax):
+    def level_func(self, vmin, vmax):
         def batch_func(x):
             x = torch.stack([
                 scale_anything(x[...,0], (0, 1), (vmin[0], vmax[0])),
                 scale_anything(x[...,1], (0, 1), (vmin[1], vmax[1])),
                 scale_anything(x[...,2], (0, 1), (vmin[2], vmax[2])),
             ], dim=-1).to(self.rank)
-            rv = self.forward_level(x).cpu()
-            cleanup()
-            return rv
-    
-        level = chunk_batch(batch_func, self.config.isosurface.chunk, True, self.helper.grid_vertices())
-        mesh = self.helper(level, threshold=self.config.isosurface.threshold)
+            return self.forward_level(x)
+        return batch_func
+
+    def isosurface_(self, vmin, vmax):
+        if self.config.isosurface.get('sparse', False):
+            mesh = self.isosurface_sparse_(vmin, vmax)
+        else:
+            mesh = self.isosurface_dense_(vmin, vmax)
+        cleanup()
         mesh['v_pos'] = torch.stack([
             scale_anything(mesh['v_pos'][...,0], (0, 1), (vmin[0], vmax[0])),
             scale_anything(mesh['v_pos'][...,1], (0, 1), (vmin[1], vmax[1])),
@@ -100,6 +217,78 @@ class BaseImplicitGeometry(BaseModel):
         ], dim=-1)
         return mesh
 
+    def isosurface_dense_(self, vmin, vmax):
+        """
+        The level is evaluated chunk by chunk on grid coordinates generated from linear index ranges and written into a preallocated
+        volume, memory-mapped to a temporary file in isosurface.memmap_dir if set, so that peak memory does not scale with resolution^3.
+        """
+        level_func = self.level_func(vmin, vmax)
+        chunk, n_verts = self.config.isosurface.chunk, self.helper.resolution**3
+        memmap_dir = self.config.isosurface.get('memmap_dir', None)
+        with tempfile.TemporaryDirectory(dir=memmap_dir) if memmap_dir is not None else contextlib.nullcontext() as tmp_dir:
+            level = self.helper.empty_level(os.path.join(tmp_dir, 'level.npy') if tmp_dir is not None else None)
+            level_flat = level.view(-1)
+            vertex_level = lambda index: level_func(self.helper.grid_vertices(index.start, index.stop))
+            for start, end, level_chunk in chunk_batch_stream(vertex_level, chunk, True, range(n_verts)):
+                level_flat[start:end] = level_chunk
+            return self.helper(level, threshold=self.config.isosurface.threshold, inplace=True)
+
+    def isosurface_sparse_(self, vmin, vmax):
+        """
+        Hierarchical narrow-band extraction: the level is evaluated at the corners of coarse cells, cells whose corner values
+        straddle the threshold or lie within isosurface.narrow_band cell diagonals (times the Lipschitz bound of the level) of it are subdivided
+        until they reach isosurface.block_size grid cells,
+        and marching cubes only runs on these active blocks. Memory and queries scale with the surface area instead of resolution^3.
+        """
+        level_func = self.level_func(vmin, vmax)
+        chunk, threshold = self.config.isosurface.chunk, self.config.isosurface.threshold
+        n_cells = self.helper.resolution - 1
+        block_size = self.config.isosurface.get('block_size', 8)
+        narrow_band = self.config.isosurface.get('narrow_band', 1.0)
+        level_lipschitz = self.config.isosurface.get('level_lipschitz', self.level_lipschitz)
+        cell_size = block_size
+        while n_cells / cell_size > self.config.isosurface.get('coarse_resolution', 32):
+            cell_size *= 2
+
+        # mcubes extracts -level = threshold (see MarchingCubeHelper)
+        iso_level = threshold if self.helper.use_torch else -threshold
+
+        def eval_level(vertex_index):
+            return chunk_batch(level_func, chunk, True, vertex_index.clamp(max=n_cells).float() / n_cells)
+
+        corners = torch.stack(torch.meshgrid(*([torch.arange(2)] * 3), indexing='ij'), dim=-1).view(-1, 3)
+        n = (n_cells + cell_size - 1) // cell_size
+        cells = torch.stack(torch.meshgrid(*([torch.arange(n)] * 3), indexing='ij'), dim=-1).view(-1, 3)
+        while len(cells) > 0:
+            # evaluate each distinct corner once
+            corner_index = ((cells[:,None,:] + corners[None,:,:]) * cell_size).clamp(max=n_cells).view(-1, 3)
+            corner_key = (corner_index[:,0] * (n_cells + 1) + corner_index[:,1]) * (n_cells + 1) + corner_index[:,2]
+            corner_key, inverse = torch.unique(corner_key, return_inverse=True)
+            vertex_index = torch.stack([corner_key // (n_cells + 1)**2, corner_key // (n_cells + 1) % (n_cells + 1), corner_key % (n_cells + 1)], dim=-1)
+            corner_level = eval_level(vertex_index)[inverse].view(-1, 8)
+            active = (corner_level.amin(dim=1) <= iso_level) & (corner_level.amax(dim=1) >= iso_level)
+            # the surface may cross a cell without a sign change at its corners, but then all corners are closer to the surface
+            # than the cell diagonal, so their levels differ from the threshold by at most the Lipschitz bound times the diagonal
+            cell_diagonal = (torch.as_tensor(vmax) - torch.as_tensor(vmin)).float().norm() * cell_size / n_cells
+            active |= (corner_level - iso_level).abs().amin(dim=1) <= narrow_band * level_lipschitz * cell_diagonal
+            cells = cells[active]
+            if cell_size == block_size:
+                break
+            cells = (cells[:,None,:] * 2 + corners[None,:,:]).view(-1, 3)
+            cell_size //= 2
+            cells = cells[(cells * cell_size < n_cells).all(dim=-1)]
+
+        # dense level volumes of the active blocks, cropped at the grid boundary, evaluated a group of blocks at a time
+        origins = cells * block_size
+        offsets = torch.stack(torch.meshgrid(*([torch.arange(block_size + 1)] * 3), indexing='ij'), dim=-1).view(-1, 3)
+        def blocks():
+            for origins_ in origins.split(max(chunk // len(offsets), 1)):
+                levels = eval_level((origins_[:,None,:] + offsets[None,:,:]).view(-1, 3)).view(-1, block_size + 1, block_size + 1, block_size + 1)
+                extents = (n_cells - origins_).clamp(max=block_size) + 1
+                for level, origin, (ex, ey, ez) in zip(levels, origins_, extents.tolist()):
+                    yield level[:ex, :ey, :ez], origin
+        return self.helper.forward_blocks(blocks(), threshold=threshold)
+
     @torch.no_grad()
     def isosurface(self):
         if self.config.isosurface is None:
@@ -142,6 +331,8 @@ class VolumeDensity(BaseImplicitGeometry):
 
 @models.register('volume-sdf')
 class VolumeSDF(BaseImplicitGeometry):
+    level_lipschitz = 1. # the level is the SDF, kept close to unit gradient norm by the eikonal loss
+
     def setup(self):
         self.n_output_dims = self.config.feature_dim
         encoding = get_encoding(3, self.config.xyz_encoding_config)
@@ -152,51 +343,94 @@ class VolumeSDF(BaseImplicitGeometry):
         # the actual value used in training
         # will update at certain steps if finite_difference_eps="progressive"
         self._finite_difference_eps = None
+        # central: 6 offsets along the axes, tetrahedral: 4 offsets at the vertices of a tetrahedron
+        self.finite_difference_stencil = self.config.get('finite_difference_stencil', 'central')
+        assert self.finite_difference_stencil in ['central', 'tetrahedral']
         if self.grad_type == 'finite_difference':
-            rank_zero_info(f"Using finite difference to compute gradients with eps={self.finite_difference_eps}")
+            rank_zero_info(f"Using finite difference to compute gradients with eps={self.finite_difference_eps} and {self.finite_difference_stencil} stencil")
+        # pure-torch frequency encoding + MLP: the input gradient is computed alongside the forward pass instead of with autograd
+        self.closed_form_grad = self.grad_type == 'analytic' and self.config.get('closed_form_grad', True) \
+            and supports_closed_form_grad(self.encoding, self.network) and 'sdf_activation' not in self.config
+        if self.closed_form_grad:
+            self.jacobian_channels = F.one_hot(self.encoding.jacobian_channels(), 3).float()
+            rank_zero_info("Using closed-form gradients of the SDF network")
+
+    def finite_difference_offsets(self):
+        if self.finite_difference_stencil == 'central':
+            return torch.as_tensor(
+                [
+                    [1.0, 0.0, 0.0],
+                    [-1.0, 0.0, 0.0],
+                    [0.0, 1.0, 0.0],
+                    [0.0, -1.0, 0.0],
+                    [0.0, 0.0, 1.0],
+                    [0.0, 0.0, -1.0],
+                ]
+            )
+        elif self.finite_difference_stencil == 'tetrahedral':
+            return torch.as_tensor(
+                [
+                    [1.0, -1.0, -1.0],
+                    [-1.0, -1.0, 1.0],
+                    [-1.0, 1.0, -1.0],
+                    [1.0, 1.0, 1.0],
+                ]
+            )
 
     def forward(self, points, with_grad=True, with_feature=True, with_laplace=False):
-        with torch.inference_mode(torch.is_inference_mode_enabled() and not (with_grad and self.grad_type == 'analytic')):
-            with torch.set_grad_enabled(self.training or (with_grad and self.grad_type == 'analytic')):
-                if with_grad and self.grad_type == 'analytic':
+        with_closed_form_grad = with_grad and self.closed_form_grad and self.contraction_type == ContractionType.AABB
+        with_autograd = with_grad and self.grad_type == 'analytic' and not with_closed_form_grad
+        with torch.inference_mode(torch.is_inference_mode_enabled() and not with_autograd):
+            with torch.set_grad_enabled(self.training or with_autograd):
+                if with_autograd:
                     if not self.training:
                         points = points.clone() # points may be in inference mode, get a copy to enable grad
                     points.requires_grad_(True)
 
                 points_ = points # points in the original scale
                 points = contract_to_unisphere(points, self.radius, self.contraction_type) # points normalized to (0, 1)
-                
-                out = self.network(self.encoding(points.view(-1, 3))).view(*points.shape[:-1], self.n_output_dims).float()
+
+                with_finite_difference = with_grad and self.grad_type == 'finite_difference'
+                if with_finite_difference:
+                    # center and offset points are evaluated in a single call
+                    eps = self._finite_difference_eps
+                    offsets = self.finite_difference_offsets().to(points_)
+                    points_d_ = (points_[...,None,:] + eps * offsets).clamp(-self.radius, self.radius)
+                    points_d = contract_aabb(points_d_, self.radius)
+                    points_all = torch.cat([points[...,None,:], points_d], dim=-2)
+                    out_all = self.network(self.encoding(points_all.view(-1, 3))).view(*points.shape[:-1], 1 + len(offsets), self.n_output_dims).float()
+                    out, points_d_sdf = out_all[...,0,:], out_all[...,1:,0]
+                elif with_closed_form_grad:
+                    encoded, dencoded = self.encoding.forward_with_derivatives(points.view(-1, 3))
+                    out, grad_encoded = self.network.forward_with_input_grad(encoded, output_index=0)
+                    out = out.view(*points.shape[:-1], self.n_output_dims).float()
+                    # chain rule through the elementwise encoding (summed per input channel) and the AABB contraction to (0, 1)
+                    grad = ((grad_encoded * dencoded) @ self.jacobian_channels.to(grad_encoded)).view(*points.shape[:-1], 3) / (2 * self.radius)
+                else:
+                    out = self.network(self.encoding(points.view(-1, 3))).view(*points.shape[:-1], self.n_output_dims).float()
                 sdf, feature = out[...,0], out
                 if 'sdf_activation' in self.config:
                     sdf = get_activation(self.config.sdf_activation)(sdf + float(self.config.sdf_bias))
                 if 'feature_activation' in self.config:
                     feature = get_activation(self.config.feature_activation)(feature)
-                if with_grad:
+                if with_grad and not with_closed_form_grad:
                     if self.grad_type == 'analytic':
                         grad = torch.autograd.grad(
                             sdf, points_, grad_outputs=torch.ones_like(sdf),
                             create_graph=True, retain_graph=True, only_inputs=True
                         )[0]
-                    elif self.grad_type == 'finite_difference':
-                        eps = self._finite_difference_eps
-                        offsets = torch.as_tensor(
-                            [
-                                [eps, 0.0, 0.0],
-                                [-eps, 0.0, 0.0],
-                                [0.0, eps, 0.0],
-                                [0.0, -eps, 0.0],
-                                [0.0, 0.0, eps],
-                                [0.0, 0.0, -eps],
-                            ]
-                        ).to(points_)
-                        points_d_ = (points_[...,None,:] + offsets).clamp(-self.radius, self.radius)
-                        points_d = scale_anything(points_d_, (-self.radius, self.radius), (0, 1))
-                        points_d_sdf = self.network(self.encoding(points_d.view(-1, 3)))[...,0].view(*points.shape[:-1], 6).float()
+                    elif self.finite_difference_stencil == 'central':
                         grad = 0.5 * (points_d_sdf[..., 0::2] - points_d_sdf[..., 1::2]) / eps  
 
                         if with_laplace:
                             laplace = (points_d_sdf[..., 0::2] + points_d_sdf[..., 1::2] - 2 * sdf[..., None]).sum(-1) / (eps ** 2)
+                    elif self.finite_difference_stencil == 'tetrahedral':
+                        # sum_i k_i f(x + eps k_i) = 4 eps grad f + O(eps^3) for the 4 tetrahedron vertices k_i
+                        grad = (points_d_sdf[...,None] * offsets).sum(-2) / (4 * eps)
+
+                        if with_laplace:
+                            # sum_i f(x + eps k_i) - 4 f(x) = 2 eps^2 laplace f + O(eps^4)
+                            laplace = (points_d_sdf.sum(-1) - 4 * sdf) / (2 * eps ** 2)
 
         rv = [sdf]
         if with_grad:
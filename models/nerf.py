@@ -7,13 +7,15 @@ import torch.nn.functional as F
 import models
 from models.base import BaseModel
 from models.utils import chunk_batch
+from models.rendering import get_render_backend, OccupancyGridState
 from systems.utils import update_module_step
-from nerfacc import ContractionType, OccupancyGrid, ray_marching, render_weight_from_density, accumulate_along_rays
+from nerfacc import ContractionType
 
 
 @models.register('nerf')
 class NeRFModel(BaseModel):
     def setup(self):
+        self.render_backend = get_render_backend(self.config.get('render_backend', 'nerfacc'))
         self.geometry = models.make(self.config.geometry.name, self.config.geometry)
         self.texture = models.make(self.config.texture.name, self.config.texture)
         self.register_buffer('scene_aabb', torch.as_tensor([-self.config.radius, -self.config.radius, -self.config.radius, self.config.radius, self.config.radius, self.config.radius], dtype=torch.float32))
@@ -34,11 +36,12 @@ class NeRFModel(BaseModel):
         self.geometry.contraction_type = self.contraction_type
 
         if self.config.grid_prune:
-            self.occupancy_grid = OccupancyGrid(
+            self.occupancy_grid = self.render_backend.OccupancyGrid(
                 roi_aabb=self.scene_aabb,
                 resolution=self.occupancy_grid_res,
                 contraction_type=self.contraction_type
             )
+            self.occupancy_grid_state = OccupancyGridState(self.occupancy_grid, [self.geometry])
         self.randomized = self.config.randomized
         self.background_color = None
     
@@ -51,8 +54,12 @@ class NeRFModel(BaseModel):
             # approximate for 1 - torch.exp(-density[...,None] * self.render_step_size) based on taylor series
             return density[...,None] * self.render_step_size
         
-        if self.training and self.config.grid_prune:
-            self.occupancy_grid.every_n_step(step=global_step, occ_eval_fn=occ_eval_fn)
+        if self.config.grid_prune:
+            if self.training:
+                self.occupancy_grid_state.update(global_step, occ_eval_fn)
+            elif self.occupancy_grid_state.is_stale():
+                # restored without its grid or with a grid of other weights, build it once before rendering
+                self.occupancy_grid_state.rebuild(occ_eval_fn)
 
     def isosurface(self):
         mesh = self.geometry.isosurface()
@@ -62,7 +69,13 @@ class NeRFModel(BaseModel):
         n_rays = rays.shape[0]
         rays_o, rays_d = rays[:, 0:3], rays[:, 3:6] # both (N_rays, 3)
 
+        # ray_marching evaluates the density of all the marched samples once (visibility pass), the samples behind a transmittance
+        # of model.early_stop_eps are dropped there, n_samples_marched counts them for the samples_saved metric
+        n_samples_marched = 0
+
         def sigma_fn(t_starts, t_ends, ray_indices):
+            nonlocal n_samples_marched
+            n_samples_marched += len(t_starts)
             ray_indices = ray_indices.long()
             t_origins = rays_o[ray_indices]
             t_dirs = rays_d[ray_indices]
@@ -79,8 +92,11 @@ class NeRFModel(BaseModel):
             rgb = self.texture(feature, t_dirs)
             return rgb, density[...,None]
 
+        # early ray termination threshold (model.early_stop_eps) in evaluation, and in training if model.early_stop_train is set,
+        # training keeps nerfacc's default otherwise
+        early_stop_eps = self.config.get('early_stop_eps', 1e-4) if not self.training or self.config.get('early_stop_train', False) else 1e-4
         with torch.no_grad():
-            ray_indices, t_starts, t_ends = ray_marching(
+            ray_indices, t_starts, t_ends = self.render_backend.ray_marching(
                 rays_o, rays_d,
                 scene_aabb=None if self.config.learned_background else self.scene_aabb,
                 grid=self.occupancy_grid if self.config.grid_prune else None,
@@ -89,6 +105,7 @@ class NeRFModel(BaseModel):
                 render_step_size=self.render_step_size,
                 stratified=self.randomized,
                 cone_angle=self.cone_angle,
+                early_stop_eps=early_stop_eps,
                 alpha_thre=0.0
             )   
         
@@ -102,10 +119,10 @@ class NeRFModel(BaseModel):
         density, feature = self.geometry(positions) 
         rgb = self.texture(feature, t_dirs)
 
-        weights = render_weight_from_density(t_starts, t_ends, density[...,None], ray_indices=ray_indices, n_rays=n_rays)
-        opacity = accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
-        depth = accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
-        comp_rgb = accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
+        weights = self.render_backend.render_weight_from_density(t_starts, t_ends, density[...,None], ray_indices=ray_indices, n_rays=n_rays)
+        opacity = self.render_backend.accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
+        depth = self.render_backend.accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
+        comp_rgb = self.render_backend.accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
         comp_rgb = comp_rgb + self.background_color * (1.0 - opacity)       
 
         out = {
@@ -113,7 +130,8 @@ class NeRFModel(BaseModel):
             'opacity': opacity,
             'depth': depth,
             'rays_valid': opacity > 0,
-            'num_samples': torch.as_tensor([len(t_starts)], dtype=torch.int32, device=rays.device)
+            'num_samples': torch.as_tensor([len(t_starts)], dtype=torch.int32, device=rays.device),
+            'num_samples_marched': torch.as_tensor([max(n_samples_marched, len(t_starts))], dtype=torch.int32, device=rays.device)
         }
 
         if self.training:
@@ -3,7 +3,11 @@ import numpy as np
 
 import torch
 import torch.nn as nn
-import tinycudann as tcnn
+import torch.nn.functional as F
+try:
+    import tinycudann as tcnn
+except ImportError:
+    tcnn = None # CPU-only environments, use the pure-torch encodings and networks
 
 from pytorch_lightning.utilities.rank_zero import rank_zero_debug, rank_zero_info
 
@@ -29,6 +33,18 @@ class VanillaFrequency(nn.Module):
                 out += [func(freq*x) * mask]                
         return torch.cat(out, -1)          
 
+    def forward_with_derivatives(self, x):
+        # output k only depends on input channel k % in_channels, returns the encoding and d(output k)/d(input channel of k)
+        freq, mask = self.freq_bands.to(x)[:,None], self.mask.to(x)[:,None]
+        fx = x[...,None,:] * freq # (..., N_freqs, in_channels)
+        sin, cos = torch.sin(fx) * mask, torch.cos(fx) * mask
+        out = torch.stack([sin, cos], dim=-2).view(*x.shape[:-1], self.n_output_dims)
+        dout = (torch.stack([cos, -sin], dim=-2) * freq[...,None]).view(*x.shape[:-1], self.n_output_dims)
+        return out, dout
+
+    def jacobian_channels(self):
+        return torch.arange(self.n_output_dims) % self.in_channels
+
     def update_step(self, epoch, global_step):
         if self.n_masking_step <= 0 or global_step is None:
             self.mask = torch.ones(self.N_freqs, dtype=torch.float32)
@@ -37,22 +53,119 @@ class VanillaFrequency(nn.Module):
             rank_zero_debug(f'Update mask: {global_step}/{self.n_masking_step} {self.mask}')
 
 
+class HashGridTorch(nn.Module):
+    """
+    Pure-PyTorch multiresolution hash encoding, a drop-in for tcnn's HashGrid on CPU-only machines.
+    Follows the tcnn conventions (level scales, dense/hashed level layout, spatial hash primes, output layout)
+    so the same config can be used for both backends.
+    Levels are split into the leading dense ones and the trailing hashed ones so each only computes its own index,
+    then all levels and all 2^D corners are looked up with a single batched gather.
+    """
+    PRIMES = [1, 2654435761, 805459861, 3674653429, 2097192037, 1434869437, 2165219737]
+
+    def __init__(self, in_channels, config):
+        super().__init__()
+        self.n_input_dims = in_channels
+        self.n_levels, self.n_features_per_level = config['n_levels'], config['n_features_per_level']
+        self.log2_hashmap_size = config['log2_hashmap_size']
+        self.base_resolution, self.per_level_scale = config['base_resolution'], config['per_level_scale']
+        self.n_output_dims = self.n_levels * self.n_features_per_level
+
+        scales, strides, hashed, sizes, offsets = [], [], [], [], []
+        n_params = 0
+        for level in range(self.n_levels):
+            scale = self.base_resolution * self.per_level_scale**level - 1.
+            resolution = int(math.ceil(scale)) + 1
+            size = min(resolution**in_channels, 2**31 - 1)
+            size = min((size + 7) // 8 * 8, 2**self.log2_hashmap_size)
+            scales.append(scale)
+            strides.append([resolution**d for d in range(in_channels)])
+            hashed.append(resolution**in_channels > size)
+            sizes.append(size)
+            offsets.append(n_params)
+            n_params += size
+
+        self.register_buffer('scales', torch.as_tensor(scales, dtype=torch.float32), persistent=False)
+        # int32 index arithmetic: the hash wraps around like tcnn's uint32 hash, and the low bits used by the
+        # power-of-two hashmap sizes are the same, while memory traffic is halved compared to int64
+        primes = [p - 2**32 if p >= 2**31 else p for p in self.PRIMES[:in_channels]]
+        self.register_buffer('strides', torch.as_tensor(strides, dtype=torch.int32), persistent=False)
+        self.register_buffer('hashed', torch.as_tensor(hashed, dtype=torch.bool), persistent=False)
+        self.register_buffer('sizes', torch.as_tensor(sizes, dtype=torch.int32), persistent=False)
+        self.register_buffer('offsets', torch.as_tensor(offsets, dtype=torch.int32), persistent=False)
+        self.register_buffer('primes', torch.as_tensor(primes, dtype=torch.int32), persistent=False)
+        # dense index offsets of the 2^D cell corners per level, corner bits ordered from the first dimension
+        corners = torch.stack(torch.meshgrid(*[torch.arange(2)] * in_channels, indexing='ij'), dim=-1).view(-1, in_channels)
+        self.register_buffer('dense_corners', (corners[None] * self.strides[:,None,:]).sum(-1).int(), persistent=False)
+        # sizes only grow with the level, so hashed levels always follow the dense ones
+        self.n_dense_levels = int((~self.hashed).sum())
+
+        self.params = nn.Parameter(torch.empty(n_params, self.n_features_per_level, dtype=torch.float32))
+        nn.init.uniform_(self.params, -1e-4, 1e-4) # same initialization as tcnn
+
+    def encode_levels(self, x, n_levels):
+        # x: (N, D) in [0, 1], encodes the first n_levels levels
+        if n_levels == 0:
+            return x.new_zeros((x.shape[0], 0, self.n_features_per_level))
+        n_dense = min(self.n_dense_levels, n_levels)
+        pos = x[:,None,:] * self.scales[:n_levels, None] + 0.5 # (N, n_levels, D)
+        pos_grid = pos.floor()
+        frac = pos - pos_grid
+        pos_grid = pos_grid.int()
+        # trilinear weights of the 2^D corners built one dimension at a time, (N, n_levels, 2^D)
+        weights = None
+        for d in range(self.n_input_dims):
+            w = torch.stack([1. - frac[...,d], frac[...,d]], dim=-1)
+            weights = w if weights is None else (weights[...,:,None] * w[...,None,:]).flatten(-2)
+        index = []
+        if n_dense > 0:
+            base = (pos_grid[:,:n_dense] * self.strides[:n_dense]).sum(-1, dtype=torch.int32)
+            index.append((base[...,None] + self.dense_corners[:n_dense]) % self.sizes[:n_dense, None] + self.offsets[:n_dense, None])
+        if n_levels > n_dense:
+            # the hash of each corner xors the per-dimension terms, only grid and grid + 1 are needed per dimension
+            hash_index = None
+            for d in range(self.n_input_dims):
+                h = pos_grid[:,n_dense:,d] * self.primes[d]
+                h = torch.stack([h, h + self.primes[d]], dim=-1)
+                hash_index = h if hash_index is None else (hash_index[...,:,None] ^ h[...,None,:]).flatten(-2)
+            # hashed levels have power-of-two sizes
+            index.append((hash_index & (2**self.log2_hashmap_size - 1)) + self.offsets[n_dense:n_levels, None])
+        index = torch.cat(index, dim=1) if len(index) > 1 else index[0]
+        feats = self.params.index_select(0, index.view(-1)).view(*index.shape, -1) # (N, n_levels, 2^D, F), one gather for all levels
+        return (feats * weights[...,None]).sum(-2) # (N, n_levels, F)
+
+    def forward(self, x):
+        enc = self.encode_levels(x.float(), self.n_levels)
+        return enc.reshape(x.shape[0], self.n_output_dims)
+
+
 class ProgressiveBandHashGrid(nn.Module):
     def __init__(self, in_channels, config):
         super().__init__()
         self.n_input_dims = in_channels
         encoding_config = config.copy()
-        encoding_config['otype'] = 'HashGrid'
-        with torch.cuda.device(get_rank()):
-            self.encoding = tcnn.Encoding(in_channels, encoding_config)
+        self.backend = config.get('backend', 'tcnn')
+        assert self.backend in ['tcnn', 'torch']
+        if self.backend == 'torch':
+            encoding_config['otype'] = 'HashGridTorch'
+            self.encoding = HashGridTorch(in_channels, encoding_config)
+        else:
+            encoding_config['otype'] = 'HashGrid'
+            with torch.cuda.device(get_rank()):
+                self.encoding = tcnn.Encoding(in_channels, encoding_config)
         self.n_output_dims = self.encoding.n_output_dims
         self.n_level = config['n_levels']
         self.n_features_per_level = config['n_features_per_level']
         self.start_level, self.start_step, self.update_steps = config['start_level'], config['start_step'], config['update_steps']
         self.current_level = self.start_level
-        self.mask = torch.zeros(self.n_level * self.n_features_per_level, dtype=torch.float32, device=get_rank())
+        self.register_buffer('mask', torch.zeros(self.n_level * self.n_features_per_level, dtype=torch.float32), persistent=False)
+        self.n_active_levels = 0 # number of leading levels enabled in mask
 
     def forward(self, x):
+        if self.backend == 'torch':
+            # only evaluate the active levels, the masked ones are zero
+            enc = self.encoding.encode_levels(x.float(), self.n_active_levels).reshape(x.shape[0], self.n_active_levels * self.n_features_per_level)
+            return F.pad(enc, (0, self.n_output_dims - enc.shape[-1]))
         enc = self.encoding(x)
         enc = enc * self.mask
         return enc
@@ -63,6 +176,7 @@ class ProgressiveBandHashGrid(nn.Module):
             rank_zero_info(f'Update grid level to {current_level}')
         self.current_level = current_level
         self.mask[:self.current_level * self.n_features_per_level] = 1.
+        self.n_active_levels = max(self.n_active_levels, self.current_level)
 
 
 class CompositeEncoding(nn.Module):
@@ -75,6 +189,16 @@ class CompositeEncoding(nn.Module):
     def forward(self, x, *args):
         return self.encoding(x, *args) if not self.include_xyz else torch.cat([x * self.xyz_scale + self.xyz_offset, self.encoding(x, *args)], dim=-1)
 
+    def forward_with_derivatives(self, x):
+        out, dout = self.encoding.forward_with_derivatives(x)
+        if self.include_xyz:
+            out, dout = torch.cat([x * self.xyz_scale + self.xyz_offset, out], dim=-1), torch.cat([torch.full_like(x, self.xyz_scale), dout], dim=-1)
+        return out, dout
+
+    def jacobian_channels(self):
+        channels = self.encoding.jacobian_channels()
+        return torch.cat([torch.arange(self.encoding.n_input_dims), channels]) if self.include_xyz else channels
+
     def update_step(self, epoch, global_step):
         update_module_step(self.encoding, epoch, global_step)
 
@@ -83,6 +207,8 @@ def get_encoding(n_input_dims, config):
     # input suppose to be range [0, 1]
     if config.otype == 'VanillaFrequency':
         encoding = VanillaFrequency(n_input_dims, config_to_primitive(config))
+    elif config.otype == 'HashGridTorch':
+        encoding = HashGridTorch(n_input_dims, config_to_primitive(config))
     elif config.otype == 'ProgressiveBandHashGrid':
         encoding = ProgressiveBandHashGrid(n_input_dims, config_to_primitive(config))
     else:
@@ -104,13 +230,40 @@ class VanillaMLP(nn.Module):
         self.layers += [self.make_linear(self.n_neurons, dim_out, is_first=False, is_last=True)]
         self.layers = nn.Sequential(*self.layers)
         self.output_activation = get_activation(config['output_activation'])
+        self.linear_output = config['output_activation'] in [None, 'none']
     
     @torch.cuda.amp.autocast(False)
     def forward(self, x):
         x = self.layers(x.float())
         x = self.output_activation(x)
         return x
-    
+
+    @torch.cuda.amp.autocast(False)
+    def forward_with_input_grad(self, x, output_index=0):
+        """
+        Returns the output and the gradient of output[...,output_index] wrt the input, computed by an explicit backward sweep
+        over the activation derivatives kept from the forward pass instead of an autograd graph.
+        """
+        assert self.linear_output, "Input gradient is only supported without output activation"
+        x = x.float()
+        weights, derivatives = [], []
+        for layer in self.layers:
+            if isinstance(layer, nn.Linear):
+                x = layer(x)
+                weights.append(layer.weight) # the weight-normalized weight is recomputed by the call above
+            elif isinstance(layer, nn.Softplus):
+                derivatives.append(torch.sigmoid(layer.beta * x)) # rounds to 1 in the linear regime above the threshold
+                x = layer(x)
+            elif isinstance(layer, nn.ReLU):
+                x = layer(x)
+                derivatives.append((x > 0).to(x))
+            else:
+                raise NotImplementedError
+        grad = weights[-1][output_index]
+        for weight, derivative in zip(reversed(weights[:-1]), reversed(derivatives)):
+            grad = (grad * derivative) @ weight
+        return x, grad
+
     def make_linear(self, dim_in, dim_out, is_first, is_last):
         layer = nn.Linear(dim_in, dim_out, bias=True) # network without bias will degrade quality
         if self.sphere_init:
@@ -139,6 +292,11 @@ class VanillaMLP(nn.Module):
             return nn.ReLU(inplace=True)
 
 
+def supports_closed_form_grad(encoding, network):
+    return isinstance(encoding, CompositeEncoding) and isinstance(encoding.encoding, VanillaFrequency) \
+        and isinstance(network, VanillaMLP) and network.linear_output
+
+
 def sphere_init_tcnn_network(n_input_dims, n_output_dims, config, network):
     rank_zero_debug('Initialize tcnn MLP to approximately represent a sphere.')
     """
@@ -199,7 +357,7 @@ class EncodingWithNetwork(nn.Module):
 
 def get_encoding_with_network(n_input_dims, n_output_dims, encoding_config, network_config):
     # input suppose to be range [0, 1]
-    if encoding_config.otype in ['VanillaFrequency', 'ProgressiveBandHashGrid'] \
+    if encoding_config.otype in ['VanillaFrequency', 'HashGridTorch', 'ProgressiveBandHashGrid'] \
         or network_config.otype in ['VanillaMLP']:
         encoding = get_encoding(n_input_dims, encoding_config)
         network = get_mlp(encoding.n_output_dims, n_output_dims, network_config)
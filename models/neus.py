@@ -6,10 +6,10 @@ import torch.nn.functional as F
 
 import models
 from models.base import BaseModel
-from models.utils import chunk_batch
+from models.utils import chunk_batch, chunk_batch_stream
+from models.rendering import get_render_backend, OccupancyGridState, render_front_to_back, sample_pdf
 from systems.utils import update_module_step
-from nerfacc import ContractionType, OccupancyGrid, ray_marching, render_weight_from_density, render_weight_from_alpha, accumulate_along_rays
-from nerfacc.intersection import ray_aabb_intersect
+from nerfacc import ContractionType
 
 
 class VarianceNetwork(nn.Module):
@@ -46,6 +46,7 @@ class VarianceNetwork(nn.Module):
 @models.register('neus')
 class NeuSModel(BaseModel):
     def setup(self):
+        self.render_backend = get_render_backend(self.config.get('render_backend', 'nerfacc'))
         self.geometry = models.make(self.config.geometry.name, self.config.geometry)
         self.texture = models.make(self.config.texture.name, self.config.texture)
         self.geometry.contraction_type = ContractionType.AABB
@@ -61,17 +62,19 @@ class NeuSModel(BaseModel):
         self.variance = VarianceNetwork(self.config.variance)
         self.register_buffer('scene_aabb', torch.as_tensor([-self.config.radius, -self.config.radius, -self.config.radius, self.config.radius, self.config.radius, self.config.radius], dtype=torch.float32))
         if self.config.grid_prune:
-            self.occupancy_grid = OccupancyGrid(
+            self.occupancy_grid = self.render_backend.OccupancyGrid(
                 roi_aabb=self.scene_aabb,
                 resolution=128,
                 contraction_type=ContractionType.AABB
             )
+            self.occupancy_grid_state = OccupancyGridState(self.occupancy_grid, [self.geometry, self.variance])
             if self.config.learned_background:
-                self.occupancy_grid_bg = OccupancyGrid(
+                self.occupancy_grid_bg = self.render_backend.OccupancyGrid(
                     roi_aabb=self.scene_aabb,
                     resolution=256,
                     contraction_type=ContractionType.UN_BOUNDED_SPHERE
                 )
+                self.occupancy_grid_bg_state = OccupancyGridState(self.occupancy_grid_bg, [self.geometry_bg])
         self.randomized = self.config.randomized
         self.background_color = None
         self.render_step_size = 1.732 * 2 * self.config.radius / self.config.num_samples_per_ray
@@ -105,10 +108,17 @@ class NeuSModel(BaseModel):
             # approximate for 1 - torch.exp(-density[...,None] * self.render_step_size_bg) based on taylor series
             return density[...,None] * self.render_step_size_bg
         
-        if self.training and self.config.grid_prune:
-            self.occupancy_grid.every_n_step(step=global_step, occ_eval_fn=occ_eval_fn, occ_thre=self.config.get('grid_prune_occ_thre', 0.01))
+        if self.config.grid_prune:
+            # the hierarchical sampler does not read the foreground grid
+            grids = [] if self.config.get('sampler', 'occupancy_grid') == 'hierarchical' else [(self.occupancy_grid_state, occ_eval_fn, self.config.get('grid_prune_occ_thre', 0.01))]
             if self.config.learned_background:
-                self.occupancy_grid_bg.every_n_step(step=global_step, occ_eval_fn=occ_eval_fn_bg, occ_thre=self.config.get('grid_prune_occ_thre_bg', 0.01))
+                grids.append((self.occupancy_grid_bg_state, occ_eval_fn_bg, self.config.get('grid_prune_occ_thre_bg', 0.01)))
+            for grid_state, eval_fn, occ_thre in grids:
+                if self.training:
+                    grid_state.update(global_step, eval_fn, occ_thre=occ_thre)
+                elif grid_state.is_stale():
+                    # restored without its grid or with a grid of other weights, build it once before rendering
+                    grid_state.rebuild(eval_fn, occ_thre=occ_thre)
 
     def isosurface(self):
         mesh = self.geometry.isosurface()
@@ -150,13 +160,13 @@ class NeuSModel(BaseModel):
             density, _ = self.geometry_bg(positions)
             return density[...,None]            
 
-        _, t_max = ray_aabb_intersect(rays_o, rays_d, self.scene_aabb)
+        _, t_max = self.render_backend.ray_aabb_intersect(rays_o, rays_d, self.scene_aabb)
         # if the ray intersects with the bounding box, start from the farther intersection point
         # otherwise start from self.far_plane_bg
         # note that in nerfacc t_max is set to 1e10 if there is no intersection
         near_plane = torch.where(t_max > 1e9, self.near_plane_bg, t_max)
         with torch.no_grad():
-            ray_indices, t_starts, t_ends = ray_marching(
+            ray_indices, t_starts, t_ends = self.render_backend.ray_marching(
                 rays_o, rays_d,
                 scene_aabb=None,
                 grid=self.occupancy_grid_bg if self.config.grid_prune else None,
@@ -178,10 +188,10 @@ class NeuSModel(BaseModel):
         density, feature = self.geometry_bg(positions) 
         rgb = self.texture_bg(feature, t_dirs)
 
-        weights = render_weight_from_density(t_starts, t_ends, density[...,None], ray_indices=ray_indices, n_rays=n_rays)
-        opacity = accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
-        depth = accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
-        comp_rgb = accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
+        weights = self.render_backend.render_weight_from_density(t_starts, t_ends, density[...,None], ray_indices=ray_indices, n_rays=n_rays)
+        opacity = self.render_backend.accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
+        depth = self.render_backend.accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
+        comp_rgb = self.render_backend.accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
         comp_rgb = comp_rgb + self.background_color * (1.0 - opacity)       
 
         out = {
@@ -202,44 +212,147 @@ class NeuSModel(BaseModel):
 
         return out
 
+    def forward_bg_subset_(self, rays, ray_indices):
+        # learned background of the rays ray_indices only, scattered back to all the rays, the others get the background color
+        n_rays = rays.shape[0]
+        out_bg = {
+            'comp_rgb': self.background_color[None,:].expand(n_rays, 3),
+            'opacity': torch.zeros((n_rays, 1), device=rays.device),
+            'depth': torch.zeros((n_rays, 1), device=rays.device),
+            'rays_valid': torch.zeros((n_rays, 1), dtype=torch.bool, device=rays.device),
+            'num_samples': torch.zeros([1], dtype=torch.int32, device=rays.device)
+        }
+        if self.training:
+            empty = torch.zeros((0,), device=rays.device)
+            out_bg.update({'weights': empty, 'points': empty, 'intervals': empty, 'ray_indices': empty.long()})
+        if len(ray_indices) == 0:
+            return out_bg
+        out_subset = self.forward_bg_(rays[ray_indices])
+        for k in ['comp_rgb', 'opacity', 'depth', 'rays_valid']:
+            out_bg[k] = out_bg[k].to(out_subset[k].dtype).index_copy(0, ray_indices, out_subset[k])
+        out_bg['num_samples'] = out_subset['num_samples']
+        if self.training:
+            out_bg.update({k: out_subset[k] for k in ['weights', 'points', 'intervals']})
+            out_bg['ray_indices'] = ray_indices[out_subset['ray_indices']]
+        return out_bg
+
+    def up_sample_(self, z_vals, sdf, n_importance, inv_s):
+        # NeuS upsampling: alphas of the sections between samples from the SDF with a fixed inv_s, resampled by inverse CDF
+        prev_sdf, next_sdf = sdf[:,:-1], sdf[:,1:]
+        dist = z_vals[:,1:] - z_vals[:,:-1]
+        mid_sdf = (prev_sdf + next_sdf) * 0.5
+        cos_val = (next_sdf - prev_sdf) / (dist + 1e-5)
+        prev_cos_val = torch.cat([torch.zeros_like(cos_val[:,:1]), cos_val[:,:-1]], dim=-1)
+        cos_val = torch.minimum(prev_cos_val, cos_val).clip(-1e3, 0.0)
+        prev_cdf = torch.sigmoid((mid_sdf - cos_val * dist * 0.5) * inv_s)
+        next_cdf = torch.sigmoid((mid_sdf + cos_val * dist * 0.5) * inv_s)
+        alpha = (prev_cdf - next_cdf + 1e-5) / (prev_cdf + 1e-5)
+        weights = alpha * torch.cumprod(torch.cat([torch.ones_like(alpha[:,:1]), 1. - alpha + 1e-7], dim=-1), dim=-1)[:,:-1]
+        return sample_pdf(z_vals, weights, n_importance, det=True)
+
+    @torch.no_grad()
+    def ray_marching_hierarchical_(self, rays_o, rays_d):
+        """
+        Hierarchical sampling of the original NeuS, an alternative to the occupancy grid (model.sampler: hierarchical):
+        n_coarse uniform samples between the scene box entry and exit, then up_sample_steps rounds that each add
+        n_importance / up_sample_steps samples (the last one the remainder) around SDF sign changes and high alphas (inv_s doubling every round from 64).
+        Every ray hitting the scene box gets exactly n_coarse + n_importance samples.
+        Returns ray_indices, t_starts and t_ends as ray_marching.
+        """
+        config = self.config.get('hierarchical', {})
+        n_coarse, n_importance, up_sample_steps = config.get('n_coarse', 64), config.get('n_importance', 64), config.get('up_sample_steps', 4)
+        t_min, t_max = self.render_backend.ray_aabb_intersect(rays_o, rays_d, self.scene_aabb)
+        t_min = t_min.clamp_min(0.)
+        hit_indices = torch.nonzero(t_min < t_max)[:,0]
+        rays_o, rays_d, near, far = rays_o[hit_indices], rays_d[hit_indices], t_min[hit_indices,None], t_max[hit_indices,None]
+        sample_dist = (far - near) / n_coarse
+
+        z_vals = near + (far - near) * torch.linspace(0., 1., n_coarse, device=rays_o.device)
+        if self.training and self.randomized:
+            z_vals = z_vals + (torch.rand_like(near) - 0.5) * sample_dist
+        def eval_sdf(z):
+            return self.geometry.forward_level(rays_o[:,None,:] + rays_d[:,None,:] * z[...,None]).float().view(*z.shape)
+        sdf = eval_sdf(z_vals)
+        for i in range(up_sample_steps):
+            # the last round also draws the remainder of n_importance / up_sample_steps
+            n_round = n_importance // up_sample_steps + (n_importance % up_sample_steps if i == up_sample_steps - 1 else 0)
+            new_z_vals = self.up_sample_(z_vals, sdf, n_round, 64 * 2**i)
+            z_vals, index = torch.sort(torch.cat([z_vals, new_z_vals], dim=-1), dim=-1)
+            if i < up_sample_steps - 1:
+                sdf = torch.cat([sdf, eval_sdf(new_z_vals)], dim=-1).gather(1, index)
+
+        dists = torch.cat([z_vals[:,1:] - z_vals[:,:-1], sample_dist], dim=-1)
+        ray_indices = hit_indices[:,None].expand(*z_vals.shape).reshape(-1)
+        return ray_indices, z_vals.reshape(-1, 1), (z_vals + dists).reshape(-1, 1)
+
     def forward_(self, rays):
         n_rays = rays.shape[0]
         rays_o, rays_d = rays[:, 0:3], rays[:, 3:6] # both (N_rays, 3)
 
-        with torch.no_grad():
-            ray_indices, t_starts, t_ends = ray_marching(
-                rays_o, rays_d,
-                scene_aabb=self.scene_aabb,
-                grid=self.occupancy_grid if self.config.grid_prune else None,
-                alpha_fn=None,
-                near_plane=None, far_plane=None,
-                render_step_size=self.render_step_size,
-                stratified=self.randomized,
-                cone_angle=0.0,
-                alpha_thre=0.0
-            )
+        # model.sampler selects the occupancy grid (default) or the hierarchical sampling of NeuS
+        if self.config.get('sampler', 'occupancy_grid') == 'hierarchical':
+            ray_indices, t_starts, t_ends = self.ray_marching_hierarchical_(rays_o, rays_d)
+        else:
+            with torch.no_grad():
+                ray_indices, t_starts, t_ends = self.render_backend.ray_marching(
+                    rays_o, rays_d,
+                    scene_aabb=self.scene_aabb,
+                    grid=self.occupancy_grid if self.config.grid_prune else None,
+                    alpha_fn=None,
+                    near_plane=None, far_plane=None,
+                    render_step_size=self.render_step_size,
+                    stratified=self.randomized,
+                    cone_angle=0.0,
+                    alpha_thre=0.0
+                )
         
         ray_indices = ray_indices.long()
-        t_origins = rays_o[ray_indices]
-        t_dirs = rays_d[ray_indices]
+        n_samples_marched = len(ray_indices)
         midpoints = (t_starts + t_ends) / 2.
-        positions = t_origins + t_dirs * midpoints
         dists = t_ends - t_starts
 
-        if self.config.geometry.grad_type == 'finite_difference':
-            sdf, sdf_grad, feature, sdf_laplace = self.geometry(positions, with_grad=True, with_feature=True, with_laplace=True)
+        def eval_samples(sample_indices):
+            t_dirs = rays_d[ray_indices[sample_indices]]
+            positions = rays_o[ray_indices[sample_indices]] + t_dirs * midpoints[sample_indices]
+            samples = {}
+            if self.config.geometry.grad_type == 'finite_difference':
+                sdf, sdf_grad, feature, samples['sdf_laplace'] = self.geometry(positions, with_grad=True, with_feature=True, with_laplace=True)
+            else:
+                sdf, sdf_grad, feature = self.geometry(positions, with_grad=True, with_feature=True)
+            normal = F.normalize(sdf_grad, p=2, dim=-1)
+            alpha = self.get_alpha(sdf, normal, t_dirs, dists[sample_indices])[...,None]
+            samples.update({'sdf': sdf, 'sdf_grad': sdf_grad, 'normal': normal, 'feature': feature})
+            return alpha, samples
+
+        # early ray termination (model.early_stop_eps) in evaluation, and in training if model.early_stop_train is set
+        early_stop_eps = self.config.get('early_stop_eps', 0.) if not self.training or self.config.get('early_stop_train', False) else 0.
+        if early_stop_eps > 0:
+            sample_indices, weights, samples = render_front_to_back(
+                eval_samples, ray_indices, n_rays, self.render_backend.render_weight_from_alpha,
+                early_stop_eps=early_stop_eps, segment_size=self.config.get('early_stop_segment_size', 64)
+            )
+            ray_indices, t_starts, midpoints, dists = ray_indices[sample_indices], t_starts[sample_indices], midpoints[sample_indices], dists[sample_indices]
         else:
-            sdf, sdf_grad, feature = self.geometry(positions, with_grad=True, with_feature=True)
-        normal = F.normalize(sdf_grad, p=2, dim=-1)
-        alpha = self.get_alpha(sdf, normal, t_dirs, dists)[...,None]
-        rgb = self.texture(feature, t_dirs, normal)
+            alpha, samples = eval_samples(slice(None))
+            weights = self.render_backend.render_weight_from_alpha(alpha, ray_indices=ray_indices, n_rays=n_rays)
+        sdf, sdf_grad, normal, feature = samples['sdf'], samples['sdf_grad'], samples['normal'], samples['feature']
 
-        weights = render_weight_from_alpha(alpha, ray_indices=ray_indices, n_rays=n_rays)
-        opacity = accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
-        depth = accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
-        comp_rgb = accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
+        # the radiance is only evaluated on the samples weighing more than model.color_weight_thre (evaluation, and training if
+        # model.color_weight_train is set), the others are composited black
+        color_weight_thre = self.config.get('color_weight_thre', 0.) if not self.training or self.config.get('color_weight_train', False) else 0.
+        t_dirs = rays_d[ray_indices]
+        if color_weight_thre > 0:
+            shaded = torch.nonzero(weights.detach()[:,0] > color_weight_thre)[:,0]
+            rgb_shaded = self.texture(feature[shaded], t_dirs[shaded], normal[shaded])
+            rgb = torch.zeros((len(ray_indices), rgb_shaded.shape[-1]), dtype=rgb_shaded.dtype, device=rgb_shaded.device).index_copy(0, shaded, rgb_shaded)
+        else:
+            rgb = self.texture(feature, t_dirs, normal)
 
-        comp_normal = accumulate_along_rays(weights, ray_indices, values=normal, n_rays=n_rays)
+        opacity = self.render_backend.accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
+        depth = self.render_backend.accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
+        comp_rgb = self.render_backend.accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
+
+        comp_normal = self.render_backend.accumulate_along_rays(weights, ray_indices, values=normal, n_rays=n_rays)
         comp_normal = F.normalize(comp_normal, p=2, dim=-1)
 
         out = {
@@ -248,7 +361,9 @@ class NeuSModel(BaseModel):
             'opacity': opacity,
             'depth': depth,
             'rays_valid': opacity > 0,
-            'num_samples': torch.as_tensor([len(t_starts)], dtype=torch.int32, device=rays.device)
+            'num_samples': torch.as_tensor([len(t_starts)], dtype=torch.int32, device=rays.device),
+            'num_samples_marched': torch.as_tensor([n_samples_marched], dtype=torch.int32, device=rays.device),
+            'num_samples_shaded': torch.as_tensor([len(shaded) if color_weight_thre > 0 else len(t_starts)], dtype=torch.int32, device=rays.device)
         }
 
         if self.training:
@@ -262,10 +377,14 @@ class NeuSModel(BaseModel):
             })
             if self.config.geometry.grad_type == 'finite_difference':
                 out.update({
-                    'sdf_laplace_samples': sdf_laplace
+                    'sdf_laplace_samples': samples['sdf_laplace']
                 })
 
-        if self.config.learned_background:
+        # the rays whose foreground opacity is above model.bg_skip_opacity do not query the learned background
+        bg_skip_opacity = self.config.get('bg_skip_opacity', 1.)
+        if self.config.learned_background and bg_skip_opacity < 1.:
+            out_bg = self.forward_bg_subset_(rays, torch.nonzero(opacity.detach()[:,0] <= bg_skip_opacity)[:,0])
+        elif self.config.learned_background:
             out_bg = self.forward_bg_(rays)
         else:
             out_bg = {
@@ -286,16 +405,103 @@ class NeuSModel(BaseModel):
             **{k + '_full': v for k, v in out_full.items()}
         }
 
+    def forward_sphere_tracing_(self, rays):
+        """
+        Sphere tracing of the zero level set for quick previews: each ray steps by the SDF (scaled by step_scale, as a learned SDF
+        is not exact), rays that converge or leave the scene box are dropped from the active set, and the hit points are shaded once.
+        Only the rays that miss the surface query the learned background.
+        """
+        n_rays = rays.shape[0]
+        rays_o, rays_d = rays[:, 0:3], rays[:, 3:6] # both (N_rays, 3)
+        config = self.config.get('sphere_tracing', {})
+        max_steps, epsilon, step_scale = config.get('max_steps', 128), config.get('epsilon', 1e-3), config.get('step_scale', 0.9)
+
+        with torch.no_grad():
+            t_min, t_max = self.render_backend.ray_aabb_intersect(rays_o, rays_d, self.scene_aabb)
+            t_start = t_min.clamp_min(0.)
+            t = t_start.clone()
+            hit = torch.zeros(n_rays, dtype=torch.bool, device=rays.device)
+            active = torch.nonzero(t < t_max)[:,0]
+            n_queries = 0
+            for step in range(max_steps):
+                if len(active) == 0:
+                    break
+                sdf = self.geometry.forward_level(rays_o[active] + rays_d[active] * t[active,None]).float()
+                n_queries += len(active)
+                converged = sdf.abs() < epsilon
+                if step == 0:
+                    # rays starting inside the surface hit it at their start instead of marching backwards
+                    converged |= sdf < 0
+                hit[active[converged]] = True
+                # negative steps after an overshoot move back towards the surface, but never before the start
+                t[active] = torch.where(converged, t[active], torch.maximum(t[active] + sdf * step_scale, t_start[active]))
+                active = active[~converged & (t[active] < t_max[active])]
+
+        hit_indices = torch.nonzero(hit)[:,0]
+        _, sdf_grad, feature = self.geometry(rays_o[hit_indices] + rays_d[hit_indices] * t[hit_indices,None], with_grad=True, with_feature=True)
+        normal = F.normalize(sdf_grad, p=2, dim=-1)
+        rgb = self.texture(feature, rays_d[hit_indices], normal)
+
+        opacity = hit.float()[:,None]
+        out = {
+            'comp_rgb': torch.zeros(n_rays, 3, dtype=rgb.dtype, device=rays.device).index_copy(0, hit_indices, rgb),
+            'comp_normal': torch.zeros(n_rays, 3, dtype=normal.dtype, device=rays.device).index_copy(0, hit_indices, normal),
+            'opacity': opacity,
+            'depth': t[:,None] * opacity,
+            'rays_valid': opacity > 0,
+            'num_samples': torch.as_tensor([n_queries + len(hit_indices)], dtype=torch.int32, device=rays.device)
+        }
+
+        if self.config.learned_background:
+            out_bg = self.forward_bg_subset_(rays, torch.nonzero(~hit)[:,0])
+        else:
+            out_bg = {
+                'comp_rgb': self.background_color[None,:].expand(*out['comp_rgb'].shape),
+                'num_samples': torch.zeros_like(out['num_samples']),
+                'rays_valid': torch.zeros_like(out['rays_valid'])
+            }
+
+        out_full = {
+            'comp_rgb': out['comp_rgb'] + out_bg['comp_rgb'] * (1.0 - out['opacity']),
+            'num_samples': out['num_samples'] + out_bg['num_samples'],
+            'rays_valid': out['rays_valid'] | out_bg['rays_valid']
+        }
+
+        return {
+            **out,
+            **{k + '_bg': v for k, v in out_bg.items()},
+            **{k + '_full': v for k, v in out_full.items()}
+        }
+
+    def forward_eval_(self, rays):
+        # model.render_mode selects volume rendering (default) or sphere tracing (previews) outside training
+        if self.config.get('render_mode', 'volume') == 'sphere_tracing':
+            return self.forward_sphere_tracing_(rays)
+        return self.forward_(rays)
+
     def forward(self, rays):
         if self.training:
             out = self.forward_(rays)
         else:
-            out = chunk_batch(self.forward_, self.config.ray_chunk, True, rays)
+            out = chunk_batch(self.forward_eval_, self.config.ray_chunk, True, rays)
         return {
             **out,
             'inv_s': self.variance.inv_s
         }
 
+    @torch.no_grad()
+    def forward_stream(self, rays, keys=None):
+        # evaluation in chunks of ray_chunk rays, yields (start, end, out) with out on CPU as soon as each chunk is ready
+        # only the outputs in keys (all if None) are copied to CPU
+        def forward_keys(rays):
+            out = self.forward_eval_(rays)
+            return out if keys is None else {k: v for k, v in out.items() if k in keys}
+        for start, end, out in chunk_batch_stream(forward_keys, self.config.ray_chunk, True, rays):
+            yield start, end, {
+                **out,
+                'inv_s': self.variance.inv_s
+            }
+
     def train(self, mode=True):
         self.randomized = mode and self.config.randomized
         return super().train(mode=mode)
@@ -41,3 +41,20 @@ def get_rays(directions, c2w, keepdim=False):
         rays_o, rays_d = rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)
 
     return rays_o, rays_d
+
+
+def oct_encode(dirs):
+    # unit vectors (..., 3) => octahedral coordinates (..., 2) in [-1, 1]
+    dirs = dirs / dirs.abs().sum(-1, keepdim=True).clamp_min(1e-10)
+    xy, z = dirs[...,:2], dirs[...,2:]
+    sign = torch.where(xy >= 0, 1., -1.).to(xy)
+    return torch.where(z < 0, (1. - xy.flip(-1).abs()) * sign, xy)
+
+
+def oct_decode(enc):
+    # octahedral coordinates (..., 2) => unit vectors (..., 3)
+    z = 1. - enc.abs().sum(-1, keepdim=True)
+    sign = torch.where(enc >= 0, 1., -1.).to(enc)
+    xy = torch.where(z < 0, (1. - enc.flip(-1).abs()) * sign, enc)
+    dirs = torch.cat([xy, z], dim=-1)
+    return dirs / dirs.norm(p=2, dim=-1, keepdim=True).clamp_min(1e-10)
@@ -0,0 +1,411 @@
+"""
+Volume rendering backends.
+
+'nerfacc' uses the (CUDA) kernels of nerfacc, 'torch' is a pure-PyTorch fallback with the same interface
+that runs on any device, e.g. on CPU-only render farms.
+Both expose OccupancyGrid, ray_aabb_intersect, ray_marching, render_visibility,
+render_weight_from_alpha, render_weight_from_density and accumulate_along_rays.
+"""
+
+import math
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+from nerfacc import ContractionType
+
+from models.utils import chunk_batch
+
+
+def contract_aabb(x, roi_aabb, contraction_type):
+    # world space => [0, 1]^3 grid space
+    x = (x - roi_aabb[:3]) / (roi_aabb[3:] - roi_aabb[:3])
+    if contraction_type == ContractionType.UN_BOUNDED_SPHERE:
+        x = x * 2 - 1 # aabb is at [-1, 1]
+        mag = x.norm(dim=-1, keepdim=True).clamp_min(1e-10)
+        x = torch.where(mag > 1, (2 - 1 / mag) * (x / mag), x)
+        x = x / 4 + 0.5
+    elif contraction_type != ContractionType.AABB:
+        raise NotImplementedError
+    return x
+
+
+def contract_aabb_inv(x, roi_aabb, contraction_type):
+    # [0, 1]^3 grid space => world space
+    if contraction_type == ContractionType.UN_BOUNDED_SPHERE:
+        x = (x - 0.5) * 4
+        mag = x.norm(dim=-1, keepdim=True).clamp_min(1e-10)
+        x = torch.where(mag > 1, x / mag / (2 - mag).clamp_min(1e-10), x)
+        x = (x + 1) / 2
+    elif contraction_type != ContractionType.AABB:
+        raise NotImplementedError
+    return x * (roi_aabb[3:] - roi_aabb[:3]) + roi_aabb[:3]
+
+
+def pack_bits(binary):
+    # bool (N,) => uint8 (ceil(N / 8),), bit i of byte j is element 8 * j + i
+    binary = binary.flatten()
+    binary = torch.cat([binary, binary.new_zeros((-binary.numel()) % 8)])
+    bits = torch.arange(8, device=binary.device, dtype=torch.uint8)
+    return (binary.view(-1, 8).to(torch.uint8) << bits).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(bitfield, n):
+    bits = torch.arange(8, device=bitfield.device, dtype=torch.uint8)
+    return ((bitfield[:,None] >> bits) & 1).flatten()[:n].bool()
+
+
+def weights_fingerprint(modules):
+    # order-independent summary (sum, absolute sum) of the weights an occupancy grid is evaluated from
+    params = [p.detach().double() for module in modules for p in module.parameters()]
+    return torch.stack([sum(p.sum() for p in params), sum(p.abs().sum() for p in params)]).cpu()
+
+
+class OccupancyGridState:
+    """
+    Build state of an occupancy grid, kept by the model next to the grid.
+    The grid is saved with the model weights in a compact form: the binarized grid packed to one bit per cell, the density grid
+    in float16 and a fingerprint of the weights of the modules the grid is valid for. A grid kept up to date by training
+    (built within the last n steps of its last update) is valid for the weights at save time, as training renders with it;
+    a grid restored or rebuilt outside of training keeps the fingerprint of the weights it was built from, so that weights
+    replaced afterwards (e.g. model.weights) are detected.
+    update and rebuild go through every_n_step, n being the update interval.
+    """
+    def __init__(self, grid, modules, n=16):
+        self.grid, self.modules, self.n = grid, modules, n
+        self.stale = True
+        self.built_fingerprint = None
+        self.loaded_fingerprint = None
+        self.build_step = self.update_step = None # steps of the last training build and update
+        grid._register_state_dict_hook(self.state_dict_hook)
+        grid._register_load_state_dict_pre_hook(self.load_state_dict_pre_hook)
+
+    def fingerprint(self):
+        return weights_fingerprint(self.modules)
+
+    def update(self, step, occ_eval_fn, occ_thre=0.01):
+        # training update, the grid is built every n steps
+        self.grid.every_n_step(step=step, occ_eval_fn=occ_eval_fn, occ_thre=occ_thre, n=self.n)
+        if step % self.n == 0:
+            self.built_fingerprint = self.fingerprint()
+            self.build_step = step
+        self.update_step = step
+        self.stale = False
+
+    def tracks_training(self):
+        return self.build_step is not None and 0 <= self.update_step - self.build_step < self.n
+
+    @torch.no_grad()
+    def rebuild(self, occ_eval_fn, occ_thre=0.01):
+        # evaluate the occupancy of every cell from scratch, as in the warmup steps of the grid update
+        training = self.grid.training
+        self.grid.occs.zero_()
+        self.grid.train()
+        self.grid.every_n_step(step=0, occ_eval_fn=occ_eval_fn, occ_thre=occ_thre, n=self.n)
+        self.grid.train(training)
+        self.built_fingerprint = self.fingerprint()
+        self.build_step = self.update_step = None
+        self.stale = False
+
+    def is_stale(self):
+        # a grid is stale if it was never built or loaded, or if it was built from other weights than the loaded ones
+        # the fingerprint is checked once, after the whole state dict is loaded
+        if self.loaded_fingerprint is not None:
+            self.stale = not torch.allclose(self.loaded_fingerprint.double(), self.fingerprint(), rtol=1e-4)
+            self.loaded_fingerprint = None
+        return self.stale
+
+    def state_dict_hook(self, module, state_dict, prefix, local_metadata):
+        if prefix + '_binary' in state_dict:
+            # nerfacc.OccupancyGrid keeps one bool per cell
+            state_dict[prefix + '_binary_packed'] = pack_bits(state_dict.pop(prefix + '_binary'))
+        state_dict[prefix + 'occs'] = state_dict[prefix + 'occs'].half()
+        # a grid that was never built is saved with a fingerprint that matches no weights
+        if self.tracks_training():
+            fingerprint = self.fingerprint()
+        elif self.built_fingerprint is not None:
+            fingerprint = self.built_fingerprint
+        else:
+            fingerprint = torch.full((2,), float('nan'), dtype=torch.float64)
+        state_dict[prefix + 'weights_fingerprint'] = fingerprint
+
+    def load_state_dict_pre_hook(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        self.build_step = self.update_step = None
+        if prefix + 'occs' not in state_dict:
+            # e.g. weights saved without the grid, loaded with strict=False, the grid does not match them
+            self.stale = True
+            return
+        if prefix + '_binary_packed' in state_dict:
+            state_dict[prefix + '_binary'] = unpack_bits(state_dict.pop(prefix + '_binary_packed'), self.grid.num_cells).view(self.grid._binary.shape)
+        state_dict[prefix + 'occs'] = state_dict[prefix + 'occs'].float()
+        # grids saved before the fingerprint was introduced are trusted
+        self.built_fingerprint = self.loaded_fingerprint = state_dict.pop(prefix + 'weights_fingerprint', None)
+        self.stale = False
+
+
+class OccupancyGridTorch(nn.Module):
+    """
+    Pure-PyTorch occupancy grid with the update rule of nerfacc.OccupancyGrid.
+    The binarized grid is kept as a bitfield (one bit per cell) that ray_marching_torch queries directly.
+    Cells are evaluated in chunks of eval_chunk_size points to bound the memory of the update.
+    """
+    def __init__(self, roi_aabb, resolution=128, contraction_type=ContractionType.AABB, eval_chunk_size=2**18):
+        super().__init__()
+        self.resolution = resolution
+        self.eval_chunk_size = eval_chunk_size
+        self.contraction_type = contraction_type
+        self.num_cells = resolution**3
+        self.register_buffer('roi_aabb', torch.as_tensor(roi_aabb, dtype=torch.float32).clone())
+        self.register_buffer('occs', torch.zeros(self.num_cells, dtype=torch.float32))
+        self.register_buffer('bitfield', torch.zeros((self.num_cells + 7) // 8, dtype=torch.uint8))
+
+    @property
+    def binary(self):
+        return unpack_bits(self.bitfield, self.num_cells).view(self.resolution, self.resolution, self.resolution)
+
+    def grid_coords(self, indices):
+        res = self.resolution
+        return torch.stack([indices // (res * res), (indices // res) % res, indices % res], dim=-1)
+
+    @torch.no_grad()
+    def query(self, x):
+        # whether the cells containing the world space points x (N, 3) are occupied
+        x = contract_aabb(x, self.roi_aabb, self.contraction_type)
+        coords = (x * self.resolution).floor().long()
+        inside = ((coords >= 0) & (coords < self.resolution)).all(dim=-1)
+        coords = coords.clamp(0, self.resolution - 1)
+        indices = (coords[...,0] * self.resolution + coords[...,1]) * self.resolution + coords[...,2]
+        occupied = (self.bitfield[indices >> 3] >> (indices & 7).to(torch.uint8)) & 1
+        return inside & occupied.bool()
+
+    @torch.no_grad()
+    def _update(self, step, occ_eval_fn, occ_thre=0.01, ema_decay=0.95, warmup_steps=256):
+        device = self.occs.device
+        if step < warmup_steps:
+            indices = torch.arange(self.num_cells, device=device)
+        else:
+            n = self.num_cells // 4
+            uniform_indices = torch.randint(self.num_cells, (n,), device=device)
+            occupied_indices = torch.nonzero(unpack_bits(self.bitfield, self.num_cells))[:,0]
+            if n < len(occupied_indices):
+                occupied_indices = occupied_indices[torch.randint(len(occupied_indices), (n,), device=device)]
+            indices = torch.cat([uniform_indices, occupied_indices], dim=0)
+        x = (self.grid_coords(indices) + torch.rand(len(indices), 3, device=device)) / self.resolution
+        if self.contraction_type == ContractionType.UN_BOUNDED_SPHERE:
+            # only the points inside the sphere are valid
+            mask = (x - 0.5).norm(dim=-1) < 0.5
+            x, indices = x[mask], indices[mask]
+        x = contract_aabb_inv(x, self.roi_aabb, self.contraction_type)
+        occ = chunk_batch(occ_eval_fn, self.eval_chunk_size, False, x).squeeze(-1)
+        self.occs[indices] = torch.maximum(self.occs[indices] * ema_decay, occ)
+        self.bitfield = pack_bits(self.occs > torch.clamp(self.occs.mean(), max=occ_thre))
+
+    @torch.no_grad()
+    def every_n_step(self, step, occ_eval_fn, occ_thre=1e-2, ema_decay=0.95, warmup_steps=256, n=16):
+        if not self.training:
+            raise RuntimeError("every_n_step should only be called during training.")
+        if step % n == 0:
+            self._update(step, occ_eval_fn, occ_thre=occ_thre, ema_decay=ema_decay, warmup_steps=warmup_steps)
+
+
+def ray_aabb_intersect_torch(rays_o, rays_d, aabb):
+    # rays that miss the box get t_min = t_max = 1e10 as in nerfacc
+    # unlike nerfacc, t_min is clamped to 0 so that rays starting inside the box are not marched backwards
+    rays_d = torch.where(rays_d.abs() < 1e-10, torch.full_like(rays_d, 1e-10), rays_d)
+    t0, t1 = (aabb[:3] - rays_o) / rays_d, (aabb[3:] - rays_o) / rays_d
+    t_min = torch.minimum(t0, t1).amax(dim=-1).clamp_min(0.)
+    t_max = torch.maximum(t0, t1).amin(dim=-1)
+    miss = t_max <= t_min
+    t_min = torch.where(miss, torch.full_like(t_min, 1e10), t_min)
+    t_max = torch.where(miss, torch.full_like(t_max, 1e10), t_max)
+    return t_min, t_max
+
+
+def segment_exclusive_cumsum(values, ray_indices, n_rays):
+    # exclusive cumsum of values (N,) within each ray, samples of the same ray have to be contiguous
+    # accumulate in float64 so that subtracting the running total at the ray start does not lose precision
+    cumsum = torch.cumsum(values.double(), dim=0)
+    cumsum = cumsum - values.double()
+    counts = torch.bincount(ray_indices, minlength=n_rays)
+    starts = torch.cumsum(counts, dim=0) - counts
+    return (cumsum - cumsum[starts[ray_indices]]).to(values.dtype)
+
+
+def render_transmittance_from_alpha_torch(alphas, ray_indices, n_rays):
+    log_trans = torch.log(torch.clamp(1. - alphas.view(-1), min=1e-10))
+    return torch.exp(segment_exclusive_cumsum(log_trans, ray_indices, n_rays))[:,None]
+
+
+def render_visibility_torch(alphas, ray_indices, early_stop_eps=1e-4, alpha_thre=0.0, n_rays=None):
+    n_rays = n_rays if n_rays is not None else int(ray_indices.max()) + 1
+    visibility = render_transmittance_from_alpha_torch(alphas, ray_indices, n_rays) >= early_stop_eps
+    if alpha_thre > 0:
+        visibility = visibility & (alphas >= alpha_thre)
+    return visibility.squeeze(-1)
+
+
+def render_weight_from_alpha_torch(alphas, ray_indices, n_rays):
+    return alphas * render_transmittance_from_alpha_torch(alphas, ray_indices, n_rays)
+
+
+def render_weight_from_density_torch(t_starts, t_ends, sigmas, ray_indices, n_rays):
+    tau = (sigmas * (t_ends - t_starts)).view(-1)
+    trans = torch.exp(-segment_exclusive_cumsum(tau, ray_indices, n_rays))
+    return (trans * (1. - torch.exp(-tau)))[:,None]
+
+
+def accumulate_along_rays_torch(weights, ray_indices, values=None, n_rays=None):
+    src = weights if values is None else weights * values
+    n_rays = n_rays if n_rays is not None else int(ray_indices.max()) + 1
+    return torch.zeros((n_rays, src.shape[-1]), dtype=src.dtype, device=src.device).index_add(0, ray_indices, src)
+
+
+@torch.no_grad()
+def generate_samples(t_min, t_max, render_step_size, cone_angle):
+    """
+    Packed sample intervals along each ray, stepping with dt = max(t * cone_angle, render_step_size)
+    until the sample midpoint reaches t_max, as nerfacc does.
+    The step size is constant until t reaches render_step_size / cone_angle and grows geometrically after that,
+    so per-ray sample counts and positions have a closed form and no per-step loop is needed.
+    """
+    n_rays = t_min.shape[0]
+    n_valid = ((t_max - t_min) / render_step_size - 0.5).ceil().clamp_min(0)
+    if cone_angle > 0:
+        n_linear = ((render_step_size / cone_angle - t_min) / render_step_size).ceil().clamp_min(0)
+        n_linear = torch.minimum(n_linear, n_valid)
+        t_geo = t_min + n_linear * render_step_size
+        n_geo = (torch.log(t_max.clamp_min(1e-10) / (t_geo * (1 + cone_angle / 2)).clamp_min(1e-10)) / math.log1p(cone_angle)).ceil().clamp_min(0)
+        n_geo = torch.where(n_linear < n_valid, n_geo, torch.zeros_like(n_geo))
+    else:
+        n_linear, t_geo, n_geo = n_valid, t_min, torch.zeros_like(n_valid)
+    counts = (n_linear + n_geo).long()
+    ray_indices = torch.repeat_interleave(torch.arange(n_rays, device=t_min.device), counts)
+    starts = torch.cumsum(counts, dim=0) - counts
+    k = (torch.arange(len(ray_indices), device=t_min.device) - starts[ray_indices]).float()
+    n_linear, t_min, t_geo = n_linear[ray_indices], t_min[ray_indices], t_geo[ray_indices]
+    is_linear = k < n_linear
+    t_starts = torch.where(is_linear, t_min + k * render_step_size, t_geo * (1 + cone_angle)**(k - n_linear))
+    dt = torch.where(is_linear, torch.full_like(t_starts, render_step_size), t_starts * cone_angle)
+    return ray_indices, t_starts[:,None], (t_starts + dt)[:,None]
+
+
+@torch.no_grad()
+def ray_marching_torch(
+    rays_o, rays_d, t_min=None, t_max=None, scene_aabb=None, grid=None, sigma_fn=None, alpha_fn=None,
+    early_stop_eps=1e-4, alpha_thre=0.0, near_plane=None, far_plane=None, render_step_size=1e-3,
+    stratified=False, cone_angle=0.0
+):
+    # same arguments and outputs as nerfacc.ray_marching
+    assert sigma_fn is None or alpha_fn is None, "Only one of `alpha_fn` and `sigma_fn` should be provided."
+    if t_min is None or t_max is None:
+        if scene_aabb is not None:
+            t_min, t_max = ray_aabb_intersect_torch(rays_o, rays_d, scene_aabb)
+        else:
+            t_min = torch.zeros_like(rays_o[...,0])
+            t_max = torch.ones_like(rays_o[...,0]) * 1e10
+    if near_plane is not None:
+        t_min = torch.clamp(t_min, min=near_plane)
+    if far_plane is not None:
+        t_max = torch.clamp(t_max, max=far_plane)
+    if stratified:
+        t_min = t_min + torch.rand_like(t_min) * render_step_size
+
+    ray_indices, t_starts, t_ends = generate_samples(t_min, t_max, render_step_size, cone_angle)
+
+    # skip samples in empty cells
+    if grid is not None:
+        positions = rays_o[ray_indices] + rays_d[ray_indices] * (t_starts + t_ends) / 2.
+        occupied = grid.query(positions)
+        ray_indices, t_starts, t_ends = ray_indices[occupied], t_starts[occupied], t_ends[occupied]
+
+    # skip invisible samples
+    if sigma_fn is not None or alpha_fn is not None:
+        if sigma_fn is not None:
+            alphas = 1. - torch.exp(-sigma_fn(t_starts, t_ends, ray_indices) * (t_ends - t_starts))
+        else:
+            alphas = alpha_fn(t_starts, t_ends, ray_indices)
+        masks = render_visibility_torch(alphas, ray_indices, early_stop_eps=early_stop_eps, alpha_thre=alpha_thre, n_rays=rays_o.shape[0])
+        ray_indices, t_starts, t_ends = ray_indices[masks], t_starts[masks], t_ends[masks]
+
+    return ray_indices, t_starts, t_ends
+
+
+def render_front_to_back(eval_fn, ray_indices, n_rays, render_weight_from_alpha, early_stop_eps=1e-4, segment_size=64):
+    """
+    Early ray termination for the samples of ray_marching (sorted by ray): the samples are evaluated front to back, segment_size
+    samples per ray at a time, and rays whose transmittance fell below early_stop_eps are not evaluated any further.
+    eval_fn(sample_indices) returns the alphas (n, 1) and a dict of per-sample outputs of the given samples.
+    Returns the indices of the evaluated samples, their weights (n, 1) and outputs, in sample order.
+    The weights are exact (and differentiable) for the evaluated samples, the others would weigh less than early_stop_eps each.
+    """
+    device = ray_indices.device
+    counts = torch.bincount(ray_indices, minlength=n_rays)
+    rank = torch.arange(len(ray_indices), device=device) - (torch.cumsum(counts, dim=0) - counts)[ray_indices]
+    transmittance = torch.ones(n_rays, device=device)
+    sample_indices, weights, outputs = [], [], {}
+    for start in range(0, int(counts.max()) if len(ray_indices) > 0 else 0, segment_size):
+        alive = transmittance.detach() > early_stop_eps
+        indices = torch.nonzero((rank >= start) & (rank < start + segment_size) & alive[ray_indices])[:,0]
+        if len(indices) == 0:
+            break
+        alphas, out = eval_fn(indices)
+        segment_ray_indices = ray_indices[indices]
+        segment_weights = render_weight_from_alpha(alphas, ray_indices=segment_ray_indices, n_rays=n_rays)
+        weights.append(segment_weights * transmittance[segment_ray_indices,None])
+        transmittance = transmittance * (1. - torch.zeros_like(transmittance).index_add(0, segment_ray_indices, segment_weights.view(-1).to(transmittance)))
+        sample_indices.append(indices)
+        for k, v in out.items():
+            outputs.setdefault(k, []).append(v)
+
+    if len(sample_indices) == 0:
+        alphas, out = eval_fn(ray_indices.new_zeros((0,)))
+        return ray_indices.new_zeros((0,)), alphas, out
+    sample_indices = torch.cat(sample_indices)
+    sample_indices, order = torch.sort(sample_indices)
+    return sample_indices, torch.cat(weights)[order], {k: torch.cat(v)[order] for k, v in outputs.items()}
+
+
+def sample_pdf(bins, weights, n_samples, det=True):
+    # inverse transform sampling of n_samples per ray from the piecewise constant pdf of weights (N, M - 1) over bins (N, M)
+    weights = weights + 1e-5
+    cdf = torch.cumsum(weights / weights.sum(dim=-1, keepdim=True), dim=-1)
+    cdf = torch.cat([torch.zeros_like(cdf[:,:1]), cdf], dim=-1)
+    if det:
+        u = torch.linspace(0.5 / n_samples, 1. - 0.5 / n_samples, n_samples, device=bins.device).expand(len(bins), n_samples)
+    else:
+        u = torch.rand(len(bins), n_samples, device=bins.device)
+    inds = torch.searchsorted(cdf, u.contiguous(), right=True)
+    below, above = (inds - 1).clamp_min(0), inds.clamp_max(cdf.shape[-1] - 1)
+    cdf_below, cdf_above = cdf.gather(1, below), cdf.gather(1, above)
+    bins_below, bins_above = bins.gather(1, below), bins.gather(1, above)
+    denom = cdf_above - cdf_below
+    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+    return bins_below + (u - cdf_below) / denom * (bins_above - bins_below)
+
+
+def get_render_backend(name):
+    if name == 'nerfacc':
+        import nerfacc
+        from nerfacc.intersection import ray_aabb_intersect
+        return SimpleNamespace(
+            OccupancyGrid=nerfacc.OccupancyGrid,
+            ray_aabb_intersect=ray_aabb_intersect,
+            ray_marching=nerfacc.ray_marching,
+            render_visibility=nerfacc.render_visibility,
+            render_weight_from_alpha=nerfacc.render_weight_from_alpha,
+            render_weight_from_density=nerfacc.render_weight_from_density,
+            accumulate_along_rays=nerfacc.accumulate_along_rays
+        )
+    elif name == 'torch':
+        return SimpleNamespace(
+            OccupancyGrid=OccupancyGridTorch,
+            ray_aabb_intersect=ray_aabb_intersect_torch,
+            ray_marching=ray_marching_torch,
+            render_visibility=render_visibility_torch,
+            render_weight_from_alpha=render_weight_from_alpha_torch,
+            render_weight_from_density=render_weight_from_density_torch,
+            accumulate_along_rays=accumulate_along_rays_torch
+        )
+    else:
+        raise ValueError(f"Unknown render backend: {name}")
@@ -1,5 +1,5 @@
 import gc
-from collections import defaultdict
+import math
 
 import torch
 import torch.nn as nn
@@ -7,49 +7,187 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
-import tinycudann as tcnn
+try:
+    import tinycudann as tcnn
+except ImportError:
+    tcnn = None # CPU-only environments, use the pure-torch encodings and networks
 
 
-def chunk_batch(func, chunk_size, move_to_cpu, *args, **kwargs):
-    B = None
+def _batch_size(args):
+    # batched arguments are tensors or ranges (e.g. of linear indices that func turns into inputs on the fly)
     for arg in args:
-        if isinstance(arg, torch.Tensor):
-            B = arg.shape[0]
-            break
-    out = defaultdict(list)
-    out_type = None
+        if isinstance(arg, (torch.Tensor, range)):
+            return len(arg)
+
+
+def _chunk_outputs(func, chunk_size, *args, **kwargs):
+    # yields (start, end, outputs as a dict, type returned by func) for each chunk of the batched tensor arguments
+    B = _batch_size(args)
     for i in range(0, B, chunk_size):
-        out_chunk = func(*[arg[i:i+chunk_size] if isinstance(arg, torch.Tensor) else arg for arg in args], **kwargs)
+        out_chunk = func(*[arg[i:i+chunk_size] if isinstance(arg, (torch.Tensor, range)) else arg for arg in args], **kwargs)
         if out_chunk is None:
             continue
         out_type = type(out_chunk)
         if isinstance(out_chunk, torch.Tensor):
             out_chunk = {0: out_chunk}
         elif isinstance(out_chunk, tuple) or isinstance(out_chunk, list):
-            chunk_length = len(out_chunk)
             out_chunk = {i: chunk for i, chunk in enumerate(out_chunk)}
         elif isinstance(out_chunk, dict):
             pass
         else:
             print(f'Return value of func must be in type [torch.Tensor, list, tuple, dict], get {type(out_chunk)}.')
             exit(1)
-        for k, v in out_chunk.items():
-            v = v if torch.is_grad_enabled() else v.detach()
-            v = v.cpu() if move_to_cpu else v
-            out[k].append(v)
-    
-    if out_type is None:
-        return
+        if not torch.is_grad_enabled():
+            out_chunk = {k: v.detach() for k, v in out_chunk.items()}
+        yield i, min(i + chunk_size, B), out_chunk, out_type
+
 
-    out = {k: torch.cat(v, dim=0) for k, v in out.items()}
+def _restore_type(out, out_type):
     if out_type is torch.Tensor:
         return out[0]
     elif out_type in [tuple, list]:
-        return out_type([out[i] for i in range(chunk_length)])
+        return out_type([out[i] for i in range(len(out))])
     elif out_type is dict:
         return out
 
 
+def _empty_host(shape, dtype, pin_memory):
+    if pin_memory:
+        try:
+            return torch.empty(shape, dtype=dtype, pin_memory=True)
+        except RuntimeError:
+            pass
+    return torch.empty(shape, dtype=dtype)
+
+
+# pinned host buffers of finished device-to-host copies, reused by the next ones instead of pinning new memory on every call
+_staging_pool = []
+
+
+def _acquire_staging(numel, dtype):
+    fits = [i for i, buffer in enumerate(_staging_pool) if buffer.dtype == dtype and buffer.numel() >= numel]
+    if len(fits) > 0:
+        return _staging_pool.pop(min(fits, key=lambda i: _staging_pool[i].numel()))
+    return _empty_host((numel,), dtype, pin_memory=True)
+
+
+class _DeviceToHost:
+    """
+    Device-to-host copies of chunk outputs: on CUDA the copies run on a side stream into two alternating sets of pinned staging buffers,
+    so that the copy of a chunk overlaps with the evaluation of the next one, and finish(host outputs) of a chunk is called once its copy is done.
+    finish has to copy out of the staging buffers, they are reused by the chunk after next and returned to the pool by close.
+    Outputs on CPU are passed to finish directly.
+    """
+    def __init__(self, out_chunk):
+        device = next(iter(out_chunk.values())).device
+        self.copy_stream = torch.cuda.Stream(device=device) if device.type == 'cuda' else None
+        self.slot, self.pending, self.buffers = 0, None, {}
+
+    def staging(self, key, shape, dtype):
+        numel = math.prod(shape)
+        buffer = self.buffers.get((key, self.slot))
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+            if buffer is not None:
+                _staging_pool.append(buffer)
+            buffer = self.buffers[(key, self.slot)] = _acquire_staging(numel, dtype)
+        return buffer[:numel].view(shape)
+
+    def copy(self, out_chunk, finish):
+        if self.copy_stream is None:
+            finish({k: v.cpu() for k, v in out_chunk.items()})
+            return
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.copy_stream.device))
+        staged = {}
+        with torch.cuda.stream(self.copy_stream):
+            for k, v in out_chunk.items():
+                staged[k] = self.staging(k, v.shape, v.dtype).copy_(v, non_blocking=True)
+                v.record_stream(self.copy_stream)
+        event = self.copy_stream.record_event()
+        self.flush()
+        self.pending, self.slot = (event, staged, finish), 1 - self.slot
+
+    def flush(self):
+        if self.pending is not None:
+            event, staged, finish = self.pending
+            event.synchronize()
+            finish(staged)
+            self.pending = None
+
+    def close(self):
+        self.flush()
+        _staging_pool.extend(self.buffers.values())
+        self.buffers = {}
+
+
+def chunk_batch(func, chunk_size, move_to_cpu, *args, **kwargs):
+    """
+    Evaluates func on chunks of the batched tensor (or range) arguments and concatenates the outputs along the first dimension.
+    Output buffers are allocated from the shapes of the first chunk and filled in place, device-to-host copies go through _DeviceToHost.
+    Outputs that are not batched like the inputs, e.g. per-chunk sample counts, are concatenated over chunks (and moved to CPU) at the end.
+    With gradients enabled the chunks are concatenated with torch.cat to keep the graph.
+    """
+    B = _batch_size(args)
+    out, out_list, out_type, device_to_host = None, {}, None, None
+    for start, end, out_chunk, out_type in _chunk_outputs(func, chunk_size, *args, **kwargs):
+        if out is None:
+            out = {}
+            device_to_host = _DeviceToHost(out_chunk) if move_to_cpu else None
+            for k, v in out_chunk.items():
+                if torch.is_grad_enabled() or v.dim() == 0 or v.shape[0] != end - start:
+                    continue
+                out[k] = torch.empty((B, *v.shape[1:]), dtype=v.dtype, device='cpu' if move_to_cpu else v.device)
+        batched = {}
+        for k, v in out_chunk.items():
+            if k in out and v.shape[0] != end - start:
+                # only matched the batch size by chance in the first chunk
+                if device_to_host is not None:
+                    device_to_host.flush()
+                out_list[k] = [out.pop(k)[:start]]
+            if k in out:
+                batched[k] = v
+            else:
+                out_list.setdefault(k, []).append(v)
+        if device_to_host is None:
+            for k, v in batched.items():
+                out[k][start:end].copy_(v)
+        else:
+            device_to_host.copy(batched, lambda staged, start=start, end=end: [out[k][start:end].copy_(v) for k, v in staged.items()])
+
+    if out_type is None:
+        return
+
+    if device_to_host is not None:
+        device_to_host.close()
+    out.update({k: torch.cat([c.cpu() for c in v] if move_to_cpu else v, dim=0) for k, v in out_list.items()})
+    return _restore_type(out, out_type)
+
+
+def chunk_batch_stream(func, chunk_size, move_to_cpu, *args, **kwargs):
+    """
+    Generator version of chunk_batch, yields (start, end, output) for each chunk with output in the type returned by func.
+    When moving GPU outputs to CPU, a chunk is yielded once its copy is done while the next chunk is already being evaluated.
+    """
+    device_to_host, ready = None, []
+    def finish(staged, start, end, out_type):
+        if device_to_host.copy_stream is not None:
+            staged = {k: v.clone() for k, v in staged.items()}
+        ready.append((start, end, _restore_type(staged, out_type)))
+
+    for start, end, out_chunk, out_type in _chunk_outputs(func, chunk_size, *args, **kwargs):
+        if not move_to_cpu:
+            yield start, end, _restore_type(out_chunk, out_type)
+            continue
+        if device_to_host is None:
+            device_to_host = _DeviceToHost(out_chunk)
+        device_to_host.copy(out_chunk, lambda staged, start=start, end=end, out_type=out_type: finish(staged, start, end, out_type))
+        while len(ready) > 0:
+            yield ready.pop(0)
+    if device_to_host is not None:
+        device_to_host.close()
+    while len(ready) > 0:
+        yield ready.pop(0)
+
+
 class _TruncExp(Function):  # pylint: disable=abstract-method
     # Implementation from torch-ngp:
     # https://github.com/ashawkey/torch-ngp/blob/93b08a0d4ec1cc6e69d85df7f0acdfb99603b628/activation.py
@@ -114,6 +252,8 @@ def scale_anything(dat, inp_scale, tgt_scale):
 
 
 def cleanup():
+    _staging_pool.clear()
     gc.collect()
     torch.cuda.empty_cache()
-    tcnn.free_temporary_memory()
+    if tcnn is not None:
+        tcnn.free_temporary_memory()
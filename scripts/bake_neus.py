@@ -0,0 +1,62 @@
+"""
+Bakes a trained NeuS checkpoint into a sparse voxel grid (see models/baking.py) and reports the PSNR and render time
+of the baked grid against the full model on the test views.
+Run from the repository root:
+    python scripts/bake_neus.py --config configs/neus-dtu.yaml --ckpt path/to/last.ckpt --output baked.pt --resolution 256 --n_views 4
+Extra arguments override the config as in launch.py, e.g. dataset.root_dir=...
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.baking import bake_neus, BakedNeuS
+from eval_utils import load_checkpoint, test_views, timed, psnr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--ckpt', required=True)
+    parser.add_argument('--output', default='baked.pt')
+    parser.add_argument('--resolution', type=int, default=256)
+    parser.add_argument('--brick_size', type=int, default=8)
+    parser.add_argument('--band', type=float, default=2.0)
+    parser.add_argument('--sh_degree', type=int, default=1)
+    parser.add_argument('--n_dirs', type=int, default=32)
+    parser.add_argument('--n_views', type=int, default=4, help='number of test views of the report, 0 to skip it')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='device of the full model')
+    parser.add_argument('--render_device', default='cpu', help='device of the baked renderer')
+    args, extras = parser.parse_known_args()
+
+    config, _, model = load_checkpoint(args.config, args.ckpt, extras, args.device)
+
+    t0 = time.perf_counter()
+    baked = bake_neus(model, resolution=args.resolution, brick_size=args.brick_size, band=args.band, sh_degree=args.sh_degree, n_dirs=args.n_dirs, chunk=config.model.ray_chunk * 64)
+    torch.save(baked, args.output)
+    print(f"baked {len(baked['sdf'])} bricks in {time.perf_counter() - t0:.1f} s, {os.path.getsize(args.output) / 2**20:.1f} MB")
+    if args.n_views == 0:
+        return
+
+    renderer = BakedNeuS(baked, device=args.render_device)
+    background_color = torch.ones((3,), dtype=torch.float32)
+    model.background_color = background_color.to(args.device)
+    for index, rays, rgb in test_views(config, args.n_views, background_color):
+        with torch.no_grad():
+            out_full, t_full = timed(model, args.device, rays.to(args.device))
+        out_baked, t_baked = timed(renderer.render, args.render_device, rays, background_color=background_color.to(args.render_device))
+
+        rgb_full, rgb_baked = out_full['comp_rgb_full'].cpu(), out_baked['comp_rgb_full'].cpu()
+        print(
+            f"view {index}: full ({args.device}) {t_full:6.2f} s PSNR {psnr(rgb_full, rgb):5.2f}, "
+            f"baked ({args.render_device}) {t_baked:6.2f} s PSNR {psnr(rgb_baked, rgb):5.2f}, "
+            f"baked vs full PSNR {psnr(rgb_baked, rgb_full):5.2f}, {t_full / t_baked:5.1f}x"
+        )
+
+
+if __name__ == '__main__':
+    main()
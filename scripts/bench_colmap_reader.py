@@ -0,0 +1,109 @@
+"""
+Benchmark of the columnar COLMAP binary readers against the record-by-record ones (see datasets/colmap_utils.py).
+Writes a synthetic images.bin / points3D.bin to a temporary directory, reads it with both readers and checks that they agree.
+Run from the repository root:
+    python scripts/bench_colmap_reader.py --n_images 1000 --n_points2D 4000 --n_points3D 500000
+"""
+
+import os
+import sys
+import time
+import struct
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.colmap_utils import \
+    read_images_binary, read_points3d_binary, read_images_binary_columnar, read_points3d_binary_columnar, \
+    IMAGE_HEADER_DTYPE, POINT2D_DTYPE, POINT3D_HEADER_DTYPE, TRACK_ELEM_DTYPE
+
+
+def write_images_binary(path, n_images, n_points2D, n_points3D, rng):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', n_images))
+        for i in range(n_images):
+            header = np.zeros(1, dtype=IMAGE_HEADER_DTYPE)
+            header['id'], header['camera_id'] = i + 1, 1
+            header['qvec'], header['tvec'] = rng.normal(size=4), rng.normal(size=3)
+            f.write(header.tobytes())
+            f.write(f'image_{i:06d}.jpg'.encode() + b'\x00')
+            n = int(rng.integers(0, 2 * n_points2D))
+            points = np.zeros(n, dtype=POINT2D_DTYPE)
+            points['xy'] = rng.random((n, 2)) * 1000.
+            points['point3D_id'] = rng.integers(-1, n_points3D, size=n)
+            f.write(struct.pack('<Q', n))
+            f.write(points.tobytes())
+
+
+def write_points3d_binary(path, n_images, n_points2D, n_points3D, rng):
+    track_lengths = rng.integers(2, 10, size=n_points3D)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', n_points3D))
+        headers = np.zeros(n_points3D, dtype=POINT3D_HEADER_DTYPE)
+        headers['id'] = np.arange(n_points3D)
+        headers['xyz'] = rng.normal(size=(n_points3D, 3))
+        headers['rgb'] = rng.integers(0, 256, size=(n_points3D, 3))
+        headers['error'] = rng.random(n_points3D)
+        headers['track_length'] = track_lengths
+        tracks = np.zeros(track_lengths.sum(), dtype=TRACK_ELEM_DTYPE)
+        tracks['image_id'] = rng.integers(1, n_images + 1, size=len(tracks))
+        tracks['point2D_idx'] = rng.integers(0, n_points2D, size=len(tracks))
+        offsets = np.concatenate([[0], np.cumsum(track_lengths)])
+        for k in range(n_points3D):
+            f.write(headers[k:k+1].tobytes())
+            f.write(tracks[offsets[k]:offsets[k+1]].tobytes())
+
+
+def check_images(images, columnar, n_checks):
+    assert list(images.keys()) == list(columnar.keys())
+    for image_id in list(images.keys())[:n_checks]:
+        a, b = images[image_id], columnar[image_id]
+        assert a.name == b.name and a.camera_id == b.camera_id
+        assert np.array_equal(a.qvec, b.qvec) and np.array_equal(a.tvec, b.tvec)
+        assert np.array_equal(a.xys.reshape(-1, 2), b.xys) and np.array_equal(a.point3D_ids, b.point3D_ids)
+
+
+def check_points(points, columnar, n_checks):
+    assert list(points.keys()) == list(columnar.keys())
+    for point3D_id in list(points.keys())[:n_checks]:
+        a, b = points[point3D_id], columnar[point3D_id]
+        assert np.array_equal(a.xyz, b.xyz) and np.array_equal(a.rgb, b.rgb) and a.error == b.error
+        assert np.array_equal(a.image_ids, b.image_ids) and np.array_equal(a.point2D_idxs, b.point2D_idxs)
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t0, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=1000)
+    parser.add_argument('--n_points2D', type=int, default=4000, help='average number of 2D points per image')
+    parser.add_argument('--n_points3D', type=int, default=500000)
+    parser.add_argument('--n_checks', type=int, default=1000, help='number of records compared between the readers')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images_path, points_path = os.path.join(tmp_dir, 'images.bin'), os.path.join(tmp_dir, 'points3D.bin')
+        write_images_binary(images_path, args.n_images, args.n_points2D, args.n_points3D, rng)
+        write_points3d_binary(points_path, args.n_images, args.n_points2D, args.n_points3D, rng)
+
+        t_images, images = timed(read_images_binary, images_path)
+        t_images_columnar, images_columnar = timed(read_images_binary_columnar, images_path)
+        check_images(images, images_columnar, args.n_checks)
+        n_obs = len(images_columnar.xys)
+        print(f"images.bin   ({args.n_images} images, {n_obs} 2D points): {t_images:7.2f} s -> {t_images_columnar:7.2f} s ({t_images / t_images_columnar:6.1f}x)")
+
+        t_points, points = timed(read_points3d_binary, points_path)
+        t_points_columnar, points_columnar = timed(read_points3d_binary_columnar, points_path)
+        check_points(points, points_columnar, args.n_checks)
+        print(f"points3D.bin ({args.n_points3D} points): {t_points:7.2f} s -> {t_points_columnar:7.2f} s ({t_points / t_points_columnar:6.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Renders NeuS test views with the radiance evaluated only on the samples weighing more than model.color_weight_thre, at several
+thresholds, and reports the fraction of samples shaded, the render time and the difference with shading every sample.
+Run from the repository root:
+    python scripts/bench_color_gating.py --config configs/neus-dtu.yaml --ckpt path/to/last.ckpt --thre 1e-5 1e-4 1e-3 --n_views 4
+Extra arguments override the config as in launch.py, e.g. dataset.root_dir=...
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from eval_utils import load_checkpoint, test_views, timed, psnr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--ckpt', required=True)
+    parser.add_argument('--thre', type=float, nargs='+', default=[1e-5, 1e-4, 1e-3])
+    parser.add_argument('--n_views', type=int, default=4)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args, extras = parser.parse_known_args()
+
+    config, _, model = load_checkpoint(args.config, args.ckpt, extras, args.device)
+
+    background_color = torch.ones((3,), dtype=torch.float32)
+    model.background_color = background_color.to(args.device)
+    for index, rays, rgb in test_views(config, args.n_views, background_color):
+        rays = rays.to(args.device)
+        rgb_ref = None
+        for thre in [0.] + args.thre:
+            model.config.color_weight_thre = thre
+            with torch.no_grad():
+                out, t = timed(model, args.device, rays)
+            rgb_thre = out['comp_rgb_full'].cpu()
+            rgb_ref = rgb_thre if rgb_ref is None else rgb_ref
+            print(
+                f"view {index} thre {thre:7.1e}: {t:6.2f} s, {float(out['num_samples_shaded'].sum() / out['num_samples'].sum().clamp(min=1)) * 100:5.1f}% shaded, "
+                f"PSNR {psnr(rgb_thre, rgb):5.2f}, max abs diff {(rgb_thre - rgb_ref).abs().max().item():.1e}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Microbenchmark of the scene contraction applied on every geometry call (see models/geometry.contract_to_unisphere).
+Compares the previous implementation (scale_anything + boolean-indexed contraction) with the branch-free one,
+eagerly and compiled with TorchScript, for a range of batch sizes, and checks that they agree.
+Run from the repository root:
+    python scripts/bench_contraction.py --n_points 4096 65536 1048576
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.utils import scale_anything
+from models.geometry import contract_aabb, contract_unbounded_sphere
+
+
+def contract_aabb_indexed(x, radius):
+    return scale_anything(x, (-radius, radius), (0, 1))
+
+
+def contract_unbounded_sphere_indexed(x, radius):
+    x = scale_anything(x, (-radius, radius), (0, 1))
+    x = x * 2 - 1
+    mag = x.norm(dim=-1, keepdim=True)
+    mask = mag.squeeze(-1) > 1
+    x[mask] = (2 - 1 / mag[mask]) * (x[mask] / mag[mask])
+    x = x / 4 + 0.5
+    return x
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timed(fn, x, radius, n_iters, device):
+    fn(x, radius)
+    synchronize(device)
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        out = fn(x, radius)
+    synchronize(device)
+    return (time.perf_counter() - t0) / n_iters, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_points', type=int, nargs='+', default=[4096, 65536, 1048576])
+    parser.add_argument('--n_iters', type=int, default=50)
+    parser.add_argument('--radius', type=float, default=1.0)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for name, indexed, branch_free in [
+        ('aabb', contract_aabb_indexed, contract_aabb),
+        ('unbounded sphere', contract_unbounded_sphere_indexed, contract_unbounded_sphere),
+    ]:
+        scripted = torch.jit.script(branch_free)
+        for n in args.n_points:
+            # half of the points outside the unit sphere, as for background samples
+            x = torch.randn(n, 3, device=device) * args.radius
+            t_indexed, out_indexed = timed(indexed, x, args.radius, args.n_iters, device)
+            t_branch_free, out_branch_free = timed(branch_free, x, args.radius, args.n_iters, device)
+            t_scripted, out_scripted = timed(scripted, x, args.radius, args.n_iters, device)
+            assert torch.allclose(out_indexed, out_branch_free, atol=1e-6) and torch.allclose(out_indexed, out_scripted, atol=1e-6)
+            print(f"{name:>16s} {n:8d} points: indexed {t_indexed * 1e6:9.1f} us, branch-free {t_branch_free * 1e6:9.1f} us, scripted {t_scripted * 1e6:9.1f} us")
+
+
+if __name__ == '__main__':
+    main()
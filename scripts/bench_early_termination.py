@@ -0,0 +1,49 @@
+"""
+Renders test views with transmittance-based early ray termination (model.early_stop_eps) at several thresholds and reports
+the fraction of samples saved, the render time and the PSNR against the ground truth and against rendering without it.
+Run from the repository root:
+    python scripts/bench_early_termination.py --config configs/neus-dtu.yaml --ckpt path/to/last.ckpt --eps 1e-4 1e-3 1e-2 --n_views 4
+Extra arguments override the config as in launch.py, e.g. dataset.root_dir=...
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from eval_utils import load_checkpoint, test_views, timed, psnr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--ckpt', required=True)
+    parser.add_argument('--eps', type=float, nargs='+', default=[1e-4, 1e-3, 1e-2])
+    parser.add_argument('--n_views', type=int, default=4)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args, extras = parser.parse_known_args()
+
+    config, system, model = load_checkpoint(args.config, args.ckpt, extras, args.device)
+
+    background_color = torch.ones((3,), dtype=torch.float32)
+    model.background_color = background_color.to(args.device)
+    rgb_key = 'comp_rgb_full' if config.model.name == 'neus' else 'comp_rgb'
+    for index, rays, rgb in test_views(config, args.n_views, background_color):
+        rays = rays.to(args.device)
+        rgb_ref = None
+        for eps in [0.] + args.eps:
+            model.config.early_stop_eps = eps
+            with torch.no_grad():
+                out, t = timed(model, args.device, rays)
+            rgb_eps = out[rgb_key].cpu()
+            rgb_ref = rgb_eps if rgb_ref is None else rgb_ref
+            print(
+                f"view {index} eps {eps:7.1e}: {t:6.2f} s, {out['num_samples'].sum().item():9d} samples, "
+                f"{float(system.samples_saved(out)) * 100:5.1f}% saved, PSNR {psnr(rgb_eps, rgb):5.2f}, vs eps 0 {psnr(rgb_eps, rgb_ref):6.2f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Throughput benchmark of the pure-torch encodings (HashGridTorch vs. VanillaFrequency).
+The encodings are timed alternately over --n_repeats repeats and the medians are reported, which makes the time ratio robust
+to load changes of the machine. Fails if the median ratio exceeds --max_ratio or HashGridTorch runs below --min_throughput M points/s,
+the default bounds leave about 2x headroom over the ratios measured on CPU.
+Run from the repository root:
+    python scripts/bench_encoding.py --device cpu --n_points 262144 --n_repeats 5
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import torch
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.network_utils import get_encoding
+
+
+HASHGRID_CONFIG = {
+    'otype': 'HashGridTorch',
+    'n_levels': 16,
+    'n_features_per_level': 2,
+    'log2_hashmap_size': 19,
+    'base_resolution': 32,
+    'per_level_scale': 1.3195079107728942,
+    'include_xyz': True
+}
+
+FREQUENCY_CONFIG = {
+    'otype': 'VanillaFrequency',
+    'n_frequencies': 10,
+    'include_xyz': True
+}
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(encoding, x, n_iters, backward=False):
+    synchronize(x.device)
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        if backward:
+            encoding(x).sum().backward()
+        else:
+            with torch.no_grad():
+                encoding(x)
+    synchronize(x.device)
+    return (time.perf_counter() - t0) / n_iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--n_points', type=int, default=2**18)
+    parser.add_argument('--n_iters', type=int, default=10)
+    parser.add_argument('--backward', action='store_true', help='also time the backward pass')
+    parser.add_argument('--n_repeats', type=int, default=5, help='number of alternating timings of each encoding, the medians are used')
+    parser.add_argument('--max_ratio', type=float, default=None, help='upper bound of the median HashGridTorch / VanillaFrequency time ratio, 80 by default, 160 with --backward')
+    parser.add_argument('--min_throughput', type=float, default=0., help='lower bound of the median HashGridTorch throughput in M points/s')
+    args = parser.parse_args()
+    if args.max_ratio is None:
+        args.max_ratio = 160. if args.backward else 80.
+
+    device = torch.device(args.device)
+    # gradients w.r.t. the positions as for the SDF normals, VanillaFrequency has no parameters
+    x = torch.rand(args.n_points, 3, device=device).requires_grad_(args.backward)
+    encodings = {name: get_encoding(3, OmegaConf.create(config)).to(device) for name, config in [('VanillaFrequency', FREQUENCY_CONFIG), ('HashGridTorch', HASHGRID_CONFIG)]}
+    for encoding in encodings.values(): # warm up
+        benchmark(encoding, x, 2, backward=args.backward)
+    times = {name: [] for name in encodings}
+    for _ in range(args.n_repeats):
+        for name, encoding in encodings.items():
+            times[name].append(benchmark(encoding, x, args.n_iters, backward=args.backward))
+    for name, encoding in encodings.items():
+        t = statistics.median(times[name])
+        print(f"{name:>18s}: {t * 1e3:8.2f} ms/iter, {args.n_points / t / 1e6:8.2f} M points/s, {encoding.n_output_dims} output dims")
+    ratios = [t_hash / t_freq for t_hash, t_freq in zip(times['HashGridTorch'], times['VanillaFrequency'])]
+    ratio = statistics.median(ratios)
+    throughput = args.n_points / statistics.median(times['HashGridTorch']) / 1e6
+    print(f"HashGridTorch / VanillaFrequency time ratio: median {ratio:.2f}x, range {min(ratios):.2f}x - {max(ratios):.2f}x over {args.n_repeats} repeats")
+    assert ratio <= args.max_ratio, f"HashGridTorch is {ratio:.2f}x slower than VanillaFrequency, expected at most {args.max_ratio:.2f}x"
+    assert throughput >= args.min_throughput, f"HashGridTorch runs at {throughput:.2f} M points/s, expected at least {args.min_throughput:.2f}"
+
+if __name__ == '__main__':
+    main()
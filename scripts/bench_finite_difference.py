@@ -0,0 +1,70 @@
+"""
+Throughput benchmark of the finite-difference stencils of VolumeSDF (see models/geometry.py).
+Runs VolumeSDF.forward with gradient, feature and Laplacian followed by a backward pass, as in training with
+grad_type=finite_difference and the curvature loss, and reports samples/s for the central and tetrahedral stencils.
+The encoding and network follow neuralangelo-dtu-wmask.yaml (tcnn on GPU, the pure-torch hash grid on CPU).
+Run from the repository root:
+    python scripts/bench_finite_difference.py --n_samples 262144 --n_iters 20
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import models
+from nerfacc import ContractionType
+
+
+def make_geometry(stencil, device):
+    config = OmegaConf.load(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'neuralangelo-dtu-wmask.yaml'))
+    config = OmegaConf.create(OmegaConf.to_container(config.model.geometry, resolve=False))
+    config.radius = 1.0
+    config.finite_difference_eps = 1e-3
+    config.finite_difference_stencil = stencil
+    if device.type != 'cuda':
+        config.xyz_encoding_config.backend = 'torch'
+    geometry = models.make('volume-sdf', config).to(device)
+    geometry.contraction_type = ContractionType.AABB
+    geometry.update_step(0, 0)
+    return geometry.train()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(geometry, points, n_iters, device):
+    for it in range(n_iters + 1):
+        if it == 1:
+            synchronize(device)
+            t0 = time.perf_counter()
+        sdf, sdf_grad, feature, sdf_laplace = geometry(points, with_grad=True, with_feature=True, with_laplace=True)
+        loss = sdf.abs().mean() + (sdf_grad.norm(dim=-1) - 1.).pow(2).mean() + sdf_laplace.abs().mean() + feature.mean()
+        loss.backward()
+    synchronize(device)
+    return n_iters * len(points) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=262144)
+    parser.add_argument('--n_iters', type=int, default=20)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    points = (torch.rand(args.n_samples, 3, device=device) * 2. - 1.) * 0.8
+    for stencil, n_evals in [('central', 7), ('tetrahedral', 5)]:
+        geometry = make_geometry(stencil, device)
+        samples_per_sec = run(geometry, points, args.n_iters, device)
+        print(f"{stencil:>12s} ({n_evals} evaluations per sample): {samples_per_sec:12.0f} samples/s")
+
+
+if __name__ == '__main__':
+    main()
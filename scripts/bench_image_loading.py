@@ -0,0 +1,76 @@
+"""
+Timing benchmark of the parallel image loading used in dataset setup (see datasets/utils.parallel_load).
+Writes synthetic images to a temporary directory once, then decodes, resizes and converts the first
+100/500/2000 of them serially and with a thread pool.
+Run from the repository root:
+    python scripts/bench_image_loading.py --n_images 100 500 2000 --num_workers 8
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+import torchvision.transforms.functional as TF
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.utils import parallel_load
+
+
+def write_images(image_dir, n, w, h, fmt):
+    rng = np.random.default_rng(0)
+    # smooth random images, compress like natural images unlike pure noise
+    base = rng.integers(0, 256, size=(h // 16, w // 16, 3), dtype=np.uint8)
+    base = np.asarray(Image.fromarray(base).resize((w, h), Image.BICUBIC))
+    paths = []
+    for i in range(n):
+        path = os.path.join(image_dir, f'{i:06d}.{fmt}')
+        if not os.path.exists(path):
+            img = np.roll(base, shift=i, axis=1) + rng.integers(0, 8, size=base.shape, dtype=np.uint8)
+            Image.fromarray(img).save(path)
+        paths.append(path)
+    return paths
+
+
+def load(paths, img_wh, num_workers):
+    w, h = img_wh
+    def load_image(i):
+        img = Image.open(paths[i])
+        img = img.resize(img_wh, Image.BICUBIC)
+        img = TF.to_tensor(img).permute(1, 2, 0)[...,:3]
+        return [img]
+    all_images = torch.empty((len(paths), h, w, 3), dtype=torch.float32)
+    t0 = time.perf_counter()
+    parallel_load(load_image, len(paths), [all_images], num_workers)
+    return time.perf_counter() - t0, all_images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--downscale', type=int, default=4)
+    parser.add_argument('--format', default='jpg', choices=['jpg', 'png'])
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count()))
+    parser.add_argument('--image_dir', default=None, help='directory for the synthetic images, a temporary one by default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_dir = args.image_dir or tmp_dir
+        os.makedirs(image_dir, exist_ok=True)
+        paths = write_images(image_dir, max(args.n_images), args.width, args.height, args.format)
+        img_wh = (args.width // args.downscale, args.height // args.downscale)
+        for n in args.n_images:
+            t_serial, images_serial = load(paths[:n], img_wh, num_workers=1)
+            t_parallel, images_parallel = load(paths[:n], img_wh, num_workers=args.num_workers)
+            assert torch.equal(images_serial, images_parallel)
+            print(f"{n:5d} images: serial {t_serial:7.2f} s, {args.num_workers} workers {t_parallel:7.2f} s, speedup {t_serial / t_parallel:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
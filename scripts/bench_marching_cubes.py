@@ -0,0 +1,51 @@
+"""
+Wall-time benchmark of the block-parallel CPU marching cubes (see models/geometry.MarchingCubeHelper.forward_parallel).
+Extracts the surface of an analytic SDF volume (a torus with surface noise) with a single mcubes call and with
+blocks on a pool of worker processes, and checks that both meshes have the same number of triangles.
+Run from the repository root:
+    python scripts/bench_marching_cubes.py --resolution 512 --num_workers 8 --block_size 128
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.geometry import MarchingCubeHelper
+
+
+def make_level(helper, chunk=2**22):
+    level = helper.empty_level()
+    level_flat = level.view(-1)
+    for start in range(0, helper.resolution**3, chunk):
+        end = min(start + chunk, helper.resolution**3)
+        x = helper.grid_vertices(start, end) * 2. - 1.
+        q = torch.stack([x[...,:2].norm(dim=-1) - 0.5, x[...,2]], dim=-1)
+        level_flat[start:end] = q.norm(dim=-1) - 0.2 + 0.01 * torch.sin(40. * x).prod(dim=-1)
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', type=int, default=512)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--block_size', type=int, default=128)
+    args = parser.parse_args()
+
+    results = {}
+    for num_workers in [1, args.num_workers]:
+        helper = MarchingCubeHelper(args.resolution, use_torch=False, num_workers=num_workers, block_size=args.block_size)
+        level = make_level(helper)
+        t0 = time.perf_counter()
+        mesh = helper(level, threshold=0., inplace=True)
+        results[num_workers] = (time.perf_counter() - t0, mesh)
+        print(f"{num_workers:3d} worker(s): {results[num_workers][0]:7.2f} s, {len(mesh['v_pos'])} vertices, {len(mesh['t_pos_idx'])} triangles")
+    assert len(results[1][1]['t_pos_idx']) == len(results[args.num_workers][1]['t_pos_idx'])
+    print(f"speedup {results[1][0] / results[args.num_workers][0]:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
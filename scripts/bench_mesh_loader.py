@@ -0,0 +1,127 @@
+"""
+Load-time benchmark of the vectorized mesh loader (see utils/obj.load_obj and utils/ply.load_ply) against the
+previous line-by-line OBJ loader, on a random mesh written with utils/obj.write_obj and utils/ply.write_ply.
+The loaded arrays are compared with the previous loader and with the written mesh.
+Run from the repository root:
+    python scripts/bench_mesh_loader.py --n_faces 1000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.obj import load_obj, write_obj
+from utils.ply import write_ply
+
+
+def load_obj_per_line(filename):
+    # the previous utils/obj.load_obj
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+
+    vertices, texcoords  = [], []
+    for line in lines:
+        if len(line.split()) == 0:
+            continue
+        prefix = line.split()[0].lower()
+        if prefix == 'v':
+            vertices.append([float(v) for v in line.split()[1:]])
+        elif prefix == 'vt':
+            val = [float(v) for v in line.split()[1:]]
+            texcoords.append([val[0], 1.0 - val[1]])
+
+    uv = len(texcoords) > 0
+    faces, tfaces = [], []
+    for line in lines:
+        if len(line.split()) == 0:
+            continue
+        prefix = line.split()[0].lower()
+        if prefix == 'f':
+            vs = line.split()[1:]
+            nv = len(vs)
+            vv = vs[0].split('/')
+            v0 = int(vv[0]) - 1
+            if uv:
+                t0 = int(vv[1]) - 1 if vv[1] != "" else -1
+            for i in range(nv - 2):
+                vv1 = vs[i + 1].split('/')
+                v1 = int(vv1[0]) - 1
+                vv2 = vs[i + 2].split('/')
+                v2 = int(vv2[0]) - 1
+                faces.append([v0, v1, v2])
+                if uv:
+                    t1 = int(vv1[1]) - 1 if vv1[1] != "" else -1
+                    t2 = int(vv2[1]) - 1 if vv2[1] != "" else -1
+                    tfaces.append([t0, t1, t2])
+    vertices = np.array(vertices, dtype=np.float32)
+    faces = np.array(faces, dtype=np.int64)
+    if uv:
+        texcoords = np.array(texcoords, dtype=np.float32)
+        tfaces = np.array(tfaces, dtype=np.int64)
+    else:
+        texcoords, tfaces = None, None
+    return vertices, faces, texcoords, tfaces
+
+
+def timed(load, path):
+    t0 = time.perf_counter()
+    out = load(path)
+    return time.perf_counter() - t0, out
+
+
+def assert_same(a, b):
+    for x, y in zip(a, b):
+        assert (x is None and y is None) or (x.dtype == y.dtype and np.array_equal(x, y))
+
+
+def check_polygons(tmp_dir):
+    # quads, v//vn records and mixed index formats, compared with the previous loader
+    path = os.path.join(tmp_dir, 'polygons.obj')
+    with open(path, 'w') as f:
+        f.write('# comment\nv 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nv 0 0 1\nvn 0 0 1\nvt 0 0\nvt 1 0\nvt 1 1\n')
+        f.write('f 1/1 2/2 3/3 4/1\nf 1//1 2//1 5//1\r\nf 2/3/1 3/2/1 5/1/1\nf  1/1/1\t4/2 5//1 \n')
+    assert_same(load_obj(path), load_obj_per_line(path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_faces', type=int, default=1000000)
+    parser.add_argument('--skip_slow', action='store_true', help='skip the previous loader')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n_verts = args.n_faces // 2
+    v_pos = rng.random((n_verts, 3), dtype=np.float32) * 2. - 1.
+    t_pos_idx = rng.integers(0, n_verts, (args.n_faces, 3))
+    v_tex = rng.random((n_verts, 2), dtype=np.float32)
+    t_tex_idx = rng.integers(0, n_verts, (args.n_faces, 3))
+
+    meshes = [
+        ('obj', 'positions', lambda path: write_obj(path, v_pos, t_pos_idx)),
+        ('obj', 'positions + texcoords', lambda path: write_obj(path, v_pos, t_pos_idx, v_tex=v_tex, t_tex_idx=t_tex_idx)),
+        ('ply', 'binary positions', lambda path: write_ply(path, v_pos, t_pos_idx)),
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        check_polygons(tmp_dir)
+        for ext, name, write in meshes:
+            path = os.path.join(tmp_dir, f'mesh.{ext}')
+            write(path)
+            t_new, (vertices, faces, texcoords, tfaces) = timed(load_obj, path)
+            assert np.array_equal(vertices, v_pos) and np.array_equal(faces, t_pos_idx)
+            if texcoords is not None:
+                assert np.array_equal(tfaces, t_tex_idx) and np.abs(texcoords - v_tex).max() <= 1e-6
+            line = f"{ext} {name:>22s}: load_obj {t_new:7.2f} s"
+            if ext == 'obj' and not args.skip_slow:
+                t_old, out_old = timed(load_obj_per_line, path)
+                assert_same((vertices, faces, texcoords, tfaces), out_old)
+                line += f", previous loader {t_old:7.2f} s ({t_old / t_new:5.1f}x)"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
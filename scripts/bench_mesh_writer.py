@@ -0,0 +1,91 @@
+"""
+Write-time benchmark of the vectorized mesh writers (see utils/obj.write_obj and utils/ply.write_ply) against the
+previous per-line OBJ writer and trimesh export, on a random mesh with vertex colors.
+The written files are read back with trimesh and compared with the input (round trip).
+Run from the repository root:
+    python scripts/bench_mesh_writer.py --n_faces 1000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.obj import write_obj
+from utils.ply import write_ply
+
+
+def write_obj_per_line(filename, v_pos, t_pos_idx):
+    # the previous utils/obj.write_obj
+    with open(filename, "w") as f:
+        for v in v_pos:
+            f.write('v {} {} {} \n'.format(v[0], v[1], v[2]))
+        for i in range(len(t_pos_idx)):
+            f.write("f ")
+            for j in range(3):
+                f.write(' %s/%s' % (str(t_pos_idx[i][j]+1), ''))
+            f.write("\n")
+
+
+def write_trimesh(filename, v_pos, t_pos_idx, v_rgb):
+    # the previous SaverMixin.save_mesh
+    import trimesh
+    trimesh.Trimesh(vertices=v_pos, faces=t_pos_idx, vertex_colors=v_rgb).export(filename)
+
+
+def load(filename):
+    import trimesh
+    mesh = trimesh.load(filename, process=False, maintain_order=True)
+    return np.asarray(mesh.vertices), np.asarray(mesh.faces), np.asarray(mesh.visual.vertex_colors)[:,:3]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_faces', type=int, default=1000000)
+    parser.add_argument('--skip_slow', action='store_true', help='skip the per-line writer and trimesh export')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n_verts = args.n_faces // 2
+    v_pos = rng.random((n_verts, 3), dtype=np.float32) * 2. - 1.
+    # every vertex referenced, so that readers dropping unreferenced vertices keep them all
+    t_pos_idx = rng.permutation(np.arange(args.n_faces * 3) % n_verts).reshape(-1, 3)
+    v_rgb = rng.random((n_verts, 3), dtype=np.float32)
+    v_rgb_uint8 = np.round(v_rgb * 255.).astype(np.uint8)
+
+    writers = [
+        ('obj', 'write_obj', lambda path: write_obj(path, v_pos, t_pos_idx, v_rgb=v_rgb)),
+        ('obj', 'write_obj precision=5', lambda path: write_obj(path, v_pos, t_pos_idx, v_rgb=v_rgb, precision=5)),
+        ('ply', 'write_ply', lambda path: write_ply(path, v_pos, t_pos_idx, v_rgb=v_rgb)),
+    ]
+    if not args.skip_slow:
+        writers = [
+            ('obj', 'per-line write_obj', lambda path: write_obj_per_line(path, v_pos, t_pos_idx)),
+            ('obj', 'trimesh export', lambda path: write_trimesh(path, v_pos, t_pos_idx, v_rgb)),
+            ('ply', 'trimesh export', lambda path: write_trimesh(path, v_pos, t_pos_idx, v_rgb)),
+        ] + writers
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, (ext, name, write) in enumerate(writers):
+            path = os.path.join(tmp_dir, f'{i}.{ext}')
+            t0 = time.perf_counter()
+            write(path)
+            t = time.perf_counter() - t0
+            size = os.path.getsize(path) / 2**20
+            print(f"{ext} {name:>24s}: {t:7.2f} s, {size:8.1f} MB")
+            if name.startswith('write_'):
+                verts, faces, colors = load(path)
+                if 'precision' in name:
+                    assert np.abs(verts - v_pos).max() <= 0.5e-5 + 1e-7
+                else:
+                    assert np.array_equal(verts.astype(np.float32), v_pos)
+                assert np.array_equal(faces, t_pos_idx)
+                assert np.abs(colors.astype(np.int64) - v_rgb_uint8).max() <= 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Steps-to-PSNR benchmark of the pixel samplers (see systems/samplers.py).
+Fits a hash grid + MLP to a set of synthetic images made of flat regions and a small high-frequency patch,
+and reports the number of steps each sampler needs to reach the target PSNR over all pixels.
+Run from the repository root:
+    python scripts/bench_pixel_sampler.py --n_rays 1024 --target_psnr 30
+"""
+
+import os
+import sys
+import math
+import time
+import argparse
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.network_utils import get_encoding_with_network
+from systems import samplers
+
+
+ENCODING_CONFIG = {
+    'otype': 'HashGridTorch',
+    'n_levels': 12,
+    'n_features_per_level': 2,
+    'log2_hashmap_size': 17,
+    'base_resolution': 8,
+    'per_level_scale': 1.4,
+}
+
+NETWORK_CONFIG = {
+    'otype': 'VanillaMLP',
+    'activation': 'ReLU',
+    'output_activation': 'Sigmoid',
+    'n_neurons': 64,
+    'n_hidden_layers': 1,
+}
+
+
+def make_images(n_images, h, w):
+    y, x = torch.meshgrid(torch.linspace(0, 1, h), torch.linspace(0, 1, w), indexing='ij')
+    images = []
+    for i in range(n_images):
+        color = torch.stack([0.2 + 0.6 * x, 0.3 + 0.4 * y, torch.full_like(x, 0.1 * (i + 1))], dim=-1)
+        # small textured patch covering a few percent of the image
+        patch = (x > 0.6) & (x < 0.8) & (y > 0.2 + 0.1 * i / n_images) & (y < 0.4 + 0.1 * i / n_images)
+        stripes = 0.5 + 0.5 * torch.sin(300 * x + 200 * y + i)[...,None] * torch.tensor([1., -1., 0.5])
+        images.append(torch.where(patch[...,None], stripes, color))
+    return torch.stack(images, dim=0)
+
+
+def coords(index, y, x, n_images, h, w):
+    return torch.stack([(x.float() + 0.5) / w, (y.float() + 0.5) / h, (index.float() + 0.5) / n_images], dim=-1)
+
+
+def run(sampler_config, images, args):
+    torch.manual_seed(0)
+    n_images, h, w = images.shape[:3]
+    dataset = SimpleNamespace(all_images=images, h=h, w=w)
+    sampler = samplers.make(sampler_config.name, sampler_config, dataset)
+    model = get_encoding_with_network(3, 3, OmegaConf.create(ENCODING_CONFIG), OmegaConf.create(NETWORK_CONFIG))
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+
+    all_index, all_y, all_x = torch.meshgrid(torch.arange(n_images), torch.arange(h), torch.arange(w), indexing='ij')
+    all_coords = coords(all_index.reshape(-1), all_y.reshape(-1), all_x.reshape(-1), n_images, h, w)
+    t0 = time.perf_counter()
+    for step in range(1, args.max_steps + 1):
+        index, y, x = sampler.sample(args.n_rays)
+        index = index.expand_as(x)
+        rgb = images[index, y, x]
+        pred = model(coords(index, y, x, n_images, h, w)).float()
+        loss = F.l1_loss(pred, rgb)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        sampler.update((index * h + y) * w + x, (pred - rgb).detach().abs().mean(-1))
+        if step % args.eval_every == 0:
+            with torch.no_grad():
+                mse = F.mse_loss(model(all_coords).float(), images.view(-1, 3)).item()
+            psnr = -10. * math.log10(mse)
+            if psnr >= args.target_psnr:
+                return step, psnr, time.perf_counter() - t0
+    return None, psnr, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=4)
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--n_rays', type=int, default=1024)
+    parser.add_argument('--target_psnr', type=float, default=30.)
+    parser.add_argument('--max_steps', type=int, default=3000)
+    parser.add_argument('--eval_every', type=int, default=25)
+    parser.add_argument('--update_every', type=int, default=50)
+    args = parser.parse_args()
+
+    images = make_images(args.n_images, args.resolution, args.resolution)
+    for sampler_config in [
+        {'name': 'uniform'},
+        {'name': 'importance', 'update_every': args.update_every, 'uniform_ratio': 0.2},
+    ]:
+        steps, psnr, t = run(OmegaConf.create(sampler_config), images, args)
+        steps = f"{steps:6d}" if steps is not None else f">{args.max_steps}"
+        print(f"{sampler_config['name']:>10s}: {steps} steps to {args.target_psnr:.1f} dB (final {psnr:.2f} dB, {t:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Step-time benchmark of the level skipping in ProgressiveBandHashGrid (see models/network_utils.py) across the level schedule.
+For each number of active levels, times forward + backward of the encoding followed by a small MLP, evaluating
+all levels and masking (the previous behavior) against evaluating only the active levels, and checks that both agree.
+Uses the encoding of neuralangelo-dtu-wmask.yaml with the pure-torch backend.
+Run from the repository root:
+    python scripts/bench_progressive_hashgrid.py --n_points 65536 --n_iters 5
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.network_utils import get_encoding, get_mlp
+
+
+MLP_CONFIG = {
+    'otype': 'VanillaMLP',
+    'activation': 'ReLU',
+    'output_activation': 'none',
+    'n_neurons': 64,
+    'n_hidden_layers': 1,
+}
+
+
+def timed_steps(encode, network, x, n_iters):
+    for it in range(n_iters + 1):
+        if it == 1:
+            t0 = time.perf_counter()
+        out = network(encode(x))
+        out.sum().backward()
+    return (time.perf_counter() - t0) / n_iters, out.detach()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_points', type=int, default=65536)
+    parser.add_argument('--n_iters', type=int, default=5)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'neuralangelo-dtu-wmask.yaml'))
+    encoding_config = config.model.geometry.xyz_encoding_config
+    encoding_config.backend = 'torch'
+    encoding_config.include_xyz = False
+    encoding = get_encoding(3, encoding_config)
+    grid = encoding.encoding
+    network = get_mlp(encoding.n_output_dims, 1, OmegaConf.create(MLP_CONFIG))
+
+    x = torch.rand(args.n_points, 3)
+    masked = lambda x: grid.encoding(x) * grid.mask
+    for step in range(0, (grid.n_level - grid.start_level + 1) * grid.update_steps, grid.update_steps):
+        encoding.update_step(0, step)
+        t_masked, out_masked = timed_steps(masked, network, x, args.n_iters)
+        t_skipped, out_skipped = timed_steps(encoding, network, x, args.n_iters)
+        assert torch.allclose(out_masked, out_skipped, atol=1e-6)
+        print(f"step {step:6d}, {grid.current_level:2d}/{grid.n_level} levels: all levels + mask {t_masked * 1000:8.1f} ms, active levels only {t_skipped * 1000:8.1f} ms ({t_masked / t_skipped:4.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
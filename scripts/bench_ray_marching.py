@@ -0,0 +1,80 @@
+"""
+Samples/s benchmark of the volume rendering backends (see models/rendering.py) on a synthetic sphere scene.
+The nerfacc backend is only timed when CUDA is available.
+Run from the repository root:
+    python scripts/bench_ray_marching.py --n_rays 4096
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.rendering import get_render_backend
+from nerfacc import ContractionType
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(backend, device, args):
+    radius = 1.0
+    scene_aabb = torch.as_tensor([-radius, -radius, -radius, radius, radius, radius], dtype=torch.float32, device=device)
+    render_step_size = 1.732 * 2 * radius / args.num_samples_per_ray
+    grid = backend.OccupancyGrid(roi_aabb=scene_aabb, resolution=128, contraction_type=ContractionType.AABB).to(device)
+    sphere_sdf = lambda x: x.norm(dim=-1, keepdim=True) - 0.5
+    grid.train()
+    grid.every_n_step(step=0, occ_eval_fn=lambda x: torch.sigmoid(-sphere_sdf(x) * 100.), occ_thre=0.01)
+
+    torch.manual_seed(0)
+    rays_o = F.normalize(torch.randn(args.n_rays, 3, device=device), dim=-1) * 3.
+    rays_d = F.normalize(-rays_o + 0.5 * torch.randn(args.n_rays, 3, device=device), dim=-1)
+
+    def render():
+        ray_indices, t_starts, t_ends = backend.ray_marching(
+            rays_o, rays_d, scene_aabb=scene_aabb, grid=grid,
+            render_step_size=render_step_size, stratified=False, cone_angle=0.0, alpha_thre=0.0
+        )
+        ray_indices = ray_indices.long()
+        midpoints = (t_starts + t_ends) / 2.
+        positions = rays_o[ray_indices] + rays_d[ray_indices] * midpoints
+        alpha = torch.sigmoid(-sphere_sdf(positions) * 50.)
+        weights = backend.render_weight_from_alpha(alpha, ray_indices=ray_indices, n_rays=args.n_rays)
+        opacity = backend.accumulate_along_rays(weights, ray_indices, values=None, n_rays=args.n_rays)
+        return len(ray_indices), opacity
+
+    render()
+    synchronize(device)
+    t0 = time.perf_counter()
+    n_samples = 0
+    for _ in range(args.n_iters):
+        n, _ = render()
+        n_samples += n
+    synchronize(device)
+    t = (time.perf_counter() - t0) / args.n_iters
+    return t, n_samples / args.n_iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rays', type=int, default=4096)
+    parser.add_argument('--num_samples_per_ray', type=int, default=1024)
+    parser.add_argument('--n_iters', type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [('torch', torch.device('cpu'))]
+    if torch.cuda.is_available():
+        runs += [('torch', torch.device('cuda')), ('nerfacc', torch.device('cuda'))]
+    for name, device in runs:
+        t, n_samples = benchmark(get_render_backend(name), device, args)
+        print(f"{name:>8s} ({device.type}): {t * 1e3:8.2f} ms/iter, {n_samples:10.0f} samples/iter, {n_samples / t / 1e6:8.2f} M samples/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Checks that the occupancy grids saved with the model weights (see models/rendering.OccupancyGridState) are reused after loading:
+a few training steps in the order of the trainer (grid update at the start of the batch, optimizer step, then the checkpoint),
+then the saved state dict is loaded into a new model, whose grids must not be stale. The same grids with other weights must be.
+Run from the repository root:
+    python scripts/check_grid_checkpoint.py --config configs/neus-dtu.yaml --n_steps 20
+Extra arguments override the config as in launch.py, e.g. model.render_backend=torch to run without CUDA.
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import models
+from utils.misc import load_config
+
+
+def grid_states(model):
+    return {name: state for name, state in [
+        ('occupancy_grid', getattr(model, 'occupancy_grid_state', None)),
+        ('occupancy_grid_bg', getattr(model, 'occupancy_grid_bg_state', None))
+    ] if state is not None}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--n_steps', type=int, default=20)
+    parser.add_argument('--n_rays', type=int, default=256)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args, extras = parser.parse_known_args()
+
+    config = load_config(args.config, cli_args=extras)
+    torch.manual_seed(0)
+    model = models.make(config.model.name, config.model).to(args.device)
+    model.background_color = torch.ones((3,), dtype=torch.float32, device=args.device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+    rgb_key = 'comp_rgb_full' if config.model.name == 'neus' else 'comp_rgb'
+    model.train()
+    for step in range(args.n_steps):
+        model.update_step(0, step)
+        rays_o = F.normalize(torch.randn(args.n_rays, 3, device=args.device), dim=-1) * config.model.radius * 2
+        rays_d = F.normalize(-rays_o + torch.randn_like(rays_o) * 0.2 * config.model.radius, dim=-1)
+        out = model(torch.cat([rays_o, rays_d], dim=-1))
+        loss = (out[rgb_key] - 0.5).abs().mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+
+    restored = models.make(config.model.name, config.model).to(args.device)
+    restored.load_state_dict(state_dict)
+    for name, state in grid_states(restored).items():
+        assert not state.is_stale(), f"{name} saved after a training step is stale after loading"
+        assert torch.equal(getattr(restored, name).binary, getattr(model, name).binary)
+        print(f"{name}: reused after loading")
+
+    # the saved grids with weights they were not built from
+    replaced = {k: v + 0.05 if k.startswith('geometry') and v.is_floating_point() else v for k, v in state_dict.items()}
+    restored = models.make(config.model.name, config.model).to(args.device)
+    restored.load_state_dict(replaced)
+    stale = {name: state.is_stale() for name, state in grid_states(restored).items()}
+    assert all(stale.values()), f"grids loaded with replaced weights are not stale: {stale}"
+    print("grids loaded with replaced weights are stale")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Helpers of the scripts that evaluate a trained checkpoint on the test views
+(bake_neus.py, bench_color_gating.py, bench_early_termination.py).
+Imported by the scripts after they add the repository root to sys.path.
+"""
+
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.ray_utils import get_rays
+import datasets
+import systems
+from datasets.utils import to_float
+from systems.criterions import PSNR
+from utils.misc import load_config
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timed(fn, device, *args, **kwargs):
+    # output of fn and its wall time, the device is synchronized before and after
+    synchronize(device)
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    synchronize(device)
+    return out, time.perf_counter() - t0
+
+
+def load_checkpoint(config_path, ckpt_path, cli_args, device):
+    """
+    Loads the config (cli_args override it as in launch.py) and the checkpoint.
+    Returns the config, the system and its model in eval mode on device, updated to the step of the checkpoint.
+    """
+    config = load_config(config_path, cli_args=cli_args)
+    system = systems.make(config.system.name, config)
+    ckpt = torch.load(ckpt_path, map_location='cpu')
+    system.load_state_dict(ckpt['state_dict'], strict=False)
+    model = system.model.to(device).eval()
+    model.update_step(ckpt.get('epoch', 0), ckpt.get('global_step', 0))
+    return config, system, model
+
+
+def test_views(config, n_views, background_color):
+    """
+    Yields the index, the normalized rays (N_rays, 6) and the ground truth colors (N_rays, 3) of the first n_views test views,
+    on CPU. Ground truth colors are composited on background_color when the dataset applies its masks.
+    """
+    dm = datasets.make(config.dataset.name, config.dataset)
+    dm.setup('test')
+    dataset = dm.test_dataloader().dataset
+    background_color = background_color.cpu()
+    for index in range(min(n_views, len(dataset.all_c2w))):
+        directions = dataset.directions if dataset.directions.ndim == 3 else dataset.directions[index]
+        rays_o, rays_d = get_rays(directions.cpu(), dataset.all_c2w[index].cpu())
+        rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
+        rgb = to_float(dataset.all_images[index].view(-1, 3).cpu())
+        if dataset.apply_mask:
+            fg_mask = to_float(dataset.all_fg_masks[index].view(-1).cpu())
+            rgb = rgb * fg_mask[...,None] + background_color * (1 - fg_mask[...,None])
+        yield index, rays, rgb
+
+
+def psnr(rgb, rgb_ref):
+    return PSNR()(rgb.cpu(), rgb_ref.cpu()).item()
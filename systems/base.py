@@ -1,6 +1,9 @@
+import torch
 import pytorch_lightning as pl
+from omegaconf import OmegaConf
 
 import models
+from systems import samplers
 from systems.utils import parse_optimizer, parse_scheduler, update_module_step
 from utils.mixins import SaverMixin
 from utils.misc import config_to_primitive, get_rank
@@ -43,10 +46,26 @@ class BaseSystem(pl.LightningModule, SaverMixin):
                 current_step = self.current_epoch
                 value = start_value + (end_value - start_value) * max(min(1.0, (current_step - start_step) / (end_step - start_step)), 0.0)
         return value
-    
+
+    def samples_saved(self, out):
+        # fraction of the marched samples of an image that early ray termination did not evaluate (model.early_stop_eps)
+        if 'num_samples_marched' not in out:
+            return torch.zeros((), device=out['num_samples'].device)
+        return 1. - out['num_samples'].sum().float() / out['num_samples_marched'].sum().clamp(min=1)
+
     def preprocess_data(self, batch, stage):
         pass
 
+    def get_pixel_sampler(self):
+        # built lazily as the training dataset is only available once training starts
+        if getattr(self, 'pixel_sampler', None) is None:
+            sampler_config = OmegaConf.merge(
+                {'name': 'uniform', 'batch_image_sampling': self.config.model.batch_image_sampling},
+                self.config.system.get('pixel_sampler', {})
+            )
+            self.pixel_sampler = samplers.make(sampler_config.name, sampler_config, self.dataset)
+        return self.pixel_sampler
+
     """
     Implementing on_after_batch_transfer of DataModule does the same.
     But on_after_batch_transfer does not support DP.
@@ -8,6 +8,7 @@ from pytorch_lightning.utilities.rank_zero import rank_zero_info, rank_zero_debu
 
 import models
 from models.ray_utils import get_rays
+from datasets.utils import get_ray_cache, to_float
 import systems
 from systems.base import BaseSystem
 from systems.criterions import PSNR
@@ -34,25 +35,23 @@ class NeRFSystem(BaseSystem):
         if 'index' in batch: # validation / testing
             index = batch['index']
         else:
-            if self.config.model.batch_image_sampling:
-                index = torch.randint(0, len(self.dataset.all_images), size=(self.train_num_rays,), device=self.dataset.all_images.device)
-            else:
-                index = torch.randint(0, len(self.dataset.all_images), size=(1,), device=self.dataset.all_images.device)
+            index, y, x = self.get_pixel_sampler().sample(self.train_num_rays)
         if stage in ['train']:
-            c2w = self.dataset.all_c2w[index]
-            x = torch.randint(
-                0, self.dataset.w, size=(self.train_num_rays,), device=self.dataset.all_images.device
-            )
-            y = torch.randint(
-                0, self.dataset.h, size=(self.train_num_rays,), device=self.dataset.all_images.device
-            )
-            if self.dataset.directions.ndim == 3: # (H, W, 3)
-                directions = self.dataset.directions[y, x]
-            elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
-                directions = self.dataset.directions[index, y, x]
-            rays_o, rays_d = get_rays(directions, c2w)
-            rgb = self.dataset.all_images[index, y, x].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index, y, x].view(-1).to(self.rank)
+            pixel_index = (index * self.dataset.h + y) * self.dataset.w + x
+            if self.config.dataset.get('ray_cache', None):
+                # single gather over the flat pixel index
+                rays_o, rays_d = get_ray_cache(self.dataset)(pixel_index)
+                rgb = to_float(self.dataset.all_images.view(-1, self.dataset.all_images.shape[-1])[pixel_index].to(self.rank))
+                fg_mask = to_float(self.dataset.all_fg_masks.view(-1)[pixel_index].to(self.rank))
+            else:
+                c2w = self.dataset.all_c2w[index]
+                if self.dataset.directions.ndim == 3: # (H, W, 3)
+                    directions = self.dataset.directions[y, x]
+                elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
+                    directions = self.dataset.directions[index, y, x]
+                rays_o, rays_d = get_rays(directions, c2w)
+                rgb = to_float(self.dataset.all_images[index, y, x].view(-1, self.dataset.all_images.shape[-1]).to(self.rank))
+                fg_mask = to_float(self.dataset.all_fg_masks[index, y, x].view(-1).to(self.rank))
         else:
             c2w = self.dataset.all_c2w[index][0]
             if self.dataset.directions.ndim == 3: # (H, W, 3)
@@ -60,8 +59,8 @@ class NeRFSystem(BaseSystem):
             elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
                 directions = self.dataset.directions[index][0]
             rays_o, rays_d = get_rays(directions, c2w)
-            rgb = self.dataset.all_images[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index].view(-1).to(self.rank)
+            rgb = to_float(self.dataset.all_images[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank))
+            fg_mask = to_float(self.dataset.all_fg_masks[index].view(-1).to(self.rank))
         
         rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
 
@@ -83,6 +82,10 @@ class NeRFSystem(BaseSystem):
             'rgb': rgb,
             'fg_mask': fg_mask
         })
+        if stage in ['train']:
+            batch.update({
+                'pixel_index': pixel_index
+            })
     
     def training_step(self, batch, batch_idx):
         out = self(batch)
@@ -93,6 +96,9 @@ class NeRFSystem(BaseSystem):
         if self.config.model.dynamic_ray_sampling:
             train_num_rays = int(self.train_num_rays * (self.train_num_samples / out['num_samples'].sum().item()))        
             self.train_num_rays = min(int(self.train_num_rays * 0.9 + train_num_rays * 0.1), self.config.model.max_train_num_rays)
+
+        # per-pixel errors drive error-based pixel samplers
+        self.get_pixel_sampler().update(batch['pixel_index'], (out['comp_rgb'] - batch['rgb']).detach().abs().mean(-1))
         
         loss_rgb = F.smooth_l1_loss(out['comp_rgb'][out['rays_valid'][...,0]], batch['rgb'][out['rays_valid'][...,0]])
         self.log('train/loss_rgb', loss_rgb)
@@ -145,6 +151,7 @@ class NeRFSystem(BaseSystem):
         ])
         return {
             'psnr': psnr,
+            'samples_saved': self.samples_saved(out).to(psnr),
             'index': batch['index']
         }
           
@@ -162,13 +169,14 @@ class NeRFSystem(BaseSystem):
             for step_out in out:
                 # DP
                 if step_out['index'].ndim == 1:
-                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr']}
+                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr'], 'samples_saved': step_out['samples_saved']}
                 # DDP
                 else:
                     for oi, index in enumerate(step_out['index']):
-                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi]}
+                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi], 'samples_saved': step_out['samples_saved'][oi]}
             psnr = torch.mean(torch.stack([o['psnr'] for o in out_set.values()]))
-            self.log('val/psnr', psnr, prog_bar=True, rank_zero_only=True)         
+            self.log('val/psnr', psnr, prog_bar=True, rank_zero_only=True)
+            self.log('val/samples_saved', torch.mean(torch.stack([o['samples_saved'] for o in out_set.values()])), rank_zero_only=True)         
 
     def test_step(self, batch, batch_idx):  
         out = self(batch)
@@ -182,6 +190,7 @@ class NeRFSystem(BaseSystem):
         ])
         return {
             'psnr': psnr,
+            'samples_saved': self.samples_saved(out).to(psnr),
             'index': batch['index']
         }      
     
@@ -192,13 +201,14 @@ class NeRFSystem(BaseSystem):
             for step_out in out:
                 # DP
                 if step_out['index'].ndim == 1:
-                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr']}
+                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr'], 'samples_saved': step_out['samples_saved']}
                 # DDP
                 else:
                     for oi, index in enumerate(step_out['index']):
-                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi]}
+                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi], 'samples_saved': step_out['samples_saved'][oi]}
             psnr = torch.mean(torch.stack([o['psnr'] for o in out_set.values()]))
-            self.log('test/psnr', psnr, prog_bar=True, rank_zero_only=True)    
+            self.log('test/psnr', psnr, prog_bar=True, rank_zero_only=True)
+            self.log('test/samples_saved', torch.mean(torch.stack([o['samples_saved'] for o in out_set.values()])), rank_zero_only=True)    
 
             self.save_img_sequence(
                 f"it{self.global_step}-test",
@@ -213,6 +223,6 @@ class NeRFSystem(BaseSystem):
     def export(self):
         mesh = self.model.export(self.config.export)
         self.save_mesh(
-            f"it{self.global_step}-{self.config.model.geometry.isosurface.method}{self.config.model.geometry.isosurface.resolution}.obj",
+            f"it{self.global_step}-{self.config.model.geometry.isosurface.method}{self.config.model.geometry.isosurface.resolution}.{self.config.export.get('format', 'obj')}",
             **mesh
         )    
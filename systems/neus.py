@@ -9,6 +9,7 @@ from pytorch_lightning.utilities.rank_zero import rank_zero_info, rank_zero_debu
 import models
 from models.utils import cleanup
 from models.ray_utils import get_rays
+from datasets.utils import get_ray_cache, to_float
 import systems
 from systems.base import BaseSystem
 from systems.criterions import PSNR, binary_cross_entropy
@@ -31,30 +32,41 @@ class NeuSSystem(BaseSystem):
 
     def forward(self, batch):
         return self.model(batch['rays'])
+
+    def forward_stream(self, batch, keys=('comp_rgb_full', 'num_samples', 'num_samples_marched')):
+        # evaluation streamed chunk by chunk (NeuSModel.forward_stream), only the outputs in keys are kept on CPU
+        n_rays, out = batch['rays'].shape[0], {}
+        for start, end, out_chunk in self.model.forward_stream(batch['rays'], keys=keys):
+            for k, v in out_chunk.items():
+                if k.startswith('num_samples'):
+                    out[k] = out.get(k, 0) + v.sum()
+                elif k in keys:
+                    if k not in out:
+                        out[k] = torch.empty((n_rays, *v.shape[1:]), dtype=v.dtype)
+                    out[k][start:end] = v
+        return out
     
     def preprocess_data(self, batch, stage):
         if 'index' in batch: # validation / testing
             index = batch['index']
         else:
-            if self.config.model.batch_image_sampling:
-                index = torch.randint(0, len(self.dataset.all_images), size=(self.train_num_rays,), device=self.dataset.all_images.device)
-            else:
-                index = torch.randint(0, len(self.dataset.all_images), size=(1,), device=self.dataset.all_images.device)
+            index, y, x = self.get_pixel_sampler().sample(self.train_num_rays)
         if stage in ['train']:
-            c2w = self.dataset.all_c2w[index]
-            x = torch.randint(
-                0, self.dataset.w, size=(self.train_num_rays,), device=self.dataset.all_images.device
-            )
-            y = torch.randint(
-                0, self.dataset.h, size=(self.train_num_rays,), device=self.dataset.all_images.device
-            )
-            if self.dataset.directions.ndim == 3: # (H, W, 3)
-                directions = self.dataset.directions[y, x]
-            elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
-                directions = self.dataset.directions[index, y, x]
-            rays_o, rays_d = get_rays(directions, c2w)
-            rgb = self.dataset.all_images[index, y, x].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index, y, x].view(-1).to(self.rank)
+            pixel_index = (index * self.dataset.h + y) * self.dataset.w + x
+            if self.config.dataset.get('ray_cache', None):
+                # single gather over the flat pixel index
+                rays_o, rays_d = get_ray_cache(self.dataset)(pixel_index)
+                rgb = to_float(self.dataset.all_images.view(-1, self.dataset.all_images.shape[-1])[pixel_index].to(self.rank))
+                fg_mask = to_float(self.dataset.all_fg_masks.view(-1)[pixel_index].to(self.rank))
+            else:
+                c2w = self.dataset.all_c2w[index]
+                if self.dataset.directions.ndim == 3: # (H, W, 3)
+                    directions = self.dataset.directions[y, x]
+                elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
+                    directions = self.dataset.directions[index, y, x]
+                rays_o, rays_d = get_rays(directions, c2w)
+                rgb = to_float(self.dataset.all_images[index, y, x].view(-1, self.dataset.all_images.shape[-1]).to(self.rank))
+                fg_mask = to_float(self.dataset.all_fg_masks[index, y, x].view(-1).to(self.rank))
         else:
             c2w = self.dataset.all_c2w[index][0]
             if self.dataset.directions.ndim == 3: # (H, W, 3)
@@ -62,8 +74,8 @@ class NeuSSystem(BaseSystem):
             elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
                 directions = self.dataset.directions[index][0] 
             rays_o, rays_d = get_rays(directions, c2w)
-            rgb = self.dataset.all_images[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index].view(-1).to(self.rank)
+            rgb = to_float(self.dataset.all_images[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank))
+            fg_mask = to_float(self.dataset.all_fg_masks[index].view(-1).to(self.rank))
 
         rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
 
@@ -84,7 +96,11 @@ class NeuSSystem(BaseSystem):
             'rays': rays,
             'rgb': rgb,
             'fg_mask': fg_mask
-        })      
+        })
+        if stage in ['train']:
+            batch.update({
+                'pixel_index': pixel_index
+            })      
     
     def training_step(self, batch, batch_idx):
         out = self(batch)
@@ -93,9 +109,13 @@ class NeuSSystem(BaseSystem):
 
         # update train_num_rays
         if self.config.model.dynamic_ray_sampling:
-            train_num_rays = int(self.train_num_rays * (self.train_num_samples / out['num_samples_full'].sum().item()))        
+            # the background samples of the rays skipped by model.bg_skip_opacity are not counted, all rays may be skipped
+            train_num_rays = int(self.train_num_rays * (self.train_num_samples / max(out['num_samples_full'].sum().item(), 1)))
             self.train_num_rays = min(int(self.train_num_rays * 0.9 + train_num_rays * 0.1), self.config.model.max_train_num_rays)
 
+        # per-pixel errors drive error-based pixel samplers
+        self.get_pixel_sampler().update(batch['pixel_index'], (out['comp_rgb_full'] - batch['rgb']).detach().abs().mean(-1))
+
         loss_rgb_mse = F.mse_loss(out['comp_rgb_full'][out['rays_valid_full'][...,0]], batch['rgb'][out['rays_valid_full'][...,0]])
         self.log('train/loss_rgb_mse', loss_rgb_mse)
         loss += loss_rgb_mse * self.C(self.config.system.loss.lambda_rgb_mse)
@@ -134,7 +154,8 @@ class NeuSSystem(BaseSystem):
             self.log('train/loss_distortion', loss_distortion)
             loss += loss_distortion * self.C(self.config.system.loss.lambda_distortion)    
 
-        if self.config.model.learned_background and self.C(self.config.system.loss.lambda_distortion_bg) > 0:
+        # no background samples when every ray skips the learned background (model.bg_skip_opacity)
+        if self.config.model.learned_background and self.C(self.config.system.loss.lambda_distortion_bg) > 0 and out['weights_bg'].numel() > 0:
             loss_distortion_bg = flatten_eff_distloss(out['weights_bg'], out['points_bg'], out['intervals_bg'], out['ray_indices_bg'])
             self.log('train/loss_distortion_bg', loss_distortion_bg)
             loss += loss_distortion_bg * self.C(self.config.system.loss.lambda_distortion_bg)        
@@ -170,7 +191,7 @@ class NeuSSystem(BaseSystem):
     """
     
     def validation_step(self, batch, batch_idx):
-        out = self(batch)
+        out = self.forward_stream(batch)
         psnr = self.criterions['psnr'](out['comp_rgb_full'].to(batch['rgb']), batch['rgb'])
         W, H = self.dataset.img_wh
         # 下面这段是把四张图片拼接成一张grid
@@ -196,6 +217,7 @@ class NeuSSystem(BaseSystem):
 
         return {
             'psnr': psnr,
+            'samples_saved': self.samples_saved(out).to(psnr),
             'index': batch['index']
         }
         
@@ -212,16 +234,17 @@ class NeuSSystem(BaseSystem):
             for step_out in out:
                 # DP
                 if step_out['index'].ndim == 1:
-                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr']}
+                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr'], 'samples_saved': step_out['samples_saved']}
                 # DDP
                 else:
                     for oi, index in enumerate(step_out['index']):
-                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi]}
+                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi], 'samples_saved': step_out['samples_saved'][oi]}
             psnr = torch.mean(torch.stack([o['psnr'] for o in out_set.values()]))
-            self.log('val/psnr', psnr, prog_bar=True, rank_zero_only=True)         
+            self.log('val/psnr', psnr, prog_bar=True, rank_zero_only=True)
+            self.log('val/samples_saved', torch.mean(torch.stack([o['samples_saved'] for o in out_set.values()])), rank_zero_only=True)         
 
     def test_step(self, batch, batch_idx):
-        out = self(batch)
+        out = self.forward_stream(batch)
         psnr = self.criterions['psnr'](out['comp_rgb_full'].to(batch['rgb']), batch['rgb'])
         W, H = self.dataset.img_wh
         # self.save_image_grid(f"it{self.global_step}-test/{batch['index'][0].item()}.png", [
@@ -243,6 +266,7 @@ class NeuSSystem(BaseSystem):
         
         return {
             'psnr': psnr,
+            'samples_saved': self.samples_saved(out).to(psnr),
             'index': batch['index']
         }      
     
@@ -257,13 +281,14 @@ class NeuSSystem(BaseSystem):
             for step_out in out:
                 # DP
                 if step_out['index'].ndim == 1:
-                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr']}
+                    out_set[step_out['index'].item()] = {'psnr': step_out['psnr'], 'samples_saved': step_out['samples_saved']}
                 # DDP
                 else:
                     for oi, index in enumerate(step_out['index']):
-                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi]}
+                        out_set[index[0].item()] = {'psnr': step_out['psnr'][oi], 'samples_saved': step_out['samples_saved'][oi]}
             psnr = torch.mean(torch.stack([o['psnr'] for o in out_set.values()]))
-            self.log('test/psnr', psnr, prog_bar=True, rank_zero_only=True)    
+            self.log('test/psnr', psnr, prog_bar=True, rank_zero_only=True)
+            self.log('test/samples_saved', torch.mean(torch.stack([o['samples_saved'] for o in out_set.values()])), rank_zero_only=True)    
 
             self.save_img_sequence(
                 f"it{self.global_step}-test",
@@ -278,6 +303,6 @@ class NeuSSystem(BaseSystem):
     def export(self):
         mesh = self.model.export(self.config.export)
         self.save_mesh(
-            f"it{self.global_step}-{self.config.model.geometry.isosurface.method}{self.config.model.geometry.isosurface.resolution}.obj",
+            f"it{self.global_step}-{self.config.model.geometry.isosurface.method}{self.config.model.geometry.isosurface.resolution}.{self.config.export.get('format', 'obj')}",
             **mesh
         )        
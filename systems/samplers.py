@@ -0,0 +1,177 @@
+import torch
+import torch.nn.functional as F
+
+from datasets.utils import to_float
+
+
+samplers = {}
+
+
+def register(name):
+    def decorator(cls):
+        samplers[name] = cls
+        return cls
+    return decorator
+
+
+def make(name, config, dataset):
+    sampler = samplers[name](config, dataset)
+    return sampler
+
+
+def build_alias_table(weights):
+    """
+    Vectorized construction of a Walker/Vose alias table from non-negative weights.
+    The sequential sweep over light (q < 1) and heavy (q >= 1) buckets is expressed with prefix sums:
+    light bucket i borrows from the first heavy whose cumulative surplus exceeds the cumulative deficit of the lights before it,
+    and every heavy borrows its remaining deficit from the next heavy.
+    """
+    n = weights.shape[0]
+    q = weights.double() * (n / weights.double().sum())
+    light = q < 1.
+    light_index, heavy_index = light.nonzero()[:,0], (~light).nonzero()[:,0]
+    prob = q.clone()
+    alias = torch.arange(n, device=weights.device)
+    if len(light_index) == 0 or len(heavy_index) == 0:
+        return prob.clamp(max=1.).float(), alias
+    deficit = torch.cumsum(1. - q[light_index], dim=0)
+    surplus = torch.cumsum(q[heavy_index] - 1., dim=0)
+    deficit_before = torch.cat([deficit.new_zeros(1), deficit[:-1]])
+    donor = torch.searchsorted(surplus, deficit_before, right=True).clamp(max=len(heavy_index) - 1)
+    alias[light_index] = heavy_index[donor]
+    # deficit consumed once heavy j is exhausted, i.e. by all lights that borrowed from heavies <= j
+    n_served = torch.searchsorted(deficit_before, surplus, right=False)
+    consumed = torch.where(n_served > 0, deficit[(n_served - 1).clamp(min=0)], torch.zeros_like(surplus))
+    prob[heavy_index] = 1. + surplus - consumed
+    alias[heavy_index[:-1]] = heavy_index[1:]
+    prob[heavy_index[-1]] = 1.
+    return prob.clamp(0., 1.).float(), alias
+
+
+def sample_alias_table(prob, alias, n_samples):
+    bucket = torch.randint(0, prob.shape[0], size=(n_samples,), device=prob.device)
+    accept = torch.rand((n_samples,), device=prob.device) < prob[bucket]
+    return torch.where(accept, bucket, alias[bucket])
+
+
+class BasePixelSampler():
+    """
+    Draws (index, y, x) of the training pixels of each batch.
+    update() receives the per-pixel errors of the sampled rays after the forward pass.
+    """
+    def __init__(self, config, dataset):
+        self.config = config
+        self.dataset = dataset
+        self.device = dataset.all_images.device
+        self.n_images, self.h, self.w = len(dataset.all_images), dataset.h, dataset.w
+
+    def sample(self, n_rays):
+        raise NotImplementedError
+
+    def update(self, pixel_index, errors):
+        pass
+
+    def unravel(self, pixel_index):
+        index = torch.div(pixel_index, self.h * self.w, rounding_mode='floor')
+        pixel_index = pixel_index - index * self.h * self.w
+        y = torch.div(pixel_index, self.w, rounding_mode='floor')
+        x = pixel_index - y * self.w
+        return index, y, x
+
+
+@register('uniform')
+class UniformPixelSampler(BasePixelSampler):
+    def sample(self, n_rays):
+        if self.config.get('batch_image_sampling', True):
+            index = torch.randint(0, self.n_images, size=(n_rays,), device=self.device)
+        else:
+            index = torch.randint(0, self.n_images, size=(1,), device=self.device)
+        x = torch.randint(
+            0, self.w, size=(n_rays,), device=self.device
+        )
+        y = torch.randint(
+            0, self.h, size=(n_rays,), device=self.device
+        )
+        return index, y, x
+
+
+@register('importance')
+class ImportancePixelSampler(BasePixelSampler):
+    """
+    Samples pixels proportionally to their last observed error, mixed with a uniform distribution so that no pixel starves.
+    Errors of never-sampled pixels stay at init_error, the alias table is rebuilt every update_every steps.
+    Samples across all images regardless of batch_image_sampling.
+    """
+    def __init__(self, config, dataset):
+        super().__init__(config, dataset)
+        self.update_every = self.config.get('update_every', 500)
+        self.uniform_ratio = self.config.get('uniform_ratio', 0.2)
+        self.errors = torch.full((self.n_images * self.h * self.w,), self.config.get('init_error', 1.0), dtype=torch.float32, device=self.device)
+        self.n_updates = 0
+        self.rebuild()
+
+    def rebuild(self):
+        weights = (1. - self.uniform_ratio) * self.errors / self.errors.sum().clamp(min=1e-12) + self.uniform_ratio / self.errors.shape[0]
+        self.prob, self.alias = build_alias_table(weights)
+
+    def sample(self, n_rays):
+        return self.unravel(sample_alias_table(self.prob, self.alias, n_rays))
+
+    def update(self, pixel_index, errors):
+        self.errors[pixel_index.to(self.device)] = errors.detach().float().to(self.device)
+        self.n_updates += 1
+        if self.n_updates % self.update_every == 0:
+            self.rebuild()
+
+
+@register('mask')
+class MaskPixelSampler(BasePixelSampler):
+    """
+    Splits the ray budget between foreground and background pixels using the loaded foreground masks.
+    fg_ratio of the rays are drawn from the foreground, of which boundary_ratio (relative to all rays) come from a band of
+    band_width pixels around the mask boundary. Budgets of empty pools fall back to uniform sampling over all pixels,
+    as does the whole sampler when the dataset does not apply its masks.
+    The split is applied to whatever number of rays is requested, so it adapts with dynamic_ray_sampling.
+    Pools hold int32 flat pixel indices, built chunk by chunk.
+    """
+    def __init__(self, config, dataset):
+        super().__init__(config, dataset)
+        self.fg_ratio = self.config.get('fg_ratio', 0.8)
+        self.boundary_ratio = self.config.get('boundary_ratio', 0.2)
+        assert 0. <= self.boundary_ratio <= self.fg_ratio <= 1.
+        assert self.n_images * self.h * self.w < 2**31, "Too many pixels for int32 pixel indices"
+        self.pools = []
+        if not dataset.apply_mask:
+            return
+        band_width = self.config.get('band_width', 4)
+        boundary_pool, interior_pool, background_pool = [], [], []
+        start = 0
+        for mask in dataset.all_fg_masks.split(self.config.get('chunk', 16)):
+            mask = (to_float(mask) > 0.5).float()[:,None]
+            dilated = F.max_pool2d(mask, kernel_size=2 * band_width + 1, stride=1, padding=band_width) > 0.5
+            eroded = -F.max_pool2d(-mask, kernel_size=2 * band_width + 1, stride=1, padding=band_width) > 0.5
+            fg, boundary = (mask[:,0] > 0.5).view(-1), (dilated & ~eroded)[:,0].view(-1)
+            for pool, selected in [(boundary_pool, boundary), (interior_pool, fg & ~boundary), (background_pool, ~fg & ~boundary)]:
+                pool.append(selected.nonzero()[:,0].int() + start)
+            start += fg.shape[0]
+        boundary_pool, interior_pool, background_pool = [torch.cat(pool, dim=0) for pool in [boundary_pool, interior_pool, background_pool]]
+        # thin objects may lie entirely inside the band and vice versa, keep the foreground budget in that case
+        if len(interior_pool) == 0:
+            foreground_pools = [(boundary_pool, self.fg_ratio)]
+        elif len(boundary_pool) == 0:
+            foreground_pools = [(interior_pool, self.fg_ratio)]
+        else:
+            foreground_pools = [(boundary_pool, self.boundary_ratio), (interior_pool, self.fg_ratio - self.boundary_ratio)]
+        self.pools = foreground_pools + [(background_pool, 1. - self.fg_ratio)]
+
+    def sample(self, n_rays):
+        pixel_index, n_sampled = [], 0
+        for pool, ratio in self.pools:
+            n = min(int(round(n_rays * ratio)), n_rays - n_sampled)
+            if len(pool) == 0 or n == 0:
+                continue
+            pixel_index.append(pool[torch.randint(0, len(pool), size=(n,), device=pool.device)])
+            n_sampled += n
+        if n_sampled < n_rays:
+            pixel_index.append(torch.randint(0, self.n_images * self.h * self.w, size=(n_rays - n_sampled,), dtype=torch.int32, device=self.device))
+        return self.unravel(torch.cat(pixel_index, dim=0).long())
@@ -11,6 +11,7 @@ import json
 import torch
 
 from utils.obj import write_obj
+from utils.ply import write_ply
 
 
 class SaverMixin():
@@ -208,18 +209,25 @@ class SaverMixin():
             imgs = [cv2.cvtColor(i, cv2.COLOR_BGR2RGB) for i in imgs]
             imageio.mimsave(self.get_save_path(filename), imgs, fps=fps)
     
-    def save_mesh(self, filename, v_pos, t_pos_idx, v_tex=None, t_tex_idx=None, v_rgb=None):
+    def save_mesh(self, filename, v_pos, t_pos_idx, v_tex=None, t_tex_idx=None, v_rgb=None, **kwargs):
         v_pos, t_pos_idx = self.convert_data(v_pos), self.convert_data(t_pos_idx)
         if v_rgb is not None:
             v_rgb = self.convert_data(v_rgb)
+        if v_tex is not None:
+            v_tex, t_tex_idx = self.convert_data(v_tex), self.convert_data(t_tex_idx)
 
-        import trimesh
-        mesh = trimesh.Trimesh(
-            vertices=v_pos,
-            faces=t_pos_idx,
-            vertex_colors=v_rgb
-        )
-        mesh.export(self.get_save_path(filename))
+        if filename.endswith('.obj'):
+            write_obj(self.get_save_path(filename), v_pos, t_pos_idx, v_tex=v_tex, t_tex_idx=t_tex_idx, v_rgb=v_rgb, **kwargs)
+        elif filename.endswith('.ply'):
+            write_ply(self.get_save_path(filename), v_pos, t_pos_idx, v_rgb=v_rgb, **kwargs)
+        else:
+            import trimesh
+            mesh = trimesh.Trimesh(
+                vertices=v_pos,
+                faces=t_pos_idx,
+                vertex_colors=v_rgb
+            )
+            mesh.export(self.get_save_path(filename))
     
     def save_file(self, filename, src_path):
         shutil.copyfile(src_path, self.get_save_path(filename))
@@ -1,74 +1,143 @@
 import numpy as np
 
+from utils.ply import load_ply
+
+
+SPACE, NEWLINE = ord(' '), ord('\n')
+ASCII_LOWER = 0x20 # or-ed into an ASCII letter gives its lower case
+
+
+def split_lines(raw):
+    # start and end (newline) offsets of every line of the file bytes
+    if len(raw) > 0 and raw[-1] != NEWLINE:
+        raw = np.append(raw, np.uint8(NEWLINE))
+    ends = np.flatnonzero(raw == NEWLINE)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    return raw, starts, ends
+
+
+def is_space(raw):
+    return (raw == SPACE) | (raw == ord('\t')) | (raw == ord('\r')) | (raw == NEWLINE)
+
+
+def select_records(raw, starts, ends, prefix):
+    # the records of the lines starting with the given (lower case) prefix in any case, concatenated without the prefix
+    n = len(prefix)
+    selected = ends - starts > n
+    for i, c in enumerate(prefix.lower().encode()):
+        selected[selected] &= (raw[starts[selected] + i] | ASCII_LOWER) == c
+    selected[selected] &= is_space(raw[starts[selected] + n])
+    if not selected.any():
+        return None, 0
+    index = np.flatnonzero(selected)
+    if index[-1] - index[0] + 1 == len(index):
+        # a single run of lines (as written by write_obj), blank out the prefixes of a copy of the byte range
+        block = raw[starts[index[0]]:ends[index[-1]] + 1].copy()
+        for i in range(n):
+            block[starts[index] - starts[index[0]] + i] = SPACE
+        return block, len(index)
+    # byte mask of the selected lines without their prefix, from +1/-1 markers at the record starts and ends
+    marker = np.zeros(len(raw) + 1, dtype=np.int8)
+    marker[starts[index] + n] += 1
+    marker[ends[index] + 1] -= 1
+    block = raw[np.cumsum(marker[:-1], dtype=np.int8).view(bool)]
+    return block, len(index)
+
+
+def parse_records(raw, starts, ends, prefix, dtype):
+    # all records of the given prefix parsed in bulk, (n_records, n_values) array or None
+    block, n_records = select_records(raw, starts, ends, prefix)
+    if n_records == 0:
+        return None
+    values = np.fromstring(block.tobytes(), dtype=dtype, sep=' ')
+    return values.reshape(n_records, -1)
+
+
+def parse_faces(raw, starts, ends):
+    # returns the (vertex, texcoord) indices of the fan-triangulated polygons
+    block, n_records = select_records(raw, starts, ends, 'f')
+    if n_records == 0:
+        return np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+    # number of vertices of each polygon from the token starts
+    space = is_space(block)
+    token_start = ~space & np.concatenate([[True], space[:-1]])
+    n_tokens = int(np.count_nonzero(token_start))
+    if n_tokens == 3 * n_records:
+        # triangles only, as a face has at least 3 vertices
+        counts = np.full(n_records, 3, dtype=np.int64)
+    else:
+        line_starts = np.concatenate([[0], np.flatnonzero(block == NEWLINE)[:-1] + 1])
+        counts = np.add.reduceat(token_start, line_starts, dtype=np.int64)
+
+    # v, v/vt, v//vn or v/vt/vn, an empty vt becomes 0 i.e. -1 after the offset like a missing texture index
+    block = block.tobytes()
+    first_token = block[np.argmax(token_start):].split(None, 1)[0]
+    n_fields = len(first_token.split(b'/'))
+    values = np.fromstring(block.replace(b'//', b'/0/').replace(b'/', b' '), dtype=np.int64, sep=' ')
+    if values.size != n_tokens * n_fields:
+        # the polygons mix index formats, parse token by token
+        values = np.array([[int(field) if field != b'' else 0 for field in (token.split(b'/') + [b'0'])[:2]] for token in block.split()], dtype=np.int64)
+        n_fields = 2
+    values = values.reshape(n_tokens, n_fields) - 1
+    v_index = values[:,0]
+    vt_index = values[:,1] if n_fields > 1 else np.full(n_tokens, -1, dtype=np.int64)
+
+    # fan triangulation (v0, vi, vi+1) of each polygon
+    first = np.cumsum(counts) - counts
+    n_triangles = np.maximum(counts - 2, 0)
+    polygon = np.repeat(np.arange(len(counts)), n_triangles)
+    i = np.arange(n_triangles.sum()) - np.repeat(np.cumsum(n_triangles) - n_triangles, n_triangles) + 1
+    corners = np.stack([first[polygon], first[polygon] + i, first[polygon] + i + 1], axis=-1)
+    return v_index[corners], vt_index[corners]
+
 
 def load_obj(filename):
-    # Read entire file
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-
-    # load vertices
-    vertices, texcoords  = [], []
-    for line in lines:
-        if len(line.split()) == 0:
-            continue
-        
-        prefix = line.split()[0].lower()
-        if prefix == 'v':
-            vertices.append([float(v) for v in line.split()[1:]])
-        elif prefix == 'vt':
-            val = [float(v) for v in line.split()[1:]]
-            texcoords.append([val[0], 1.0 - val[1]])
-    
-    uv = len(texcoords) > 0
-    faces, tfaces = [], []
-    for line in lines:
-        if len(line.split()) == 0:
-            continue
-        prefix = line.split()[0].lower()
-        if prefix == 'usemtl': # Track used materials
-            pass
-        elif prefix == 'f': # Parse face
-            vs = line.split()[1:]
-            nv = len(vs)
-            vv = vs[0].split('/')
-            v0 = int(vv[0]) - 1
-            if uv:
-                t0 = int(vv[1]) - 1 if vv[1] != "" else -1
-            for i in range(nv - 2): # Triangulate polygons
-                vv1 = vs[i + 1].split('/')
-                v1 = int(vv1[0]) - 1
-                vv2 = vs[i + 2].split('/')
-                v2 = int(vv2[0]) - 1
-                faces.append([v0, v1, v2])
-                if uv:
-                    t1 = int(vv1[1]) - 1 if vv1[1] != "" else -1
-                    t2 = int(vv2[1]) - 1 if vv2[1] != "" else -1
-                    tfaces.append([t0, t1, t2])
-    vertices = np.array(vertices, dtype=np.float32)
-    faces = np.array(faces, dtype=np.int64)
-    if uv:
-        assert len(tfaces) == len(faces)
-        texcoords = np.array(texcoords, dtype=np.float32)
-        tfaces = np.array(tfaces, dtype=np.int64)
+    if filename.endswith('.ply'):
+        return load_ply(filename)
+
+    with open(filename, 'rb') as f:
+        raw, starts, ends = split_lines(np.frombuffer(f.read(), dtype=np.uint8))
+
+    vertices = parse_records(raw, starts, ends, 'v', np.float64)
+    vertices = vertices.astype(np.float32) if vertices is not None else np.zeros((0, 3), dtype=np.float32)
+    texcoords = parse_records(raw, starts, ends, 'vt', np.float64)
+    faces, tfaces = parse_faces(raw, starts, ends)
+    if texcoords is not None:
+        texcoords = np.stack([texcoords[:,0], 1.0 - texcoords[:,1]], axis=-1).astype(np.float32)
     else:
-        texcoords, tfaces = None, None 
+        texcoords, tfaces = None, None
 
     return vertices, faces, texcoords, tfaces
 
 
-def write_obj(filename, v_pos, t_pos_idx, v_tex, t_tex_idx):
+def write_rows(f, row_format, rows, chunk_size=1048576):
+    # format a block of rows with a single %-operation per chunk instead of one write per row
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i+chunk_size]
+        f.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def write_obj(filename, v_pos, t_pos_idx, v_tex=None, t_tex_idx=None, v_rgb=None, precision=None, color_precision=4):
+    """
+    precision: number of decimals of the vertex positions (quantization), shortest round-trip float32 representation if None.
+    color_precision: number of decimals of the vertex colors, written after the positions as in trimesh.
+    """
+    v_pos, t_pos_idx = np.asarray(v_pos), np.asarray(t_pos_idx, dtype=np.int64)
+    position_format = '%.9g' if precision is None else f'%.{precision}f'
     with open(filename, "w") as f:
-        for v in v_pos:
-            f.write('v {} {} {} \n'.format(v[0], v[1], v[2]))
-       
+        if v_rgb is not None:
+            v_rgb = np.asarray(v_rgb)
+            v_rgb = v_rgb / 255. if v_rgb.dtype == np.uint8 else v_rgb
+            color_format = f'%.{color_precision}f'
+            write_rows(f, f'v {position_format} {position_format} {position_format} {color_format} {color_format} {color_format}\n', np.concatenate([v_pos, v_rgb], axis=-1))
+        else:
+            write_rows(f, f'v {position_format} {position_format} {position_format}\n', v_pos)
+
         if v_tex is not None:
             assert(len(t_pos_idx) == len(t_tex_idx))
-            for v in v_tex:
-                f.write('vt {} {} \n'.format(v[0], 1.0 - v[1]))
-
-        # Write faces
-        for i in range(len(t_pos_idx)):
-            f.write("f ")
-            for j in range(3):
-                f.write(' %s/%s' % (str(t_pos_idx[i][j]+1), '' if v_tex is None else str(t_tex_idx[i][j]+1)))
-            f.write("\n")
+            v_tex = np.asarray(v_tex)
+            write_rows(f, 'vt %.9g %.9g\n', np.stack([v_tex[:,0], 1.0 - v_tex[:,1]], axis=-1))
+            # interleave position and texture indices, 1-based
+            write_rows(f, 'f %d/%d %d/%d %d/%d\n', np.stack([t_pos_idx + 1, np.asarray(t_tex_idx, dtype=np.int64) + 1], axis=-1).reshape(-1, 6))
+        else:
+            write_rows(f, 'f %d %d %d\n', t_pos_idx + 1)
@@ -0,0 +1,122 @@
+import numpy as np
+
+
+def write_ply(filename, v_pos, t_pos_idx, v_rgb=None, position_dtype=np.float32, color_dtype=np.uint8):
+    """
+    Binary little-endian PLY written with one bulk write per element.
+    position_dtype: np.float32 or np.float64, color_dtype: np.uint8 (colors quantized to 8 bits) or np.float32.
+    """
+    v_pos, t_pos_idx = np.asarray(v_pos), np.asarray(t_pos_idx)
+    ply_types = {np.dtype(np.float32): 'float', np.dtype(np.float64): 'double', np.dtype(np.uint8): 'uchar'}
+    position_dtype, color_dtype = np.dtype(position_dtype), np.dtype(color_dtype)
+
+    vertex_fields = [('x', position_dtype), ('y', position_dtype), ('z', position_dtype)]
+    if v_rgb is not None:
+        vertex_fields += [('red', color_dtype), ('green', color_dtype), ('blue', color_dtype)]
+    vertices = np.empty(len(v_pos), dtype=vertex_fields)
+    vertices['x'], vertices['y'], vertices['z'] = v_pos[:,0], v_pos[:,1], v_pos[:,2]
+    if v_rgb is not None:
+        v_rgb = np.asarray(v_rgb)
+        if color_dtype == np.uint8 and v_rgb.dtype != np.uint8:
+            v_rgb = np.round(np.clip(v_rgb, 0., 1.) * 255.)
+        vertices['red'], vertices['green'], vertices['blue'] = v_rgb[:,0], v_rgb[:,1], v_rgb[:,2]
+
+    faces = np.empty(len(t_pos_idx), dtype=[('n', np.uint8), ('vertex_indices', '<i4', (3,))])
+    faces['n'] = 3
+    faces['vertex_indices'] = t_pos_idx
+
+    header = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(vertices)}']
+    header += [f'property {ply_types[dtype]} {name}' for name, dtype in vertex_fields]
+    header += [f'element face {len(faces)}', 'property list uchar int vertex_indices', 'end_header']
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(vertices.data)
+        f.write(faces.data)
+
+
+PLY_DTYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+
+def read_ply_header(f):
+    # returns the format and the list of (name, count, properties) elements, a property being (name, dtype) or (name, count dtype, item dtype) for lists
+    assert f.readline().strip() == b'ply', "Not a PLY file"
+    fmt, elements = None, []
+    while True:
+        tokens = f.readline().decode('ascii').split()
+        if len(tokens) == 0 or tokens[0] in ['comment', 'obj_info']:
+            continue
+        if tokens[0] == 'end_header':
+            return fmt, elements
+        if tokens[0] == 'format':
+            fmt = tokens[1]
+        elif tokens[0] == 'element':
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == 'property' and tokens[1] == 'list':
+            elements[-1][2].append((tokens[4], PLY_DTYPES[tokens[2]], PLY_DTYPES[tokens[3]]))
+        elif tokens[0] == 'property':
+            elements[-1][2].append((tokens[2], PLY_DTYPES[tokens[1]]))
+
+
+def read_binary_faces(buffer, offset, count, count_dtype, index_dtype):
+    # triangle meshes are fixed-size records, other polygons are read record by record and fan-triangulated
+    triangles = np.dtype([('n', count_dtype), ('v', index_dtype, (3,))])
+    records = np.frombuffer(buffer, dtype=triangles, count=count, offset=offset) if len(buffer) - offset >= count * triangles.itemsize else None
+    if records is not None and (records['n'] == 3).all():
+        return records['v'].astype(np.int64), offset + count * triangles.itemsize
+    count_dtype, index_dtype = np.dtype(count_dtype), np.dtype(index_dtype)
+    faces = []
+    for _ in range(count):
+        n = int(np.frombuffer(buffer, dtype=count_dtype, count=1, offset=offset)[0])
+        polygon = np.frombuffer(buffer, dtype=index_dtype, count=n, offset=offset + count_dtype.itemsize).astype(np.int64)
+        faces += [[polygon[0], polygon[i], polygon[i + 1]] for i in range(1, n - 1)]
+        offset += count_dtype.itemsize + n * index_dtype.itemsize
+    return np.array(faces, dtype=np.int64).reshape(-1, 3), offset
+
+
+def load_ply(filename):
+    """
+    Reads the vertex positions and the (fan-triangulated) faces of a binary or ASCII PLY file.
+    Returns (vertices, faces, texcoords, tfaces) like utils/obj.load_obj, without texture coordinates.
+    """
+    with open(filename, 'rb') as f:
+        fmt, elements = read_ply_header(f)
+        data = f.read()
+
+    vertices, faces = np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64)
+    if fmt == 'ascii':
+        lines = data.decode('ascii').split('\n')
+        start = 0
+        for name, count, properties in elements:
+            rows = lines[start:start + count]
+            start += count
+            if name == 'vertex':
+                values = np.fromstring(' '.join(rows), dtype=np.float64, sep=' ').reshape(count, -1)
+                xyz = [[p[0] for p in properties].index(axis) for axis in ['x', 'y', 'z']]
+                vertices = values[:,xyz].astype(np.float32)
+            elif name == 'face':
+                values = np.fromstring(' '.join(rows), dtype=np.int64, sep=' ')
+                if values.size == 4 * count and (values[::4] == 3).all():
+                    faces = values.reshape(count, 4)[:,1:]
+                else:
+                    polygons = [np.array(row.split()[1:], dtype=np.int64) for row in rows]
+                    faces = np.array([[p[0], p[i], p[i + 1]] for p in polygons for i in range(1, len(p) - 1)], dtype=np.int64).reshape(-1, 3)
+        return vertices, faces, None, None
+
+    byte_order = {'binary_little_endian': '<', 'binary_big_endian': '>'}[fmt]
+    offset = 0
+    for name, count, properties in elements:
+        if any(len(p) == 3 for p in properties):
+            assert name == 'face' and len(properties) == 1, "Only face elements with a single list property are supported"
+            _, count_dtype, index_dtype = properties[0]
+            faces, offset = read_binary_faces(data, offset, count, byte_order + count_dtype, byte_order + index_dtype)
+        else:
+            records = np.frombuffer(data, dtype=np.dtype([(p[0], byte_order + p[1]) for p in properties]), count=count, offset=offset)
+            offset += records.nbytes
+            if name == 'vertex':
+                vertices = np.stack([records['x'], records['y'], records['z']], axis=-1).astype(np.float32)
+    return vertices, faces, None, None